@@ -0,0 +1,74 @@
+from base.backends import open_base
+from base.migrate import migrate
+import json
+import sys
+
+# Commands available only on backends with these methods.
+COMMANDS = {
+    "-stats": "rebuild_stats",
+    "-vacuum": "enable_incremental_vacuum",
+    "-archive": "archive"
+}
+
+
+def usage():
+    print("Usage:", args[0],
+          "-h|-reindex|-stats|-compress <level>|-prune|-vacuum|"
+          "-archive <echoarea> <directory>|"
+          "-migrate <backend> <path> [checkpoint]")
+    sys.exit(0)
+
+
+config = json.loads(open("server.json").read())
+config.pop("bloom", None)
+base = open_base(config)
+args = sys.argv
+if len(args) == 1 or args[1] == "-h":
+    usage()
+elif args[1] in COMMANDS and not hasattr(base, COMMANDS[args[1]]):
+    print("Error: {} is not supported by {} backend.".format(
+        args[1], config.get("backend", "sqlite")))
+    usage()
+elif args[1] == "-reindex":
+    base.rebuild_search_index()
+    print("Search index rebuilt.")
+elif args[1] == "-stats":
+    base.rebuild_stats()
+    print("Activity rollups rebuilt.")
+elif args[1] == "-compress" and len(args) > 2:
+    stats = base.compress_messages(int(args[2]))
+    print("Messages: {}".format(stats["count"]))
+    print("Size: {} -> {} bytes ({:.1%})".format(
+        stats["before"], stats["after"],
+        stats["after"] / stats["before"] if stats["before"] else 1))
+    print("CPU: compress {:.3f}s, decompress {:.3f}s".format(
+        stats["compress_seconds"], stats["decompress_seconds"]))
+elif args[1] == "-prune":
+    for echoarea in config["echoareas"]:
+        if "max_count" not in echoarea and "max_days" not in echoarea:
+            continue
+        max_age = None
+        if "max_days" in echoarea:
+            max_age = echoarea["max_days"] * 86400
+        deleted = base.prune(echoarea["name"], echoarea.get("max_count"),
+                             max_age)
+        print("{}: {} messages deleted.".format(echoarea["name"], deleted))
+elif args[1] == "-vacuum":
+    base.enable_incremental_vacuum()
+    print("Incremental vacuum enabled.")
+elif args[1] == "-archive" and len(args) > 3:
+    filename = base.archive(args[2], args[3])
+    if filename:
+        print("Echoarea archived to {}.".format(filename))
+    else:
+        print("Echoarea has no own shard.")
+elif args[1] == "-migrate" and len(args) > 3:
+    target = open_base(dict(config, backend=args[2], base=args[3]))
+    checkpoint = args[4] if len(args) > 4 else args[3] + ".migrate"
+    saved = migrate(base, target, checkpoint,
+                    progress=lambda echoarea, done, total, speed: print(
+                        "{}: {}/{} ({:.0f} msg/s)".format(echoarea, done,
+                                                          total, speed)))
+    print("{} messages migrated.".format(saved))
+else:
+    usage()
@@ -0,0 +1,67 @@
+"""
+Aggregation of echoareas activity rollups.
+"""
+
+from collections import Counter
+from typing import Dict, List, Tuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DAY = 86400
+HOUR = 3600
+
+
+def count_pairs(groups: List[int], values: List[int]) -> Dict[Tuple[int, int],
+                                                               int]:
+    """
+    Count occurrences of (group, value) pairs. Vectorized by numpy if
+    it is installed and pairs fit in 64-bit keys, other pairs are counted
+    by Counter, so both ways give same results.
+
+    Args:
+        groups (List): Group ids, e.g. echoareas ids.
+        values (List): Values, e.g. days or authors ids.
+
+    Return:
+        Dict: Counts of pairs {(group, value): int}.
+    """
+    if numpy is None:
+        return Counter(zip(groups, values))
+    groups = numpy.asarray(groups, dtype=numpy.int64)
+    values = numpy.asarray(values, dtype=numpy.int64)
+    if len(values) and (groups.min() < 0 or groups.max() > 0x7FFFFFFF or
+                        values.min() < 0 or values.max() > 0xFFFFFFFF):
+        return Counter(zip(groups.tolist(), values.tolist()))
+    keys = (groups << 32) | values
+    keys, counts = numpy.unique(keys, return_counts=True)
+    return dict(zip(zip((keys >> 32).tolist(), (keys & 0xFFFFFFFF).tolist()),
+                    counts.tolist()))
+
+
+def aggregate(echoarea_ids: List[int], dates: List[int],
+              author_ids: List[int]) -> Dict[str, Counter]:
+    """
+    Build daily, hourly and posters rollups of messages columns.
+
+    Args:
+        echoarea_ids (List): Echoarea id of every message.
+        dates (List): Date (unixtime) of every message.
+        author_ids (List): Author id of every message.
+
+    Return:
+        Dict: Rollups {"daily", "hourly", "posters"} as Counters of
+              {(echoarea_id, day or hour or author_id): count}.
+    """
+    if numpy is None:
+        days = [date // DAY for date in dates]
+        hours = [date // HOUR for date in dates]
+    else:
+        dates = numpy.asarray(dates, dtype=numpy.int64)
+        days = dates // DAY
+        hours = dates // HOUR
+    return {"daily": Counter(count_pairs(echoarea_ids, days)),
+            "hourly": Counter(count_pairs(echoarea_ids, hours)),
+            "posters": Counter(count_pairs(echoarea_ids, author_ids))}
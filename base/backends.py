@@ -0,0 +1,35 @@
+"""
+Messages base factory.
+"""
+
+from base.base import Base
+from base.sharded import Sharded
+from base.sqlite import Sqlite
+from base.txt import Txt
+from typing import Dict
+
+
+def open_base(config: Dict[str, object]) -> Base:
+    """
+    Open messages base by config.
+
+    Args:
+        config (Dict): Config with "base" path and optional "backend"
+                       ("sqlite", "txt" or "sharded"), "store_encoded",
+                       "compression", "buckets" and "bloom" keys.
+
+    Return:
+        Base: Messages base.
+    """
+    backend = config.get("backend", "sqlite")
+    if backend == "sqlite":
+        return Sqlite(config["base"], config.get("store_encoded", False),
+                      config.get("compression", 0), config.get("bloom"))
+    elif backend == "txt":
+        return Txt(config["base"], config.get("compression", 0),
+                   config.get("bloom"))
+    elif backend == "sharded":
+        return Sharded(config["base"], config.get("store_encoded", False),
+                       config.get("compression", 0),
+                       config.get("buckets", 0), config.get("bloom"))
+    raise ValueError("unknown backend: {}".format(backend))
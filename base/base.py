@@ -2,17 +2,22 @@
 Message base abstract class.
 """
 
+from base.bloom import BloomFilter
+from base.message import Message
 from base64 import urlsafe_b64encode, urlsafe_b64decode
 from hashlib import sha256
 from random import randint
 from sys import getsizeof
+from threading import RLock
 from time import time
-from typing import Callable, Dict, List
+from typing import Callable, Dict, Iterator, List, Union
+import zlib
 
 
 class Base:
     def __init__(self, path: str):
-        pass
+        self.bloom = None
+        self.bloom_lock = RLock()
 
     def check_base(self):
         """
@@ -29,6 +34,24 @@ class Base:
         """
         pass
 
+    def set_blacklisted(self, msgids: List[str]):
+        """
+        Add msgids to blacklist.
+
+        Args:
+            msgids (List): Msgids.
+        """
+        pass
+
+    def get_echoareas(self) -> List[str]:
+        """
+        Names of all echoareas stored in base.
+
+        Return:
+            List: Echoareas names.
+        """
+        pass
+
     def get_counts(self, echoareas: List[str]) -> Dict[str, int]:
         """
         Counts the number of messages in a echoarea.
@@ -53,6 +76,101 @@ class Base:
         """
         pass
 
+    def get_index_since(self, marks: Dict[str, str]) -> Dict[str, List[str]]:
+        """
+        Get msgids added to echoareas after mark.
+
+        Args:
+            marks (Dict): Marks of echoareas {"name": "mark"}, where mark
+                          is msgid of echoarea message or unixtime.
+                          Whole echoarea index returned for unknown msgid.
+
+        Return:
+            Dict: Msgids of echoareas {"name": List}.
+        """
+        pass
+
+    @staticmethod
+    def is_msgid(mark: str) -> bool:
+        """
+        Check mark of get_index_since is msgid and not unixtime.
+
+        Args:
+            mark (str): Msgid or unixtime.
+
+        Return:
+            bool: True if mark is msgid.
+        """
+        return len(mark) == 20 and not mark.isdigit()
+
+    def get_msgids(self) -> Iterator[str]:
+        """
+        Iterate msgids of all stored messages.
+
+        Return:
+            Iterator: Msgids.
+        """
+        pass
+
+    def load_bloom(self, options: Dict[str, float] = None):
+        """
+        Build Bloom filter of stored msgids for fast checks on save.
+
+        Args:
+            options (Dict, optional): Filter options {"capacity",
+                                      "error_rate", "max_memory"}.
+                                      Filter is disabled if None.
+        """
+        if options is None:
+            self.bloom = None
+            return
+        with self.bloom_lock:
+            bloom = BloomFilter(options.get("capacity", 1000000),
+                                options.get("error_rate", 0.001),
+                                options.get("max_memory"))
+            for msgid in self.get_msgids():
+                bloom.add(msgid)
+            self.bloom = bloom
+            if bloom.is_full():
+                options = dict(options, capacity=bloom.count * 2)
+                self.load_bloom(options)
+
+    def remember_msgid(self, msgid: str):
+        """
+        Add saved msgid to Bloom filter.
+
+        Args:
+            msgid (str): Msgid.
+        """
+        if self.bloom is not None:
+            with self.bloom_lock:
+                self.bloom.add(msgid)
+
+    def grow_bloom(self):
+        """
+        Rebuild Bloom filter with doubled capacity if it is overfilled.
+        Must be called outside of write transactions, because filter is
+        rebuilt from committed msgids.
+        """
+        with self.bloom_lock:
+            if self.bloom is not None and self.bloom.is_full():
+                self.load_bloom({"capacity": self.bloom.count * 2,
+                                 "error_rate": self.bloom.error_rate,
+                                 "max_memory": self.bloom.max_memory})
+
+    def may_exist(self, msgid: str) -> bool:
+        """
+        Fast check of message existence before saving.
+
+        Args:
+            msgid (str): Msgid.
+
+        Return:
+            bool: False if message is definitely new, True if it may exist
+                  and base must be checked.
+        """
+        return self.bloom is None or msgid in self.bloom
+
     def is_message_exists(self, msgid: str) -> bool:
         """
         Check message exists in echoarea.
@@ -77,7 +195,33 @@ class Base:
         """
         pass
 
-    def save_message(self, echoarea: str, msgid: str, message: str,
+    def get_message_data(self, msgid: str) -> bytes:
+        """
+        Get stored message bytes by msgid.
+
+        Args:
+            msgid (str): Msgid.
+
+        Return:
+            bytes: Message as utf-8 bytes.
+        """
+        return self.get_message(msgid).encode("utf-8")
+
+    def get_bundle(self, msgids: List[str]) -> List[Message]:
+        """
+        Get existing messages with their stored bytes and base64 forms.
+
+        Args:
+            msgids (List): Msgids.
+
+        Return:
+            List: Messages in msgids order.
+        """
+        return [Message(msgid=msgid, data=self.get_message_data(msgid))
+                for msgid in msgids if self.is_message_exists(msgid)]
+
+    def save_message(self, echoarea: str, msgid: str,
+                     message: Union[str, Message],
                      other: object = None) -> bool:
         """
         Save message to base.
@@ -85,7 +229,7 @@ class Base:
         Args:
             echoarea (str): Echoarea name.
             msgid (str): Msgid.
-            message (str): Message as plain text.
+            message (str or Message): Message.
             other (object): Additional argument.
 
         Return:
@@ -93,13 +237,12 @@ class Base:
         """
         pass
 
-    def save_messages(self, bundle: List[Dict[str, str]]) -> int:
+    def save_messages(self, bundle: List[Message]) -> int:
         """
         Save messages of bundle to base.
 
         Args:
-            bundle (List): Bundle as List of dict:
-                           {"msgid", "encoded"}.
+            bundle (List): Bundle as List of messages.
 
         Return:
             int: Saved messages count.
@@ -121,6 +264,169 @@ class Base:
         """
         pass
 
+    def search(self, query: str, echoarea: str = None, since: int = None,
+               until: int = None, limit: int = 20) -> List[Dict[str, str]]:
+        """
+        Full-text search of messages.
+
+        Args:
+            query (str): Search words.
+            echoarea (str, optional): Echoarea name filter.
+            since (int, optional): Minimal message date (unixtime).
+            until (int, optional): Maximal message date (unixtime).
+            limit (int, optional): Maximal results count.
+
+        Return:
+            List: Found messages ordered by rank as Dict:
+                  {"msgid", "snippet"}.
+        """
+        pass
+
+    def rebuild_search_index(self):
+        """
+        Rebuild full-text search index of all messages.
+        """
+        pass
+
+    def get_echoarea_stats(self, echoarea: str, days: int = 30,
+                           top: int = 10) -> Dict[str, List]:
+        """
+        Activity of echoarea from rollups.
+
+        Args:
+            echoarea (str): Echoarea name.
+            days (int, optional): Days of daily and hourly activity.
+            top (int, optional): Count of top posters and threads.
+
+        Return:
+            Dict: Activity {"daily", "hourly", "posters", "threads"} or
+                  None if base has no rollups.
+        """
+        pass
+
+    def get_parent(self, msgid: str) -> str:
+        """
+        Get msgid of message to which message replies.
+
+        Args:
+            msgid (str): Msgid.
+
+        Return:
+            str: Parent msgid or None.
+        """
+        pass
+
+    def get_children(self, msgids: List[str]) -> List[str]:
+        """
+        Get msgids of replies to messages.
+
+        Args:
+            msgids (List): Parent msgids.
+
+        Return:
+            List: Msgids of replies in arrival order.
+        """
+        pass
+
+    def get_thread(self, msgid: str) -> List[str]:
+        """
+        Get msgids of whole thread containing message.
+
+        Args:
+            msgid (str): Msgid of any message of thread.
+
+        Return:
+            List: Msgids of thread. Root message first, then replies
+                  level by level.
+        """
+        root, seen = msgid, {msgid}
+        parent = self.get_parent(root)
+        while parent and parent not in seen:
+            seen.add(parent)
+            root = parent
+            parent = self.get_parent(root)
+        thread, level, seen = [root], [root], {root}
+        while level:
+            level = [child for child in self.get_children(level)
+                     if child not in seen]
+            seen.update(level)
+            thread += level
+        return thread
+
+    def get_sync_cursors(self, uplink: str) -> Dict[str, str]:
+        """
+        Sync cursors of uplink. Cursor is last remote msgid of echoarea
+        which messages before it are saved or pending.
+
+        Args:
+            uplink (str): Uplink URL.
+
+        Return:
+            Dict: Cursors {"echoarea": "msgid"}.
+        """
+        pass
+
+    def set_sync_cursor(self, uplink: str, echoarea: str, msgid: str):
+        """
+        Save sync cursor of uplink echoarea.
+
+        Args:
+            uplink (str): Uplink URL.
+            echoarea (str): Echoarea name.
+            msgid (str): Last confirmed remote msgid.
+        """
+        pass
+
+    def get_sync_pending(self, uplink: str) -> Dict[str, List[str]]:
+        """
+        Msgids assigned for download from uplink but not saved yet.
+
+        Args:
+            uplink (str): Uplink URL.
+
+        Return:
+            Dict: Pending msgids of echoareas {"echoarea": List}.
+        """
+        pass
+
+    def add_sync_pending(self, uplink: str, echoarea: str,
+                         msgids: List[str]):
+        """
+        Mark msgids as pending download from uplink.
+
+        Args:
+            uplink (str): Uplink URL.
+            echoarea (str): Echoarea name.
+            msgids (List): Msgids.
+        """
+        pass
+
+    def remove_sync_pending(self, msgids: List[str]):
+        """
+        Unmark saved or rejected msgids as pending for all uplinks.
+
+        Args:
+            msgids (List): Msgids.
+        """
+        pass
+
+    def retry_sync_pending(self, uplink: str, echoareas: List[str],
+                           max_attempts: int) -> Dict[str, List[str]]:
+        """
+        Count new download attempt of msgids pending from uplink. Msgids
+        which were retried max_attempts times are unmarked, so messages
+        deleted or blacklisted on uplink are not requested forever.
+
+        Args:
+            uplink (str): Uplink URL.
+            echoareas (List): Echoareas names.
+            max_attempts (int): Maximal retries of msgid.
+
+        Return:
+            Dict: Pending msgids of echoareas {"echoarea": List}.
+        """
+        pass
+
     def search_point(self, username: str) -> bool:
         """
         Search point by username.
@@ -176,6 +482,70 @@ class Base:
         """
         pass
 
+    def prune(self, echoarea: str, max_count: int = None,
+              max_age: int = None, batch: int = 500) -> int:
+        """
+        Delete oldest messages of echoarea by retention rules.
+
+        Args:
+            echoarea (str): Echoarea name.
+            max_count (int, optional): Maximal messages count.
+            max_age (int, optional): Maximal message age in seconds.
+            batch (int, optional): Messages deleted at once.
+
+        Return:
+            int: Deleted messages count.
+        """
+        pass
+
+    def compress_messages(self, level: int) -> Dict[str, float]:
+        """
+        Compress or decompress all stored messages.
+
+        Args:
+            level (int): zlib compression level. 0 decompresses messages.
+
+        Return:
+            Dict: Statistics {"count", "before", "after",
+                  "compress_seconds", "decompress_seconds"}.
+        """
+        pass
+
+    @staticmethod
+    def compress(data: bytes, level: int) -> bytes:
+        """
+        Compress stored data.
+
+        Args:
+            data (bytes): Data.
+            level (int): zlib compression level. 0 disables compression.
+
+        Return:
+            bytes: Compressed data.
+        """
+        if level > 0:
+            return zlib.compress(data, level)
+        return data
+
+    @staticmethod
+    def decompress(data: Union[str, bytes]) -> Union[str, bytes]:
+        """
+        Decompress stored data. Not compressed data returned as is.
+
+        Args:
+            data (str or bytes): Stored data.
+
+        Return:
+            str or bytes: Data.
+        """
+        if isinstance(data, bytes) and len(data) > 1 and data[0] == 0x78 \
+                and (data[0] * 256 + data[1]) % 31 == 0:
+            try:
+                return zlib.decompress(data)
+            except zlib.error:
+                pass
+        return data
+
     @staticmethod
     def generate_authstr(username: str) -> str:
         """
@@ -207,6 +577,23 @@ class Base:
         hsh = urlsafe_b64encode(sha256(message.encode()).digest())
         return hsh.decode("utf-8")[:20].replace("-", "A").replace("_", "z")
 
+    @staticmethod
+    def get_repto(tags: str) -> str:
+        """
+        Get msgid of replied message from tags.
+
+        Args:
+            tags (str): Message tags "ii/ok/repto/<msgid>".
+
+        Return:
+            str: Replied msgid or None.
+        """
+        fields = tags.split("/")
+        for i in range(0, len(fields) - 1, 2):
+            if fields[i] == "repto":
+                return fields[i + 1]
+        return None
+
     @staticmethod
     def parse_point_message(encoded: str) -> Dict[str, str]:
         """
@@ -238,7 +625,7 @@ class Base:
         }
 
     @staticmethod
-    def build_message(point: Dict[str, str], encoded: str) -> tuple[str, str]:
+    def build_message(point: Dict[str, str], encoded: str) -> Message:
         """
         Build message by point information and pont's message.
 
@@ -247,21 +634,40 @@ class Base:
             encoded (str): Base64 encoded point's message.
 
         Return:
-            str: Echoarea name.
-            str: Ready message.
+            Message: Ready message.
         """
         parsed_message = Base.parse_point_message(encoded)
-        date = str(int(time()))
-        msg = "{}\n".format(parsed_message["tags"])
-        msg = msg + "{}\n".format(parsed_message["echoarea"])
-        msg = msg + "{}\n".format(date)
-        msg = msg + "{}\n".format(parsed_message["echoarea"])
-        msg = msg + "{}\n".format(point["name"])
-        msg = msg + "{}\n".format(point["address"])
-        msg = msg + "{}\n".format(parsed_message["msgto"])
-        msg = msg + "{}\n\n".format(parsed_message["subject"])
-        msg = msg + "{}\n".format(parsed_message["body"])
-        return parsed_message["echoarea"], msg
+        return Message.build(parsed_message["tags"],
+                             parsed_message["echoarea"],
+                             str(int(time())),
+                             point["name"],
+                             point["address"],
+                             parsed_message["msgto"],
+                             parsed_message["subject"],
+                             parsed_message["body"] + "\n")
+
+    @staticmethod
+    def parse_bundle(bundle: str) -> Iterator[Message]:
+        """
+        Parse bundle line by line without splitting it to list.
+
+        Args:
+            bundle (str): Bundle in "msgid:base64" format.
+
+        Return:
+            Iterator: Messages.
+        """
+        start = 0
+        length = len(bundle)
+        while start < length:
+            end = bundle.find("\n", start)
+            if end < 0:
+                end = length
+            line = bundle[start:end].strip()
+            start = end + 1
+            if ":" in line:
+                msgid, encoded = line.split(":", 1)
+                yield Message(msgid=msgid, encoded=encoded)
 
     @staticmethod
     def toss_message(save_message: Callable, point: Dict[str, str],
@@ -277,10 +683,9 @@ class Base:
         Return:
             str: Response text.
         """
-        echoarea, message = Base.build_message(point, encoded)
-        if getsizeof(message) <= 65535:
-            h = Base.build_hash(message)
-            save_message(echoarea, h, message)
-            return "msg ok:" + h
+        message = Base.build_message(point, encoded)
+        if getsizeof(message.raw) <= 65535:
+            save_message(message.echoarea, message.msgid, message)
+            return "msg ok:" + message.msgid
         else:
             return "error: msg big!"
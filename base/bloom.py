@@ -0,0 +1,72 @@
+"""
+Bloom filter of known msgids.
+"""
+
+from hashlib import blake2b
+from math import ceil, log
+from typing import Iterable
+
+
+class BloomFilter:
+    """
+    Probabilistic set of msgids. Answers "definitely not added" without
+    false negatives and "maybe added" with configured false positive rate.
+
+    Args:
+        capacity (int): Expected msgids count.
+        error_rate (float, optional): False positive rate at capacity.
+        max_memory (int, optional): Maximal size of bit array in bytes.
+    """
+    def __init__(self, capacity: int, error_rate: float = 0.001,
+                 max_memory: int = None):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.max_memory = max_memory
+        size = ceil(-self.capacity * log(error_rate) / log(2) ** 2)
+        if max_memory:
+            size = min(size, max_memory * 8)
+        self.size = max(8, size)
+        self.hashes = max(1, round(self.size / self.capacity * log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, msgid: str) -> Iterable[int]:
+        """
+        Bit positions of msgid.
+
+        Args:
+            msgid (str): Msgid.
+
+        Return:
+            Iterable: Bit numbers.
+        """
+        digest = blake2b(msgid.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, msgid: str):
+        """
+        Add msgid to filter.
+
+        Args:
+            msgid (str): Msgid.
+        """
+        for position in self.positions(msgid):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, msgid: str) -> bool:
+        for position in self.positions(msgid):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def is_full(self) -> bool:
+        """
+        Check filter holds more msgids than its capacity.
+
+        Return:
+            bool: True if filter should be rebuilt with larger capacity.
+        """
+        return self.count > self.capacity
@@ -0,0 +1,201 @@
+"""
+Order-independent digests of echoareas indexes.
+"""
+
+from base.base import Base
+from hashlib import blake2b
+from threading import RLock
+from time import time
+from typing import Dict, List, Set, Tuple
+
+# Length of msgid prefixes of leaf buckets. Msgids are base64 of sha256,
+# so they are spread uniformly over 62 ** DEPTH buckets.
+DEPTH = 2
+# Buckets with this many messages or less are compared by msgids.
+LEAF_SIZE = 64
+# Maximal count of prefixes in one x/d/ request.
+MAX_PREFIXES = 256
+
+
+def msgid_digest(msgid: str) -> int:
+    """
+    64-bit digest of msgid.
+
+    Args:
+        msgid (str): Msgid.
+
+    Return:
+        int: Digest.
+    """
+    return int.from_bytes(blake2b(msgid.encode("utf-8"),
+                                  digest_size=8).digest(), "little")
+
+
+class DigestIndex:
+    """
+    Keeps digest of every echoarea as XOR of its msgids digests, grouped
+    in tree of buckets by msgid prefix. Digests do not depend on order
+    of messages, so nodes with same messages have same digests, and
+    diverged buckets are found by descending the tree from the root.
+    Msgids of every leaf bucket are kept packed in one buffer, so msgids
+    of requested buckets are served without reading base index and
+    without object per msgid. Methods are thread-safe.
+
+    Args:
+        base (Base): Messages base.
+        ttl (float, optional): Seconds between checks of base counts.
+    """
+    def __init__(self, base: Base, ttl: float = 1.0):
+        self.base = base
+        self.ttl = ttl
+        self.leaves = {}
+        self.buckets = {}
+        self.digests = {}
+        self.marks = {}
+        self.counts = {}
+        self.synced = {}
+        self.lock = RLock()
+
+    def load(self, echoarea: str):
+        """
+        Build echoarea digests from base.
+
+        Args:
+            echoarea (str): Echoarea name.
+        """
+        self.leaves[echoarea] = {}
+        self.buckets[echoarea] = {}
+        self.digests[echoarea] = {}
+        self.counts[echoarea] = 0
+        self.marks[echoarea] = "0"
+        self.add(echoarea, self.base.get_index([echoarea]))
+
+    def add(self, echoarea: str, msgids: List[str]):
+        """
+        Add new msgids to echoarea digests.
+
+        Args:
+            echoarea (str): Echoarea name.
+            msgids (List): Msgids missing in digests.
+        """
+        leaves = self.leaves[echoarea]
+        buckets = self.buckets[echoarea]
+        digests = self.digests[echoarea]
+        for msgid in msgids:
+            prefix = msgid[:DEPTH]
+            leaves[prefix] = leaves.get(prefix, 0) + 1
+            buckets.setdefault(prefix, bytearray()).extend(
+                msgid.encode("utf-8") + b"\n")
+            digests[prefix] = digests.get(prefix, 0) ^ msgid_digest(msgid)
+        self.counts[echoarea] += len(msgids)
+        if msgids:
+            self.marks[echoarea] = msgids[-1]
+
+    def sync(self, echoarea: str):
+        """
+        Add messages saved to base after last sync. Digests are rebuilt
+        if messages were deleted from base.
+
+        Args:
+            echoarea (str): Echoarea name.
+        """
+        now = time()
+        with self.lock:
+            if echoarea in self.leaves and \
+                    now - self.synced.get(echoarea, 0) < self.ttl:
+                return
+            self.synced[echoarea] = now
+            if echoarea not in self.leaves:
+                self.load(echoarea)
+                return
+            count = self.base.get_counts([echoarea])[echoarea]
+            if count == self.counts[echoarea]:
+                return
+            mark = self.marks[echoarea]
+            msgids = self.base.get_index_since({echoarea: mark})[echoarea]
+            if mark != "0" and self.counts[echoarea] + len(msgids) != count:
+                self.load(echoarea)
+            else:
+                self.add(echoarea, msgids)
+
+    def get(self, echoarea: str, prefix: str = "") -> Tuple[int, int]:
+        """
+        Count and digest of echoarea messages with msgid prefix.
+
+        Args:
+            echoarea (str): Echoarea name.
+            prefix (str, optional): Msgid prefix not longer than DEPTH.
+
+        Return:
+            Tuple: Messages count and digest.
+        """
+        with self.lock:
+            self.sync(echoarea)
+            count, digest = 0, 0
+            for leaf, leaf_count in self.leaves[echoarea].items():
+                if leaf.startswith(prefix):
+                    count += leaf_count
+                    digest ^= self.digests[echoarea][leaf]
+            return count, digest
+
+    def children(self, echoarea: str,
+                 prefixes: List[str]) -> Dict[str, Tuple[int, int]]:
+        """
+        Counts and digests of child buckets of prefixes.
+
+        Args:
+            echoarea (str): Echoarea name.
+            prefixes (List): Msgid prefixes shorter than DEPTH.
+
+        Return:
+            Dict: Non-empty buckets {"prefix": (count, digest)}.
+        """
+        with self.lock:
+            self.sync(echoarea)
+            children = {}
+            for prefix in prefixes:
+                for leaf, leaf_count in self.leaves[echoarea].items():
+                    if leaf.startswith(prefix) and leaf_count:
+                        child = leaf[:len(prefix) + 1]
+                        count, digest = children.get(child, (0, 0))
+                        children[child] = (count + leaf_count, digest ^
+                                           self.digests[echoarea][leaf])
+            return children
+
+    def msgids(self, echoarea: str, prefixes: List[str]) -> Set[str]:
+        """
+        Msgids of echoarea with any of prefixes. Only leaf buckets of
+        prefixes are unpacked.
+
+        Args:
+            echoarea (str): Echoarea name.
+            prefixes (List): Msgid prefixes.
+
+        Return:
+            Set: Msgids.
+        """
+        prefixes = tuple(prefixes)
+        leaves = tuple(prefix[:DEPTH] for prefix in prefixes)
+        with self.lock:
+            self.sync(echoarea)
+            msgids = set()
+            for leaf, bucket in self.buckets[echoarea].items():
+                if leaf.startswith(leaves):
+                    msgids.update(msgid for msgid in
+                                  bucket.decode("utf-8").split()
+                                  if msgid.startswith(prefixes))
+            return msgids
+
+    @staticmethod
+    def format(count: int, digest: int) -> str:
+        """
+        Format count and digest for protocol responses.
+
+        Args:
+            count (int): Messages count.
+            digest (int): Digest.
+
+        Return:
+            str: "count:digest" with hex digest.
+        """
+        return "{}:{:016x}".format(count, digest)
@@ -0,0 +1,176 @@
+"""
+Fileechoareas storage.
+"""
+
+from base64 import urlsafe_b64encode
+from hashlib import sha256
+from os import makedirs, path, remove, replace, stat
+from threading import Lock
+from typing import BinaryIO, Dict, List
+import re
+
+CHUNK = 1024 * 1024
+
+
+class FileEchoes:
+    """
+    Files of fileechoareas stored as <path>/<fecho>/<fid> with index
+    <path>/<fecho>.txt of "fid:filename:size:address:description" lines.
+    Indexes are cached in memory until their files are changed.
+
+    Args:
+        path (str): Fileechoareas directory.
+    """
+    def __init__(self, path: str):
+        if path.endswith("/"):
+            self.path = path
+        else:
+            self.path = path + "/"
+        makedirs(self.path, exist_ok=True)
+        self.cache = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def is_name(name: str) -> bool:
+        """
+        Check fileechoarea name or fid is safe to use as filename.
+
+        Args:
+            name (str): Fileechoarea name or fid.
+
+        Return:
+            bool: True if name is correct.
+        """
+        return bool(re.fullmatch(r"[\w.-]+", name)) and \
+            not name.startswith(".")
+
+    def read_lines(self, filename: str) -> List[str]:
+        """
+        Read lines of index file using cache.
+
+        Args:
+            filename (str): Index filename.
+
+        Return:
+            List: Non-empty lines.
+        """
+        try:
+            info = stat(filename)
+        except OSError:
+            return []
+        version = (info.st_mtime_ns, info.st_size)
+        cached = self.cache.get(filename)
+        if cached and cached[0] == version:
+            return cached[1]
+        with open(filename, encoding="utf-8") as f:
+            lines = [line for line in f.read().split("\n") if line]
+        self.cache[filename] = (version, lines)
+        return lines
+
+    def get_index(self, fecho: str) -> List[str]:
+        """
+        Index of fileechoarea.
+
+        Args:
+            fecho (str): Fileechoarea name.
+
+        Return:
+            List: "fid:filename:size:address:description" lines.
+        """
+        if not self.is_name(fecho):
+            return []
+        return self.read_lines(self.path + fecho + ".txt")
+
+    def get_counts(self, fechoes: List[str]) -> Dict[str, int]:
+        """
+        Count files of fileechoareas.
+
+        Args:
+            fechoes (List): Fileechoareas names.
+
+        Return:
+            Dict: Counts {"name": int}.
+        """
+        return {fecho: len(self.get_index(fecho)) for fecho in fechoes}
+
+    def get_blacklist(self) -> List[str]:
+        """
+        Blacklisted fids.
+
+        Return:
+            List: Fids.
+        """
+        return self.read_lines(self.path + "blacklist.txt")
+
+    def get_file(self, fecho: str, fid: str) -> Dict[str, str]:
+        """
+        Find file of fileechoarea.
+
+        Args:
+            fecho (str): Fileechoarea name.
+            fid (str): File id.
+
+        Return:
+            Dict: File {"fid", "filename", "root"} or None if not found.
+        """
+        if not self.is_name(fid) or fid in self.get_blacklist():
+            return None
+        for line in self.get_index(fecho):
+            fields = line.split(":", 4)
+            if fields[0] == fid:
+                return {"fid": fid, "filename": fields[1],
+                        "root": self.path + fecho}
+        return None
+
+    def add_file(self, fecho: str, stream: BinaryIO, filename: str,
+                 address: str, description: str,
+                 max_size: int = None) -> str:
+        """
+        Save file to fileechoarea. File is copied from stream to disk by
+        chunks, so it is never kept in memory.
+
+        Args:
+            fecho (str): Fileechoarea name.
+            stream (BinaryIO): File contents.
+            filename (str): Original filename.
+            address (str): Address of sender.
+            description (str): Short description.
+            max_size (int, optional): Maximal file size in bytes.
+
+        Return:
+            str: Fid or empty string if file is too big.
+        """
+        directory = self.path + fecho + "/"
+        makedirs(directory, exist_ok=True)
+        hsh = sha256()
+        size = 0
+        part = "{}upload-{}.part".format(directory, id(stream))
+        with open(part, "wb") as f:
+            while True:
+                chunk = stream.read(CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    break
+                hsh.update(chunk)
+                f.write(chunk)
+        if max_size is not None and size > max_size:
+            remove(part)
+            return ""
+        fid = urlsafe_b64encode(hsh.digest()).decode("utf-8")[:20]
+        fid = fid.replace("-", "A").replace("_", "z")
+        filename = "_".join(path.basename(filename).replace(":",
+                                                            "_").split())
+        filename = filename or fid
+        description = " ".join(description.split())
+        with self.lock:
+            if path.exists(directory + fid):
+                remove(part)
+                return fid
+            replace(part, directory + fid)
+            with open(self.path + fecho + ".txt", "a",
+                      encoding="utf-8") as f:
+                f.write("{}:{}:{}:{}:{}\n".format(fid, filename, size,
+                                                  address, description))
+        return fid
@@ -0,0 +1,243 @@
+"""
+In-memory echoareas index with packed msgids.
+"""
+
+from base.base import Base
+from os import path, mkdir, replace
+from threading import RLock
+from time import time
+from typing import Dict, List
+
+RECORD = 21
+
+
+class MemoryIndex:
+    """
+    Keeps index of every echoarea as one contiguous buffer of
+    "msgid\\n" records. Slices of buffer are ready index responses, so
+    index requests are served without creating object per msgid.
+    Methods are thread-safe.
+
+    Args:
+        base (Base): Messages base.
+        echoareas (List): Echoareas names.
+        snapshot (str, optional): Snapshot directory for fast start.
+        ttl (float, optional): Seconds between checks of base counts.
+    """
+    def __init__(self, base: Base, echoareas: List[str],
+                 snapshot: str = None, ttl: float = 1.0):
+        self.base = base
+        self.snapshot = snapshot
+        self.ttl = ttl
+        self.buffers = {}
+        self.synced = {}
+        self.lock = RLock()
+        for echoarea in echoareas:
+            self.load(echoarea)
+
+    def load(self, echoarea: str, snapshot: bool = True):
+        """
+        Load echoarea index from snapshot and base.
+
+        Args:
+            echoarea (str): Echoarea name.
+            snapshot (bool, optional): Use snapshot if it exists.
+        """
+        with self.lock:
+            self.load_buffer(echoarea, snapshot)
+
+    def load_buffer(self, echoarea: str, snapshot: bool):
+        """
+        Load echoarea index from snapshot and base. Must be called under
+        lock.
+
+        Args:
+            echoarea (str): Echoarea name.
+            snapshot (bool): Use snapshot if it exists.
+        """
+        self.buffers[echoarea] = bytearray()
+        filename = self.snapshot_filename(echoarea)
+        if snapshot and filename and path.exists(filename):
+            with open(filename, "rb") as f:
+                buffer = bytearray(f.read())
+            if self.is_valid(echoarea, buffer):
+                self.buffers[echoarea] = buffer
+        if not self.sync(echoarea, True):
+            self.buffers[echoarea] = bytearray()
+            self.sync(echoarea, True)
+
+    def is_valid(self, echoarea: str, buffer: bytearray) -> bool:
+        """
+        Check snapshot buffer is a prefix of echoarea index in base. First
+        msgid must exist and messages after last msgid must complete
+        buffer to base count, so replaced messages are detected even if
+        count is the same.
+
+        Args:
+            echoarea (str): Echoarea name.
+            buffer (bytearray): Snapshot buffer.
+
+        Return:
+            bool: True if buffer can be used.
+        """
+        if len(buffer) % RECORD != 0:
+            return False
+        if not buffer:
+            return True
+        first = buffer[:RECORD - 1].decode("utf-8")
+        last = buffer[-RECORD:-1].decode("utf-8")
+        if not self.base.is_message_exists(first):
+            return False
+        count = self.base.get_counts([echoarea])[echoarea]
+        since = self.base.get_index_since({echoarea: last})[echoarea]
+        return len(buffer) // RECORD + len(since) == count
+
+    def sync(self, echoarea: str, force: bool = False) -> bool:
+        """
+        Append messages saved to base after last sync.
+
+        Args:
+            echoarea (str): Echoarea name.
+            force (bool, optional): Sync even if ttl is not expired.
+
+        Return:
+            bool: False if index diverged from base and must be rebuilt.
+        """
+        with self.lock:
+            return self.sync_buffer(echoarea, force)
+
+    def sync_buffer(self, echoarea: str, force: bool) -> bool:
+        """
+        Append messages saved to base after last sync. Must be called
+        under lock.
+
+        Args:
+            echoarea (str): Echoarea name.
+            force (bool): Sync even if ttl is not expired.
+
+        Return:
+            bool: False if index diverged from base and must be rebuilt.
+        """
+        now = time()
+        if not force and now - self.synced.get(echoarea, 0) < self.ttl:
+            return True
+        self.synced[echoarea] = now
+        buffer = self.buffers.get(echoarea)
+        if buffer is None:
+            return True
+        count = self.base.get_counts([echoarea])[echoarea]
+        if count == len(buffer) // RECORD:
+            return True
+        if buffer:
+            mark = buffer[-RECORD:-1].decode("utf-8")
+        else:
+            mark = "0"
+        msgids = self.base.get_index_since({echoarea: mark})[echoarea]
+        if buffer and len(buffer) // RECORD + len(msgids) != count:
+            if force:
+                return False
+            self.load(echoarea, False)
+            return True
+        for msgid in msgids:
+            if len(msgid) != RECORD - 1:
+                del self.buffers[echoarea]
+                return True
+            buffer += msgid.encode("utf-8") + b"\n"
+        return True
+
+    def count(self, echoarea: str) -> int:
+        """
+        Count messages of echoarea.
+
+        Args:
+            echoarea (str): Echoarea name.
+
+        Return:
+            int: Messages count or None if echoarea is not indexed.
+        """
+        with self.lock:
+            if echoarea not in self.buffers:
+                return None
+            self.sync_buffer(echoarea, False)
+            if echoarea not in self.buffers:
+                return None
+            return len(self.buffers[echoarea]) // RECORD
+
+    def index(self, echoarea: str, start: int = 0,
+              end: int = None) -> bytes:
+        """
+        Get slice of echoarea index.
+
+        Args:
+            echoarea (str): Echoarea name.
+            start (int, optional): First msgid position.
+            end (int, optional): Position after last msgid.
+
+        Return:
+            bytes: "msgid\\n" records or None if echoarea is not indexed.
+        """
+        with self.lock:
+            if echoarea not in self.buffers:
+                return None
+            self.sync_buffer(echoarea, False)
+            buffer = self.buffers.get(echoarea)
+            if buffer is None:
+                return None
+            if end is None:
+                end = len(buffer) // RECORD
+            with memoryview(buffer) as view:
+                return view[start * RECORD:max(start, end) * RECORD].tobytes()
+
+    def snapshot_filename(self, echoarea: str) -> str:
+        """
+        Snapshot filename of echoarea.
+
+        Args:
+            echoarea (str): Echoarea name.
+
+        Return:
+            str: Filename or None if snapshots are disabled.
+        """
+        if not self.snapshot:
+            return None
+        return path.join(self.snapshot, echoarea)
+
+    def save(self):
+        """
+        Save snapshot of all echoareas indexes.
+        """
+        if not self.snapshot:
+            return
+        if not path.exists(self.snapshot):
+            mkdir(self.snapshot)
+        with self.lock:
+            buffers = {echoarea: bytes(buffer)
+                       for echoarea, buffer in self.buffers.items()}
+        for echoarea, buffer in buffers.items():
+            filename = self.snapshot_filename(echoarea)
+            with open(filename + ".tmp", "wb") as f:
+                f.write(buffer)
+            replace(filename + ".tmp", filename)
+
+    def get_counts(self, echoareas: List[str]) -> Dict[str, int]:
+        """
+        Counts the number of messages in a echoareas. Not indexed
+        echoareas are counted by base.
+
+        Args:
+            echoareas (List): Echoareas names.
+
+        Return:
+            Dict: Dict of echoareas counts (str) {"name": int}.
+        """
+        counts = {}
+        missing = []
+        for echoarea in echoareas:
+            count = self.count(echoarea)
+            if count is None:
+                missing.append(echoarea)
+            else:
+                counts[echoarea] = count
+        if missing:
+            counts.update(self.base.get_counts(missing))
+        return counts
@@ -0,0 +1,159 @@
+"""
+IDEC message.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error
+from hashlib import sha256
+from typing import List
+
+FIELDS = ("tags", "echoarea", "date", "msgfrom", "address", "msgto",
+          "subject")
+
+
+class Message:
+    """
+    Message with lazy parsing. Plain text, utf-8 bytes, base64 form and
+    header fields are computed on first access and cached, so message
+    text is decoded and splitted only once.
+
+    Args:
+        raw (str, optional): Message as plain text.
+        msgid (str, optional): Msgid. Built from message if not set.
+        encoded (str, optional): Urlsafe base64 encoded message.
+        data (bytes, optional): Message as utf-8 bytes.
+    """
+    __slots__ = ("_raw", "_bytes", "_encoded", "_msgid", "_fields")
+
+    def __init__(self, raw: str = None, msgid: str = None,
+                 encoded: str = None, data: bytes = None):
+        self._raw = raw
+        self._bytes = data
+        self._encoded = encoded
+        self._msgid = msgid
+        self._fields = None
+
+    @classmethod
+    def build(cls, tags: str, echoarea: str, date: str, msgfrom: str,
+              address: str, msgto: str, subject: str,
+              body: str) -> "Message":
+        """
+        Build message by fields.
+
+        Return:
+            Message: New message.
+        """
+        message = cls("\n".join((tags, echoarea, date, msgfrom, address,
+                                 msgto, subject, "", body)))
+        message._fields = [tags, echoarea, date, msgfrom, address, msgto,
+                           subject, "", body]
+        return message
+
+    @property
+    def raw(self) -> str:
+        """
+        Message as plain text.
+        """
+        if self._raw is None:
+            self._raw = self.data.decode("utf-8")
+        return self._raw
+
+    @property
+    def data(self) -> bytes:
+        """
+        Message as utf-8 bytes.
+        """
+        if self._bytes is None:
+            if self._raw is not None:
+                self._bytes = self._raw.encode("utf-8")
+            else:
+                self._bytes = urlsafe_b64decode(self._encoded)
+        return self._bytes
+
+    @property
+    def encoded(self) -> str:
+        """
+        Message as urlsafe base64 string.
+        """
+        if self._encoded is None:
+            self._encoded = urlsafe_b64encode(self.data).decode("utf-8")
+        return self._encoded
+
+    @property
+    def msgid(self) -> str:
+        """
+        Msgid of message.
+        """
+        if self._msgid is None:
+            self._msgid = self.build_msgid()
+        return self._msgid
+
+    def build_msgid(self) -> str:
+        """
+        Build msgid by message.
+
+        Return:
+            str: Msgid.
+        """
+        hsh = urlsafe_b64encode(sha256(self.data).digest())
+        return hsh.decode("utf-8")[:20].replace("-", "A").replace("_", "z")
+
+    @property
+    def fields(self) -> List[str]:
+        """
+        Header lines, empty line and body of message.
+        """
+        if self._fields is None:
+            fields = self.raw.split("\n", 8)
+            if len(fields) < 9:
+                fields += [""] * (9 - len(fields))
+            self._fields = fields
+        return self._fields
+
+    @property
+    def tags(self) -> str:
+        return self.fields[0]
+
+    @property
+    def echoarea(self) -> str:
+        return self.fields[1]
+
+    @property
+    def date(self) -> str:
+        return self.fields[2]
+
+    @property
+    def msgfrom(self) -> str:
+        return self.fields[3]
+
+    @property
+    def address(self) -> str:
+        return self.fields[4]
+
+    @property
+    def msgto(self) -> str:
+        return self.fields[5]
+
+    @property
+    def subject(self) -> str:
+        return self.fields[6]
+
+    @property
+    def body(self) -> str:
+        return self.fields[8]
+
+    def verify(self) -> bool:
+        """
+        Check message can be decoded and msgid matches message.
+
+        Return:
+            bool: True if message is correct.
+        """
+        try:
+            self.raw
+        except (Error, ValueError, UnicodeDecodeError):
+            return False
+        return self._msgid is None or self.build_msgid() == self._msgid
+
+    def __len__(self) -> int:
+        return len(self.data)
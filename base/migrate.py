@@ -0,0 +1,85 @@
+"""
+Migration of messages between bases.
+"""
+
+from base.base import Base
+from os import path, remove, replace
+from time import time
+from typing import Callable, Dict
+import json
+
+
+def load_checkpoint(filename: str) -> Dict[str, int]:
+    """
+    Load migration checkpoint.
+
+    Args:
+        filename (str): Checkpoint filename.
+
+    Return:
+        Dict: Migrated messages count of echoareas {"name": int}.
+    """
+    if filename and path.exists(filename):
+        with open(filename) as f:
+            return json.loads(f.read())
+    return {}
+
+
+def save_checkpoint(filename: str, checkpoint: Dict[str, int]):
+    """
+    Atomically save migration checkpoint.
+
+    Args:
+        filename (str): Checkpoint filename.
+        checkpoint (Dict): Migrated messages count of echoareas.
+    """
+    if not filename:
+        return
+    with open(filename + ".tmp", "w") as f:
+        f.write(json.dumps(checkpoint))
+    replace(filename + ".tmp", filename)
+
+
+def migrate(source: Base, target: Base, checkpoint: str = None,
+            batch: int = 1000,
+            progress: Callable[[str, int, int, float], None] = None) -> int:
+    """
+    Copy all echoareas from source base to target base. Messages are read
+    and written by batches in echoareas index order. Position of every
+    echoarea is saved to checkpoint file after each batch, so interrupted
+    migration continues from the last saved batch.
+
+    Args:
+        source (Base): Source base.
+        target (Base): Target base.
+        checkpoint (str, optional): Checkpoint filename.
+        batch (int, optional): Messages count of one batch.
+        progress (Callable, optional): Called after each batch with
+                                       echoarea name, migrated and total
+                                       messages count of echoarea and
+                                       messages per second.
+
+    Return:
+        int: Saved messages count.
+    """
+    done = load_checkpoint(checkpoint)
+    saved = 0
+    copied = 0
+    started = time()
+    for echoarea in source.get_echoareas():
+        index = source.get_index([echoarea])
+        position = done.get(echoarea, 0)
+        while position < len(index):
+            block = index[position:position + batch]
+            saved += target.save_messages(source.get_bundle(block))
+            position += len(block)
+            copied += len(block)
+            done[echoarea] = position
+            save_checkpoint(checkpoint, done)
+            if progress:
+                progress(echoarea, position, len(index),
+                         copied / max(time() - started, 0.001))
+    target.set_blacklisted(source.get_blacklist())
+    if checkpoint and path.exists(checkpoint):
+        remove(checkpoint)
+    return saved
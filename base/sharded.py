@@ -0,0 +1,780 @@
+"""
+Message base sharded by echoareas into sqlite3 databases.
+"""
+
+from base.base import Base
+from base.message import Message
+from base.sqlite import Sqlite
+from concurrent.futures import ThreadPoolExecutor
+from os import listdir, makedirs, path, replace, stat
+from threading import Lock
+from typing import Callable, Dict, Iterator, List, Union
+from zlib import crc32
+import re
+import sqlite3
+
+
+class Sharded(Base):
+    """
+    Messages base where every echoarea (or hash bucket of echoareas) is
+    stored in own sqlite3 database, so writes to different echoareas do
+    not contend for one lock. Catalog database keeps points, files and
+    global msgid to echoarea map.
+
+    Args:
+        path (str): Base directory.
+        store_encoded (bool, optional): Also keep base64 form of messages
+                                        for serving bundles. Ignored when
+                                        compression is enabled.
+        compression (int, optional): zlib compression level of stored
+                                     messages. 0 disables compression.
+        buckets (int, optional): Count of shard files echoareas are
+                                 hashed to. 0 gives own file to every
+                                 echoarea.
+        bloom (Dict, optional): Bloom filter options of msgids.
+        workers (int, optional): Threads count for fan-out queries.
+    """
+    def __init__(self, path: str, store_encoded: bool = False,
+                 compression: int = 0, buckets: int = 0,
+                 bloom: Dict[str, float] = None, workers: int = 8):
+        super().__init__(path)
+        if path.endswith("/"):
+            self.path = path
+        else:
+            self.path = path + "/"
+        self.store_encoded = store_encoded
+        self.compression = compression
+        self.buckets = buckets
+        self.shards = {}
+        self.inodes = {}
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(workers)
+        self.check_base()
+        self.catalog = Sqlite(self.path + "catalog.db")
+        self.load_bloom(bloom)
+
+    def __connect(self):
+        """
+        Connect to catalog database.
+        """
+        connection = sqlite3.connect(self.path + "catalog.db")
+        cursor = connection.cursor()
+        return connection, cursor
+
+    def check_base(self):
+        """
+        Checks base and create this if not exists.
+        """
+        makedirs(self.path + "shards", exist_ok=True)
+        connection, cursor = self.__connect()
+        sql = """CREATE TABLE IF NOT EXISTS shard_map(
+            msgid TEXT PRIMARY KEY,
+            echoarea TEXT) WITHOUT ROWID;"""
+        cursor.execute(sql)
+        connection.commit()
+        connection.close()
+
+    def shard_filename(self, echoarea: str) -> str:
+        """
+        Database filename of echoarea shard.
+
+        Args:
+            echoarea (str): Echoarea name.
+
+        Return:
+            str: Filename.
+        """
+        if self.buckets:
+            name = "bucket-{}".format(crc32(echoarea.encode("utf-8")) %
+                                      self.buckets)
+        elif re.fullmatch(r"[\w.-]+", echoarea) and \
+                not echoarea.startswith("."):
+            name = echoarea
+        else:
+            name = "echo-{:08x}".format(crc32(echoarea.encode("utf-8")))
+        return self.path + "shards/" + name + ".db"
+
+    def get_shard(self, echoarea: str, create: bool = False) -> Sqlite:
+        """
+        Get shard of echoarea.
+
+        Args:
+            echoarea (str): Echoarea name.
+            create (bool, optional): Create shard if not exists.
+
+        Return:
+            Sqlite: Shard base or None if shard not exists.
+        """
+        return self.open_shard(self.shard_filename(echoarea), create)
+
+    def open_shard(self, filename: str, create: bool = False) -> Sqlite:
+        """
+        Get cached shard by filename. Shard file archived or replaced by
+        other process since caching is checked again, so sqlite does not
+        recreate it as empty database without tables.
+
+        Args:
+            filename (str): Shard filename.
+            create (bool, optional): Create shard if not exists.
+
+        Return:
+            Sqlite: Shard base or None if shard not exists.
+        """
+        with self.lock:
+            try:
+                inode = stat(filename).st_ino
+            except FileNotFoundError:
+                inode = None
+            if filename in self.shards and \
+                    self.inodes[filename] == inode:
+                return self.shards[filename]
+            self.shards.pop(filename, None)
+            self.inodes.pop(filename, None)
+            if inode is None and not create:
+                return None
+            shard = Sqlite(filename, self.store_encoded, self.compression)
+            self.shards[filename] = shard
+            self.inodes[filename] = stat(filename).st_ino
+            return shard
+
+    def all_shards(self) -> List[Sqlite]:
+        """
+        All existing shards.
+
+        Return:
+            List: Shard bases.
+        """
+        shards = []
+        for filename in sorted(listdir(self.path + "shards")):
+            if filename.endswith(".db"):
+                shard = self.open_shard(self.path + "shards/" + filename)
+                if shard:
+                    shards.append(shard)
+        return shards
+
+    def fan_out(self, function: Callable, items: List) -> List:
+        """
+        Call function for every item on thread pool.
+
+        Args:
+            function (Callable): Function of one argument.
+            items (List): Arguments.
+
+        Return:
+            List: Results in items order.
+        """
+        if len(items) < 2:
+            return [function(item) for item in items]
+        return list(self.executor.map(function, items))
+
+    def group_echoareas(self, echoareas: List[str]) -> Dict[Sqlite,
+                                                          List[str]]:
+        """
+        Group existing echoareas by shards.
+
+        Args:
+            echoareas (List): Echoareas names.
+
+        Return:
+            Dict: Echoareas of shards {Sqlite: List}.
+        """
+        groups = {}
+        for echoarea in echoareas:
+            shard = self.get_shard(echoarea)
+            if shard:
+                groups.setdefault(shard, []).append(echoarea)
+        return groups
+
+    def locate(self, msgids: List[str]) -> Dict[str, str]:
+        """
+        Find echoareas of messages by global map.
+
+        Args:
+            msgids (List): Msgids.
+
+        Return:
+            Dict: Echoareas of found messages {"msgid": "echoarea"}.
+        """
+        located = {}
+        connection, cursor = self.__connect()
+        for i in range(0, len(msgids), 500):
+            block = msgids[i:i + 500]
+            sql = "SELECT msgid, echoarea FROM shard_map " + \
+                  "WHERE msgid IN ({});".format(", ".join("?" * len(block)))
+            located.update(cursor.execute(sql, block).fetchall())
+        connection.close()
+        return located
+
+    def get_blacklist(self) -> List[str]:
+        """
+        Return blacklisted msgids.
+
+        Return:
+            List: List of blacklisted msgids.
+        """
+        blacklist = []
+        for msgids in self.fan_out(lambda shard: shard.get_blacklist(),
+                                   self.all_shards()):
+            blacklist += msgids
+        return blacklist
+
+    def set_blacklisted(self, msgids: List[str]):
+        """
+        Add msgids to blacklist.
+
+        Args:
+            msgids (List): Msgids.
+        """
+        groups = {}
+        for msgid, echoarea in self.locate(msgids).items():
+            shard = self.get_shard(echoarea)
+            if shard:
+                groups.setdefault(shard, []).append(msgid)
+        self.fan_out(lambda x: x[0].set_blacklisted(x[1]),
+                     list(groups.items()))
+
+    def get_echoareas(self) -> List[str]:
+        """
+        Names of all echoareas stored in base.
+
+        Return:
+            List: Echoareas names.
+        """
+        echoareas = []
+        for names in self.fan_out(lambda shard: shard.get_echoareas(),
+                                  self.all_shards()):
+            echoareas += [name for name in names if name not in echoareas]
+        return echoareas
+
+    def get_counts(self, echoareas: List[str]) -> Dict[str, int]:
+        """
+        Counts the number of messages in a echoarea.
+
+        Args:
+            echoareas (List): Echoareas names.
+
+        Return:
+            Dict: Dict of echoareas counts (str) {"name": int}.
+        """
+        counts = {echoarea: 0 for echoarea in echoareas}
+        groups = list(self.group_echoareas(echoareas).items())
+        for result in self.fan_out(lambda x: x[0].get_counts(x[1]), groups):
+            counts.update(result)
+        return counts
+
+    def get_index(self, echoareas: List[str]) -> List[str]:
+        """
+        Get msgids of echoareas and return they.
+
+        Args:
+            echoareas (List): Echoareas names.
+
+        Return:
+            List: Msgids.
+        """
+        def get_echoarea_index(echoarea: str) -> List[str]:
+            shard = self.get_shard(echoarea)
+            return shard.get_index([echoarea]) if shard else []
+
+        index = []
+        for msgids in self.fan_out(get_echoarea_index, echoareas):
+            index += msgids
+        return index
+
+    def get_index_since(self, marks: Dict[str, str]) -> Dict[str, List[str]]:
+        """
+        Get msgids added to echoareas after mark.
+
+        Args:
+            marks (Dict): Marks of echoareas {"name": "mark"}, where mark
+                          is msgid of echoarea message or unixtime.
+                          Whole echoarea index returned for unknown msgid.
+
+        Return:
+            Dict: Msgids of echoareas {"name": List}.
+        """
+        index = {echoarea: [] for echoarea in marks}
+        groups = list(self.group_echoareas(list(marks)).items())
+        for result in self.fan_out(lambda x: x[0].get_index_since(
+                {echoarea: marks[echoarea] for echoarea in x[1]}), groups):
+            index.update(result)
+        return index
+
+    def get_msgids(self) -> Iterator[str]:
+        """
+        Iterate msgids of all stored messages.
+
+        Return:
+            Iterator: Msgids.
+        """
+        connection, cursor = self.__connect()
+        for row in cursor.execute("SELECT msgid FROM shard_map;"):
+            yield row[0]
+        connection.close()
+
+    def is_message_exists(self, msgid: str) -> bool:
+        """
+        Check message exists in echoarea.
+
+        Args:
+            msgid (str): Msgid of message.
+
+        Return:
+             bool: True if message exists.
+        """
+        return msgid in self.locate([msgid])
+
+    def get_message(self, msgid: str) -> str:
+        """
+        Get message by msgid.
+
+        Args:
+            msgid (str): Msgid.
+
+        Return:
+            str: Message as plain text.
+        """
+        return self.get_message_data(msgid).decode("utf-8")
+
+    def get_message_data(self, msgid: str) -> bytes:
+        """
+        Get stored message bytes by msgid.
+
+        Args:
+            msgid (str): Msgid.
+
+        Return:
+            bytes: Message as utf-8 bytes.
+        """
+        echoarea = self.locate([msgid]).get(msgid)
+        shard = self.get_shard(echoarea) if echoarea else None
+        return shard.get_message_data(msgid) if shard else b""
+
+    def get_bundle(self, msgids: List[str]) -> List[Message]:
+        """
+        Get messages by msgids.
+
+        Args:
+            msgids (List): Msgids.
+
+        Return:
+            List: Existing messages in msgids order.
+        """
+        groups = {}
+        for msgid, echoarea in self.locate(msgids).items():
+            shard = self.get_shard(echoarea)
+            if shard:
+                groups.setdefault(shard, []).append(msgid)
+        messages = {}
+        for bundle in self.fan_out(lambda x: x[0].get_bundle(x[1]),
+                                   list(groups.items())):
+            for message in bundle:
+                messages[message.msgid] = message
+        return [messages[msgid] for msgid in msgids if msgid in messages]
+
+    def save_message(self, echoarea: str, msgid: str,
+                     message: Union[str, Message],
+                     other: object = None) -> bool:
+        """
+        Save message to base.
+
+        Args:
+            echoarea (str): Echoarea name.
+            msgid (str): Msgid.
+            message (str or Message): Message.
+            other (object): Additional argument.
+
+        Return:
+            bool: Save status. True if message saved else False.
+        """
+        if not isinstance(message, Message):
+            message = Message(message, msgid)
+        return self.save_messages([message]) > 0
+
+    def save_messages(self, bundle: List[Message]) -> int:
+        """
+        Save messages of bundle to base. Messages of different shards are
+        written in parallel, every shard maps its saved messages in
+        catalog by own transaction right after its write.
+
+        Args:
+            bundle (List): Bundle as List of messages.
+
+        Return:
+            int: Saved messages count.
+        """
+        self.grow_bloom()
+        maybe = [message.msgid for message in bundle
+                 if self.may_exist(message.msgid)]
+        existing = set(self.locate(maybe)) if maybe else set()
+        groups = {}
+        for message in bundle:
+            if message.msgid in existing:
+                continue
+            existing.add(message.msgid)
+            shard = self.get_shard(message.echoarea, True)
+            groups.setdefault(shard, []).append(message)
+        return sum(self.fan_out(lambda x: self.save_group(*x),
+                                list(groups.items())))
+
+    def save_group(self, shard: Sqlite, messages: List[Message]) -> int:
+        """
+        Save messages to shard and map them in catalog.
+
+        Args:
+            shard (Sqlite): Shard base.
+            messages (List): Messages of shard.
+
+        Return:
+            int: Saved messages count.
+        """
+        saved = shard.save_messages(messages)
+        connection, cursor = self.__connect()
+        sql = "INSERT OR IGNORE INTO shard_map (msgid, echoarea) " + \
+              "VALUES (?, ?);"
+        cursor.executemany(sql, [(message.msgid, message.echoarea)
+                                 for message in messages])
+        connection.commit()
+        connection.close()
+        for message in messages:
+            self.remember_msgid(message.msgid)
+        return saved
+
+    def toss_message(self, point: Dict[str, str], encoded: str) -> str:
+        """
+        Toss message from point and save that to base.
+
+        Args:
+            point (Dict): Point information as Dict:
+                          {"name", "address"}.
+            encoded (str): Point's message as plain text.
+
+        Return:
+            str: Status of tossed message:
+                 "msg ok:<msgid>" or "error: msg big!".
+        """
+        return Base.toss_message(self.save_message, point, encoded)
+
+    def search(self, query: str, echoarea: str = None, since: int = None,
+               until: int = None, limit: int = 20) -> List[Dict[str, str]]:
+        """
+        Full-text search of messages. Results of several shards are
+        interleaved, because ranks of different shards are incomparable.
+
+        Args:
+            query (str): Search words.
+            echoarea (str, optional): Echoarea name filter.
+            since (int, optional): Minimal message date (unixtime).
+            until (int, optional): Maximal message date (unixtime).
+            limit (int, optional): Maximal results count.
+
+        Return:
+            List: Found messages ordered by rank as Dict:
+                  {"msgid", "snippet"}.
+        """
+        if echoarea:
+            shard = self.get_shard(echoarea)
+            shards = [shard] if shard else []
+        else:
+            shards = self.all_shards()
+        results = self.fan_out(lambda shard: shard.search(
+            query, echoarea, since, until, limit), shards)
+        found = []
+        for i in range(limit):
+            for result in results:
+                if i < len(result):
+                    found.append(result[i])
+        return found[:limit]
+
+    def rebuild_search_index(self):
+        """
+        Rebuild full-text search index of all messages.
+        """
+        self.fan_out(lambda shard: shard.rebuild_search_index(),
+                     self.all_shards())
+
+    def rebuild_stats(self):
+        """
+        Rebuild activity rollups of all shards.
+        """
+        self.fan_out(lambda shard: shard.rebuild_stats(), self.all_shards())
+
+    def get_echoarea_stats(self, echoarea: str, days: int = 30,
+                           top: int = 10) -> Dict[str, List]:
+        """
+        Activity of echoarea from rollups of its shard.
+
+        Args:
+            echoarea (str): Echoarea name.
+            days (int, optional): Days of daily and hourly activity.
+            top (int, optional): Count of top posters and threads.
+
+        Return:
+            Dict: Activity {"daily", "hourly", "posters", "threads"}.
+        """
+        shard = self.get_shard(echoarea)
+        if not shard:
+            return {"daily": [], "hourly": [], "posters": [], "threads": []}
+        return shard.get_echoarea_stats(echoarea, days, top)
+
+    def get_parent(self, msgid: str) -> str:
+        """
+        Get msgid of message to which message replies.
+
+        Args:
+            msgid (str): Msgid.
+
+        Return:
+            str: Parent msgid or None.
+        """
+        echoarea = self.locate([msgid]).get(msgid)
+        shard = self.get_shard(echoarea) if echoarea else None
+        return shard.get_parent(msgid) if shard else None
+
+    def get_children(self, msgids: List[str]) -> List[str]:
+        """
+        Get msgids of replies to messages.
+
+        Args:
+            msgids (List): Parent msgids.
+
+        Return:
+            List: Msgids of replies, in arrival order within every shard.
+        """
+        children = []
+        for result in self.fan_out(lambda shard: shard.get_children(msgids),
+                                   self.all_shards()):
+            children += result
+        return children
+
+    def prune(self, echoarea: str, max_count: int = None,
+              max_age: int = None, batch: int = 500) -> int:
+        """
+        Delete oldest messages of echoarea by retention rules.
+
+        Args:
+            echoarea (str): Echoarea name.
+            max_count (int, optional): Maximal messages count.
+            max_age (int, optional): Maximal message age in seconds.
+            batch (int, optional): Messages deleted by one transaction.
+
+        Return:
+            int: Deleted messages count.
+        """
+        shard = self.get_shard(echoarea)
+        if not shard:
+            return 0
+        before = shard.get_index([echoarea])
+        deleted = shard.prune(echoarea, max_count, max_age, batch)
+        if deleted:
+            removed = set(before) - set(shard.get_index([echoarea]))
+            self.unmap([msgid for msgid in before if msgid in removed])
+        return deleted
+
+    def unmap(self, msgids: List[str]):
+        """
+        Delete msgids from global map.
+
+        Args:
+            msgids (List): Msgids.
+        """
+        connection, cursor = self.__connect()
+        cursor.executemany("DELETE FROM shard_map WHERE msgid = ?;",
+                           [(msgid,) for msgid in msgids])
+        connection.commit()
+        connection.close()
+
+    def archive(self, echoarea: str, directory: str) -> str:
+        """
+        Move shard file of echoarea to directory and forget its messages.
+        Only available if every echoarea has own file. WAL is checkpointed
+        and shard is moved with its sidecar files under exclusive sqlite
+        lock, so writes of other processes are not lost.
+
+        Args:
+            echoarea (str): Echoarea name.
+            directory (str): Archive directory.
+
+        Return:
+            str: Archived filename or empty string if echoarea has no
+                 own shard.
+        """
+        shard = self.get_shard(echoarea)
+        if self.buckets or not shard:
+            return ""
+        filename = path.join(directory, path.basename(shard.path))
+        with self.lock:
+            self.shards.pop(shard.path, None)
+            self.inodes.pop(shard.path, None)
+            connection = sqlite3.connect(shard.path, timeout=60)
+            connection.isolation_level = None
+            try:
+                connection.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+                connection.execute("BEGIN EXCLUSIVE;")
+                msgids = [row[0] for row in connection.execute(
+                    "SELECT msgid FROM messages;")]
+                for suffix in ("", "-wal", "-shm"):
+                    if path.exists(shard.path + suffix):
+                        replace(shard.path + suffix, filename + suffix)
+                connection.execute("ROLLBACK;")
+            finally:
+                connection.close()
+        self.unmap(msgids)
+        return filename
+
+    def enable_incremental_vacuum(self):
+        """
+        Switch existing databases to incremental vacuum.
+        """
+        self.catalog.enable_incremental_vacuum()
+        self.fan_out(lambda shard: shard.enable_incremental_vacuum(),
+                     self.all_shards())
+
+    def compress_messages(self, level: int) -> Dict[str, float]:
+        """
+        Compress or decompress all stored messages.
+
+        Args:
+            level (int): zlib compression level. 0 decompresses messages.
+
+        Return:
+            Dict: Statistics {"count", "before", "after",
+                  "compress_seconds", "decompress_seconds"}.
+        """
+        stats = {"count": 0, "before": 0, "after": 0,
+                 "compress_seconds": 0.0, "decompress_seconds": 0.0}
+        for result in self.fan_out(
+                lambda shard: shard.compress_messages(level),
+                self.all_shards()):
+            for key in stats:
+                stats[key] += result[key]
+        return stats
+
+    def get_sync_cursors(self, uplink: str) -> Dict[str, str]:
+        """
+        Sync cursors of uplink from catalog.
+
+        Args:
+            uplink (str): Uplink URL.
+
+        Return:
+            Dict: Cursors {"echoarea": "msgid"}.
+        """
+        return self.catalog.get_sync_cursors(uplink)
+
+    def set_sync_cursor(self, uplink: str, echoarea: str, msgid: str):
+        """
+        Save sync cursor of uplink echoarea to catalog.
+
+        Args:
+            uplink (str): Uplink URL.
+            echoarea (str): Echoarea name.
+            msgid (str): Last confirmed remote msgid.
+        """
+        self.catalog.set_sync_cursor(uplink, echoarea, msgid)
+
+    def get_sync_pending(self, uplink: str) -> Dict[str, List[str]]:
+        """
+        Msgids assigned for download from uplink but not saved yet.
+
+        Args:
+            uplink (str): Uplink URL.
+
+        Return:
+            Dict: Pending msgids of echoareas {"echoarea": List}.
+        """
+        return self.catalog.get_sync_pending(uplink)
+
+    def add_sync_pending(self, uplink: str, echoarea: str,
+                         msgids: List[str]):
+        """
+        Mark msgids as pending download from uplink.
+
+        Args:
+            uplink (str): Uplink URL.
+            echoarea (str): Echoarea name.
+            msgids (List): Msgids.
+        """
+        self.catalog.add_sync_pending(uplink, echoarea, msgids)
+
+    def remove_sync_pending(self, msgids: List[str]):
+        """
+        Unmark saved or rejected msgids as pending for all uplinks.
+
+        Args:
+            msgids (List): Msgids.
+        """
+        self.catalog.remove_sync_pending(msgids)
+
+    def retry_sync_pending(self, uplink: str, echoareas: List[str],
+                           max_attempts: int) -> Dict[str, List[str]]:
+        """
+        Count new download attempt of msgids pending from uplink in
+        catalog and unmark msgids retried max_attempts times.
+
+        Args:
+            uplink (str): Uplink URL.
+            echoareas (List): Echoareas names.
+            max_attempts (int): Maximal retries of msgid.
+
+        Return:
+            Dict: Pending msgids of echoareas {"echoarea": List}.
+        """
+        return self.catalog.retry_sync_pending(uplink, echoareas,
+                                               max_attempts)
+
+    def search_point(self, username: str) -> bool:
+        """
+        Search point by username.
+
+        Args:
+            username (str): Point's username.
+
+        Return:
+            bool: True if username exists else False.
+        """
+        return self.catalog.search_point(username)
+
+    def add_point(self, username: str) -> str:
+        """
+        Register point.
+
+        Args:
+            username (str): Point username.
+
+        Return:
+            str: Authstr.
+        """
+        return self.catalog.add_point(username)
+
+    def check_point(self, nodename: str, authstr: str) -> Dict[str, str]:
+        """
+        Check for a point.
+
+        Args:
+            nodename (str): Server name.
+            authstr (str): Search authstr.
+
+        Return:
+            Dict: Point informationa:
+                  {"name", "address"} or None.
+        """
+        return self.catalog.check_point(nodename, authstr)
+
+    def point_list(self) -> List[str]:
+        """
+        List of all points on server.
+
+        Return:
+            List (str): Points list.
+        """
+        return self.catalog.point_list()
+
+    def file_list(self) -> List[str]:
+        """
+        List of files on server.
+
+        Return:
+            List (str): Files list.
+        """
+        return self.catalog.file_list()
@@ -2,17 +2,39 @@
 Message sqlite3-base.
 """
 
+from base.analytics import DAY, HOUR, aggregate
 from base.base import Base
-from base64 import urlsafe_b64decode
-from typing import Dict, List
+from base.message import Message
+from collections import Counter
+from time import process_time, time
+from typing import Dict, Iterator, List, Union
+import re
 import sqlite3
 
+# Schema version stored in user_version of database.
+SCHEMA_VERSION = 2
+
 
 class Sqlite(Base):
-    def __init__(self, path: str):
+    """
+    Messages base in sqlite3 database.
+
+    Args:
+        path (str): Database filename.
+        store_encoded (bool, optional): Also keep base64 form of messages
+                                        for serving bundles. Ignored when
+                                        compression is enabled.
+        compression (int, optional): zlib compression level of stored
+                                     messages. 0 disables compression.
+    """
+    def __init__(self, path: str, store_encoded: bool = False,
+                 compression: int = 0, bloom: Dict[str, float] = None):
         super().__init__(path)
         self.path = path
+        self.store_encoded = store_encoded and not compression
+        self.compression = compression
         self.check_base()
+        self.load_bloom(bloom)
 
     def __connect(self):
         """
@@ -24,23 +46,65 @@ class Sqlite(Base):
 
     def check_base(self):
         """
-        Checks base and create this if not exists.
+        Checks base and create this if not exists. View messages_text
+        returns body as stored, so it is zlib blob when compression is
+        enabled and should be passed to decode_body. Database uses WAL
+        journal, so writers and pruning do not block readers.
         """
         connection, cursor = self.__connect()
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        cursor.execute("PRAGMA journal_mode = WAL;")
+        version = cursor.execute("PRAGMA user_version;").fetchone()[0]
+        columns = [column[1] for column in
+                   cursor.execute("PRAGMA table_info(messages);").fetchall()]
+        migrate = version < SCHEMA_VERSION and len(columns) > 0
+        if migrate:
+            self.migrate_raw(cursor, columns)
+            self.migrate_normalize(cursor)
+        sql = """CREATE TABLE IF NOT EXISTS echoareas(
+            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            name TEXT,
+            UNIQUE(name));"""
+        cursor.execute(sql)
+        sql = """CREATE TABLE IF NOT EXISTS authors(
+            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            msgfrom TEXT,
+            address TEXT,
+            UNIQUE(msgfrom, address));"""
+        cursor.execute(sql)
         sql = """CREATE TABLE IF NOT EXISTS messages(
             id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
             msgid TEXT,
             blacklisted INTEGER DEFAULT 0,
             tags TEXT,
-            echoarea TEXT,
+            echoarea_id INTEGER REFERENCES echoareas(id),
             date INTEGER,
-            msgfrom TEXT,
-            address TEXT,
+            author_id INTEGER REFERENCES authors(id),
             msgto TEXT,
             subject TEXT,
             body TEXT,
-            UNIQUE(id));"""
+            raw BLOB,
+            encoded TEXT);"""
+        cursor.execute(sql)
+        sql = "CREATE UNIQUE INDEX IF NOT EXISTS messages_msgid " + \
+              "ON messages(msgid);"
+        cursor.execute(sql)
+        sql = "CREATE INDEX IF NOT EXISTS messages_echoarea " + \
+              "ON messages(echoarea_id, id, msgid);"
         cursor.execute(sql)
+        sql = "CREATE INDEX IF NOT EXISTS messages_echoarea_date " + \
+              "ON messages(echoarea_id, date);"
+        cursor.execute(sql)
+        sql = """CREATE VIEW IF NOT EXISTS messages_text AS
+            SELECT messages.id, msgid, blacklisted, tags,
+            echoareas.name AS echoarea, date, msgfrom, address, msgto,
+            subject, body FROM messages
+            JOIN echoareas ON echoareas.id = messages.echoarea_id
+            JOIN authors ON authors.id = messages.author_id;"""
+        cursor.execute(sql)
+        if self.store_encoded:
+            self.fill_encoded(cursor)
+        cursor.execute("PRAGMA user_version = {};".format(SCHEMA_VERSION))
         sql = """CREATE TABLE IF NOT EXISTS points(
             id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
             username TEXT,
@@ -54,8 +118,179 @@ class Sqlite(Base):
             description TEXT,
             UNIQUE(id));"""
         cursor.execute(sql)
+        sql = "SELECT COUNT(1) FROM sqlite_master WHERE name = 'replies';"
+        backfill = cursor.execute(sql).fetchone()[0] == 0
+        sql = """CREATE TABLE IF NOT EXISTS replies(
+            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            msgid TEXT,
+            parent TEXT);"""
+        cursor.execute(sql)
+        sql = "CREATE INDEX IF NOT EXISTS replies_parent ON replies(parent);"
+        cursor.execute(sql)
+        sql = "CREATE INDEX IF NOT EXISTS replies_msgid ON replies(msgid);"
+        cursor.execute(sql)
+        if backfill:
+            sql = "SELECT msgid, tags FROM messages " + \
+                  "WHERE tags LIKE '%repto/%' ORDER BY id;"
+            replies = [(msgid, Base.get_repto(tags))
+                       for msgid, tags in cursor.execute(sql).fetchall()]
+            sql = "INSERT INTO replies (msgid, parent) VALUES (?, ?);"
+            cursor.executemany(sql, [x for x in replies if x[1]])
+        sql = "SELECT COUNT(1) FROM sqlite_master " + \
+              "WHERE name = 'stats_daily';"
+        rebuild_stats = cursor.execute(sql).fetchone()[0] == 0
+        for table, column in (("stats_daily", "day"),
+                              ("stats_hourly", "hour"),
+                              ("stats_posters", "author_id")):
+            sql = """CREATE TABLE IF NOT EXISTS {0}(
+                echoarea_id INTEGER,
+                {1} INTEGER,
+                count INTEGER,
+                PRIMARY KEY (echoarea_id, {1})) WITHOUT ROWID;"""
+            cursor.execute(sql.format(table, column))
+        sql = """CREATE TABLE IF NOT EXISTS stats_threads(
+            echoarea_id INTEGER,
+            root TEXT,
+            count INTEGER,
+            last_date INTEGER,
+            PRIMARY KEY (echoarea_id, root)) WITHOUT ROWID;"""
+        cursor.execute(sql)
+        sql = """CREATE TABLE IF NOT EXISTS sync_cursors(
+            uplink TEXT,
+            echoarea TEXT,
+            msgid TEXT,
+            PRIMARY KEY (uplink, echoarea)) WITHOUT ROWID;"""
+        cursor.execute(sql)
+        sql = """CREATE TABLE IF NOT EXISTS sync_pending(
+            uplink TEXT,
+            msgid TEXT,
+            echoarea TEXT,
+            attempts INTEGER DEFAULT 0,
+            PRIMARY KEY (uplink, msgid));"""
+        cursor.execute(sql)
+        columns = [column[1] for column in cursor.execute(
+            "PRAGMA table_info(sync_pending);").fetchall()]
+        if "attempts" not in columns:
+            cursor.execute("ALTER TABLE sync_pending ADD COLUMN attempts "
+                           "INTEGER DEFAULT 0;")
+        sql = "CREATE INDEX IF NOT EXISTS sync_pending_msgid " + \
+              "ON sync_pending(msgid);"
+        cursor.execute(sql)
+        sql = """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+            USING fts5(subject, body);"""
+        try:
+            cursor.execute(sql)
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
         connection.commit()
+        if migrate:
+            cursor.execute("VACUUM;")
         connection.close()
+        if rebuild_stats:
+            self.rebuild_stats()
+
+    def migrate_raw(self, cursor: object, columns: List[str]):
+        """
+        Add columns of canonical message bytes to messages table of first
+        schema and fill them for messages saved before.
+
+        Args:
+            cursor (object): Database cursor.
+            columns (List): Columns of messages table.
+        """
+        if "raw" not in columns:
+            cursor.execute("ALTER TABLE messages ADD COLUMN raw BLOB;")
+        if "encoded" not in columns:
+            cursor.execute("ALTER TABLE messages ADD COLUMN encoded TEXT;")
+        sql = "SELECT id, tags, echoarea, date, msgfrom, address, msgto, " + \
+              "subject, body FROM messages WHERE raw IS NULL LIMIT 1000;"
+        while True:
+            rows = cursor.execute(sql).fetchall()
+            if not rows:
+                break
+            updates = []
+            for row in rows:
+                message = Message.build(*[str(x) for x in row[1:]])
+                updates.append((message.data, row[0]))
+            cursor.executemany("UPDATE messages SET raw = ? WHERE id = ?;",
+                               updates)
+
+    def migrate_normalize(self, cursor: object):
+        """
+        Rewrite messages table of first schema with echoareas and authors
+        moved to dictionary tables. Duplicated msgids are dropped.
+
+        Args:
+            cursor (object): Database cursor.
+        """
+        sql = """CREATE TABLE IF NOT EXISTS echoareas(
+            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            name TEXT,
+            UNIQUE(name));"""
+        cursor.execute(sql)
+        sql = """CREATE TABLE IF NOT EXISTS authors(
+            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            msgfrom TEXT,
+            address TEXT,
+            UNIQUE(msgfrom, address));"""
+        cursor.execute(sql)
+        sql = "INSERT OR IGNORE INTO echoareas (name) " + \
+              "SELECT echoarea FROM messages GROUP BY echoarea " + \
+              "ORDER BY MIN(id);"
+        cursor.execute(sql)
+        sql = "INSERT OR IGNORE INTO authors (msgfrom, address) " + \
+              "SELECT COALESCE(msgfrom, ''), COALESCE(address, '') " + \
+              "FROM messages GROUP BY msgfrom, address ORDER BY MIN(id);"
+        cursor.execute(sql)
+        cursor.execute("DROP VIEW IF EXISTS messages_text;")
+        cursor.execute("ALTER TABLE messages RENAME TO messages_old;")
+        for index in ("messages_msgid", "messages_echoarea",
+                      "messages_echoarea_date"):
+            cursor.execute("DROP INDEX IF EXISTS {};".format(index))
+        sql = """CREATE TABLE messages(
+            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            msgid TEXT,
+            blacklisted INTEGER DEFAULT 0,
+            tags TEXT,
+            echoarea_id INTEGER REFERENCES echoareas(id),
+            date INTEGER,
+            author_id INTEGER REFERENCES authors(id),
+            msgto TEXT,
+            subject TEXT,
+            body TEXT,
+            raw BLOB,
+            encoded TEXT);"""
+        cursor.execute(sql)
+        sql = """INSERT INTO messages (id, msgid, blacklisted, tags,
+            echoarea_id, date, author_id, msgto, subject, body, raw, encoded)
+            SELECT m.id, m.msgid, m.blacklisted, m.tags, echoareas.id,
+            m.date, authors.id, m.msgto, m.subject, m.body, m.raw, m.encoded
+            FROM messages_old AS m
+            JOIN echoareas ON echoareas.name = m.echoarea
+            JOIN authors ON authors.msgfrom = COALESCE(m.msgfrom, '')
+            AND authors.address = COALESCE(m.address, '')
+            WHERE m.id IN (SELECT MIN(id) FROM messages_old GROUP BY msgid)
+            ORDER BY m.id;"""
+        cursor.execute(sql)
+        cursor.execute("DROP TABLE messages_old;")
+
+    def fill_encoded(self, cursor: object):
+        """
+        Fill base64 forms of messages saved without them.
+
+        Args:
+            cursor (object): Database cursor.
+        """
+        sql = "SELECT id, raw FROM messages WHERE encoded IS NULL LIMIT 1000;"
+        while True:
+            rows = cursor.execute(sql).fetchall()
+            if not rows:
+                break
+            updates = [(Message(data=Base.decompress(raw)).encoded, id)
+                       for id, raw in rows]
+            cursor.executemany("UPDATE messages SET encoded = ? "
+                               "WHERE id = ?;", updates)
 
     def get_blacklist(self) -> List[str]:
         """
@@ -72,6 +307,32 @@ class Sqlite(Base):
             blacklist.append(item[0])
         return blacklist
 
+    def set_blacklisted(self, msgids: List[str]):
+        """
+        Add msgids to blacklist.
+
+        Args:
+            msgids (List): Msgids.
+        """
+        connection, cursor = self.__connect()
+        cursor.executemany("UPDATE messages SET blacklisted = 1 "
+                           "WHERE msgid = ?;", [(msgid,) for msgid in msgids])
+        connection.commit()
+        connection.close()
+
+    def get_echoareas(self) -> List[str]:
+        """
+        Names of all echoareas stored in base.
+
+        Return:
+            List: Echoareas names.
+        """
+        connection, cursor = self.__connect()
+        sql = "SELECT name FROM echoareas ORDER BY id;"
+        echoareas = [row[0] for row in cursor.execute(sql).fetchall()]
+        connection.close()
+        return echoareas
+
     def get_counts(self, echoareas: List[str]) -> Dict[str, int]:
         """
         Counts the number of messages in a echoarea.
@@ -83,7 +344,8 @@ class Sqlite(Base):
             Dict: Dict of echoareas counts (str) {"name": int}.
         """
         counts = {}
-        sql = "SELECT COUNT(1) FROM messages WHERE echoarea = ?;"
+        sql = "SELECT COUNT(1) FROM messages WHERE echoarea_id = " + \
+              "(SELECT id FROM echoareas WHERE name = ?);"
         connection, cursor = self.__connect()
         for echoarea in echoareas:
             count = int(cursor.execute(sql, (echoarea,)).fetchone()[0])
@@ -102,7 +364,8 @@ class Sqlite(Base):
             List: Msgids.
         """
         index = []
-        sql = "SELECT msgid FROM messages WHERE echoarea = ?;"
+        sql = "SELECT msgid FROM messages WHERE echoarea_id = " + \
+              "(SELECT id FROM echoareas WHERE name = ?) ORDER BY id;"
         connection, cursor = self.__connect()
         for echoarea in echoareas:
             for msgid in cursor.execute(sql, (echoarea,)).fetchall():
@@ -110,6 +373,52 @@ class Sqlite(Base):
         connection.close()
         return index
 
+    def get_index_since(self, marks: Dict[str, str]) -> Dict[str, List[str]]:
+        """
+        Get msgids added to echoareas after mark.
+
+        Args:
+            marks (Dict): Marks of echoareas {"name": "mark"}, where mark
+                          is msgid of echoarea message or unixtime.
+                          Whole echoarea index returned for unknown msgid.
+
+        Return:
+            Dict: Msgids of echoareas {"name": List}.
+        """
+        index = {}
+        connection, cursor = self.__connect()
+        sql = "SELECT id FROM echoareas WHERE name = ?;"
+        for echoarea, mark in marks.items():
+            echoarea_id = cursor.execute(sql, (echoarea,)).fetchone()
+            echoarea_id = echoarea_id[0] if echoarea_id else 0
+            if Base.is_msgid(mark):
+                row = cursor.execute("SELECT id FROM messages WHERE "
+                                     "msgid = ? AND echoarea_id = ?;",
+                                     (mark, echoarea_id)).fetchone()
+                query = "SELECT msgid FROM messages " + \
+                        "WHERE echoarea_id = ? AND id > ? ORDER BY id;"
+                args = (echoarea_id, row[0] if row else 0)
+            else:
+                query = "SELECT msgid FROM messages " + \
+                        "WHERE echoarea_id = ? AND date >= ? ORDER BY id;"
+                args = (echoarea_id, int(mark))
+            index[echoarea] = [row[0] for row in
+                               cursor.execute(query, args).fetchall()]
+        connection.close()
+        return index
+
+    def get_msgids(self) -> Iterator[str]:
+        """
+        Iterate msgids of all stored messages.
+
+        Return:
+            Iterator: Msgids.
+        """
+        connection, cursor = self.__connect()
+        for row in cursor.execute("SELECT msgid FROM messages;"):
+            yield row[0]
+        connection.close()
+
     def is_message_exists(self, msgid: str) -> bool:
         """
         Check message exists in echoarea.
@@ -139,17 +448,52 @@ class Sqlite(Base):
         Return:
             str: Message as plain text.
         """
+        return self.get_message_data(msgid).decode("utf-8")
+
+    def get_message_data(self, msgid: str) -> bytes:
+        """
+        Get stored message bytes by msgid.
+
+        Args:
+            msgid (str): Msgid.
+
+        Return:
+            bytes: Message as utf-8 bytes.
+        """
         connection, cursor = self.__connect()
-        sql = "SELECT tags, echoarea, date, msgfrom, address, msgto, " + \
-              "subject, body FROM messages WHERE msgid = ?;"
+        sql = "SELECT raw FROM messages WHERE msgid = ?;"
         message = cursor.execute(sql, (msgid,)).fetchone()
         connection.close()
         if message:
-            return "{}\n{}\n{}\n{}\n{}\n{}\n{}\n\n{}".format(*message)
+            return Base.decompress(message[0])
         else:
-            return ""
+            return b""
 
-    def save_message(self, echoarea: str, msgid: str, message: str,
+    def get_bundle(self, msgids: List[str]) -> List[Message]:
+        """
+        Get existing messages with their stored bytes and base64 forms.
+
+        Args:
+            msgids (List): Msgids.
+
+        Return:
+            List: Messages in msgids order.
+        """
+        messages = {}
+        connection, cursor = self.__connect()
+        for i in range(0, len(msgids), 500):
+            block = msgids[i:i + 500]
+            sql = "SELECT msgid, raw, encoded FROM messages " + \
+                  "WHERE msgid IN ({});".format(", ".join("?" * len(block)))
+            for msgid, raw, encoded in cursor.execute(sql, block).fetchall():
+                messages[msgid] = Message(msgid=msgid,
+                                          data=Base.decompress(raw),
+                                          encoded=encoded)
+        connection.close()
+        return [messages[msgid] for msgid in msgids if msgid in messages]
+
+    def save_message(self, echoarea: str, msgid: str,
+                     message: Union[str, Message],
                      cursor: object = None):
         """
         Save message to base.
@@ -157,42 +501,240 @@ class Sqlite(Base):
         Args:
             echoarea (str): Echoarea name.
             msgid (str): Msgid.
-            message (str): Message as plain text.
+            message (str or Message): Message.
             cursor (object): Additional argument.
 
         Return:
             bool: Save status. True if message saved else False.
         """
-        sql = """INSERT INTO messages (msgid, tags, echoarea, date, msgfrom,
-        address, msgto, subject, body) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);"""
-        lines = message.split("\n")
-        cursor.execute(sql, (msgid, *lines[:7], "\n".join(lines[8:])))
+        if not isinstance(message, Message):
+            message = Message(message, msgid)
+        fields = message.fields
+        sql = "INSERT OR IGNORE INTO echoareas (name) VALUES (?);"
+        cursor.execute(sql, (fields[1],))
+        sql = "SELECT id FROM echoareas WHERE name = ?;"
+        echoarea_id = cursor.execute(sql, (fields[1],)).fetchone()[0]
+        sql = "INSERT OR IGNORE INTO authors (msgfrom, address) " + \
+              "VALUES (?, ?);"
+        cursor.execute(sql, (fields[3], fields[4]))
+        sql = "SELECT id FROM authors WHERE msgfrom = ? AND address = ?;"
+        author_id = cursor.execute(sql, (fields[3], fields[4])).fetchone()[0]
+        sql = """INSERT OR IGNORE INTO messages (msgid, tags, echoarea_id,
+        date, author_id, msgto, subject, body, raw, encoded) VALUES
+        (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"""
+        encoded = message.encoded if self.store_encoded else None
+        raw = Base.compress(message.data, self.compression)
+        body = fields[8]
+        if self.compression:
+            body = Base.compress(body.encode("utf-8"), self.compression)
+        cursor.execute(sql, (msgid, fields[0], echoarea_id, fields[2],
+                             author_id, fields[5], fields[6], body, raw,
+                             encoded))
+        if cursor.rowcount == 0:
+            return False
+        self.remember_msgid(msgid)
+        rowid = cursor.lastrowid
+        if self.fts:
+            sql = "INSERT INTO messages_fts (rowid, subject, body) " + \
+                  "VALUES (?, ?, ?);"
+            cursor.execute(sql, (rowid, fields[6], fields[8]))
+        repto = Base.get_repto(fields[0])
+        if repto:
+            sql = "INSERT INTO replies (msgid, parent) VALUES (?, ?);"
+            cursor.execute(sql, (msgid, repto))
+        self.update_stats(cursor, echoarea_id, self.stats_date(fields[2]),
+                          author_id, repto)
+        return True
+
+    @staticmethod
+    def stats_date(date: str) -> int:
+        """
+        Date of message for rollups. Same as MAX(CAST(date AS INTEGER), 0)
+        used by rebuild_stats, so malformed dates are counted as 0.
+
+        Args:
+            date (str): Date field of message.
+
+        Return:
+            int: Unixtime.
+        """
+        match = re.match(r"\s*([+-]?\d+)", date)
+        if not match:
+            return 0
+        return max(int(match.group(1)), 0)
+
+    def update_stats(self, cursor: object, echoarea_id: int, date: int,
+                     author_id: int, repto: str = None):
+        """
+        Add saved message to activity rollups.
+
+        Args:
+            cursor (object): Database cursor.
+            echoarea_id (int): Echoarea id of message.
+            date (int): Date of message (unixtime).
+            author_id (int): Author id of message.
+            repto (str, optional): Msgid of replied message.
+        """
+        for table, column, value in (("stats_daily", "day", date // DAY),
+                                     ("stats_hourly", "hour", date // HOUR),
+                                     ("stats_posters", "author_id",
+                                      author_id)):
+            sql = "INSERT INTO {0} (echoarea_id, {1}, count) " + \
+                  "VALUES (?, ?, 1) ON CONFLICT (echoarea_id, {1}) " + \
+                  "DO UPDATE SET count = count + 1;"
+            cursor.execute(sql.format(table, column), (echoarea_id, value))
+        if repto:
+            root = self.get_root(cursor, repto)
+            sql = "INSERT INTO stats_threads (echoarea_id, root, count, " + \
+                  "last_date) VALUES (?, ?, 1, ?) " + \
+                  "ON CONFLICT (echoarea_id, root) DO UPDATE SET " + \
+                  "count = count + 1, " + \
+                  "last_date = MAX(last_date, excluded.last_date);"
+            cursor.execute(sql, (echoarea_id, root, date))
+
+    @staticmethod
+    def get_root(cursor: object, msgid: str) -> str:
+        """
+        Find first message of thread by replies.
+
+        Args:
+            cursor (object): Database cursor.
+            msgid (str): Msgid of thread message.
+
+        Return:
+            str: Msgid of thread root.
+        """
+        sql = "SELECT parent FROM replies WHERE msgid = ?;"
+        seen = {msgid}
+        while True:
+            parent = cursor.execute(sql, (msgid,)).fetchone()
+            if not parent or parent[0] in seen:
+                return msgid
+            msgid = parent[0]
+            seen.add(msgid)
+
+    def rebuild_stats(self):
+        """
+        Rebuild activity rollups of all messages. Columns are read by
+        batches and aggregated by numpy if it is installed.
+        """
+        connection, cursor = self.__connect()
+        for table in ("stats_daily", "stats_hourly", "stats_posters",
+                      "stats_threads"):
+            cursor.execute("DELETE FROM {};".format(table))
+        totals = {"daily": Counter(), "hourly": Counter(),
+                  "posters": Counter()}
+        sql = "SELECT id, echoarea_id, MAX(CAST(date AS INTEGER), 0), " + \
+              "author_id FROM messages WHERE id > ? ORDER BY id LIMIT 100000;"
+        last = 0
+        while True:
+            rows = cursor.execute(sql, (last,)).fetchall()
+            if not rows:
+                break
+            last = rows[-1][0]
+            ids, echoarea_ids, dates, author_ids = zip(*rows)
+            for name, counts in aggregate(echoarea_ids, dates,
+                                          author_ids).items():
+                totals[name].update(counts)
+        for table, column, name in (("stats_daily", "day", "daily"),
+                                    ("stats_hourly", "hour", "hourly"),
+                                    ("stats_posters", "author_id",
+                                     "posters")):
+            sql = "INSERT INTO {} (echoarea_id, {}, count) " + \
+                  "VALUES (?, ?, ?);"
+            cursor.executemany(sql.format(table, column),
+                               [(*key, count) for key, count
+                                in totals[name].items()])
+        parents = dict(cursor.execute("SELECT msgid, parent "
+                                      "FROM replies;").fetchall())
+        threads = {}
+        sql = "SELECT messages.msgid, echoarea_id, " + \
+              "MAX(CAST(date AS INTEGER), 0) FROM replies " + \
+              "JOIN messages ON messages.msgid = replies.msgid;"
+        for msgid, echoarea_id, date in cursor.execute(sql).fetchall():
+            root, seen = parents[msgid], {msgid}
+            while root in parents and root not in seen:
+                seen.add(root)
+                root = parents[root]
+            count, last_date = threads.get((echoarea_id, root), (0, 0))
+            threads[(echoarea_id, root)] = (count + 1, max(last_date, date))
+        sql = "INSERT INTO stats_threads (echoarea_id, root, count, " + \
+              "last_date) VALUES (?, ?, ?, ?);"
+        cursor.executemany(sql, [(*key, *value)
+                                 for key, value in threads.items()])
+        connection.commit()
+        connection.close()
+
+    def get_echoarea_stats(self, echoarea: str, days: int = 30,
+                           top: int = 10) -> Dict[str, List]:
+        """
+        Activity of echoarea from rollups.
+
+        Args:
+            echoarea (str): Echoarea name.
+            days (int, optional): Days of daily and hourly activity.
+            top (int, optional): Count of top posters and threads.
+
+        Return:
+            Dict: Activity {"daily": [[day, count]], "hourly": [[hour,
+                  count]], "posters": [[msgfrom, address, count]],
+                  "threads": [[root, count, last_date]]}, where day and
+                  hour are unixtime of period start.
+        """
+        connection, cursor = self.__connect()
+        sql = "SELECT id FROM echoareas WHERE name = ?;"
+        echoarea_id = cursor.execute(sql, (echoarea,)).fetchone()
+        echoarea_id = echoarea_id[0] if echoarea_id else 0
+        since = int(time()) - days * DAY
+        stats = {}
+        sql = "SELECT day * ?, count FROM stats_daily " + \
+              "WHERE echoarea_id = ? AND day >= ? ORDER BY day;"
+        stats["daily"] = cursor.execute(sql, (DAY, echoarea_id,
+                                              since // DAY)).fetchall()
+        sql = "SELECT hour * ?, count FROM stats_hourly " + \
+              "WHERE echoarea_id = ? AND hour >= ? ORDER BY hour;"
+        stats["hourly"] = cursor.execute(sql, (HOUR, echoarea_id,
+                                               since // HOUR)).fetchall()
+        sql = "SELECT msgfrom, address, count FROM stats_posters " + \
+              "JOIN authors ON authors.id = stats_posters.author_id " + \
+              "WHERE echoarea_id = ? ORDER BY count DESC LIMIT ?;"
+        stats["posters"] = cursor.execute(sql, (echoarea_id,
+                                                top)).fetchall()
+        sql = "SELECT root, count, last_date FROM stats_threads " + \
+              "WHERE echoarea_id = ? AND last_date >= ? " + \
+              "ORDER BY count DESC LIMIT ?;"
+        stats["threads"] = cursor.execute(sql, (echoarea_id, since,
+                                                top)).fetchall()
+        connection.close()
+        return {key: [list(row) for row in rows]
+                for key, rows in stats.items()}
 
-    def save_messages(self, bundle: List[Dict[str, str]]) -> int:
+    def save_messages(self, bundle: List[Message]) -> int:
         """
         Save messages of bundle to base.
 
         Args:
-            bundle (List): Bundle as List of dict:
-                           {"msgid", "encoded"}.
+            bundle (List): Bundle as List of messages.
 
         Return:
             int: Saved messages count.
         """
+        self.grow_bloom()
         connection, cursor = self.__connect()
-        new_messages = []
-        echoarea = ""
+        saved = set()
+        sql = "SELECT 1 FROM messages WHERE msgid = ?;"
         for message in bundle:
-            body = urlsafe_b64decode(message["encoded"]).decode("utf-8")
-            echoarea = body.split("\n")[1]
-            if not self.is_message_exists(message["msgid"]):
-                new_messages.append({"msgid": message["msgid"], "body": body})
-        for message in new_messages:
-            self.save_message(echoarea, message["msgid"], message["body"],
-                              cursor)
+            if message.msgid in saved:
+                continue
+            if self.may_exist(message.msgid) and \
+                    cursor.execute(sql, (message.msgid,)).fetchone():
+                continue
+            if self.save_message(message.echoarea, message.msgid, message,
+                                 cursor):
+                saved.add(message.msgid)
         connection.commit()
         connection.close()
-        return len(new_messages)
+        return len(saved)
 
     def toss_message(self, point: Dict[str, str], encoded: str) -> str:
         """
@@ -210,16 +752,381 @@ class Sqlite(Base):
         def toss_and_save_message(echoarea: str, msgid: str,
                                   message: str):
             connection, cursor = self.__connect()
-            sql = """INSERT INTO messages (msgid, tags, echoarea, date, msgfrom,
-                    address, msgto, subject, body) VALUES
-                    (?, ?, ?, ?, ?, ?, ?, ?, ?);"""
-            lines = message.split("\n")
-            cursor.execute(sql, (msgid, *lines[:7], "\n".join(lines[8:])))
+            self.save_message(echoarea, msgid, message, cursor)
             connection.commit()
             connection.close()
 
         return super().toss_message(toss_and_save_message, point, encoded)
 
+    def search(self, query: str, echoarea: str = None, since: int = None,
+               until: int = None, limit: int = 20) -> List[Dict[str, str]]:
+        """
+        Full-text search of messages.
+
+        Args:
+            query (str): Search words.
+            echoarea (str, optional): Echoarea name filter.
+            since (int, optional): Minimal message date (unixtime).
+            until (int, optional): Maximal message date (unixtime).
+            limit (int, optional): Maximal results count.
+
+        Return:
+            List: Found messages ordered by rank as Dict:
+                  {"msgid", "snippet"}.
+        """
+        words = ['"{}"'.format(word.replace('"', '""'))
+                 for word in query.split()]
+        if not self.fts or not words:
+            return []
+        sql = "SELECT messages.msgid, " + \
+              "snippet(messages_fts, -1, '', '', '...', 16) " + \
+              "FROM messages_fts JOIN messages " + \
+              "ON messages.id = messages_fts.rowid " + \
+              "WHERE messages_fts MATCH ?"
+        args = [" ".join(words)]
+        if echoarea:
+            sql += " AND messages.echoarea_id = " + \
+                   "(SELECT id FROM echoareas WHERE name = ?)"
+            args.append(echoarea)
+        if since:
+            sql += " AND messages.date >= ?"
+            args.append(since)
+        if until:
+            sql += " AND messages.date <= ?"
+            args.append(until)
+        sql += " ORDER BY messages_fts.rank LIMIT ?;"
+        args.append(limit)
+        connection, cursor = self.__connect()
+        rows = cursor.execute(sql, args).fetchall()
+        connection.close()
+        return [{"msgid": row[0], "snippet": row[1]} for row in rows]
+
+    def rebuild_search_index(self):
+        """
+        Rebuild full-text search index of all messages.
+        """
+        if not self.fts:
+            return
+        connection, cursor = self.__connect()
+        cursor.execute("DELETE FROM messages_fts;")
+        sql = "SELECT id, subject, body FROM messages WHERE id > ? " + \
+              "ORDER BY id LIMIT 1000;"
+        last = 0
+        while True:
+            rows = cursor.execute(sql, (last,)).fetchall()
+            if not rows:
+                break
+            last = rows[-1][0]
+            rows = [(id, subject, self.decode_body(body))
+                    for id, subject, body in rows]
+            cursor.executemany("INSERT INTO messages_fts (rowid, subject, "
+                               "body) VALUES (?, ?, ?);", rows)
+        connection.commit()
+        connection.close()
+
+    def prune(self, echoarea: str, max_count: int = None,
+              max_age: int = None, batch: int = 500) -> int:
+        """
+        Delete oldest messages of echoarea by retention rules. Every batch
+        is deleted by own short transaction, so readers are not blocked
+        and see consistent counts and indexes.
+
+        Args:
+            echoarea (str): Echoarea name.
+            max_count (int, optional): Maximal messages count.
+            max_age (int, optional): Maximal message age in seconds.
+            batch (int, optional): Messages deleted by one transaction.
+
+        Return:
+            int: Deleted messages count.
+        """
+        connection, cursor = self.__connect()
+        incremental = cursor.execute("PRAGMA auto_vacuum;").fetchone()[0] == 2
+        sql = "SELECT id FROM echoareas WHERE name = ?;"
+        echoarea_id = cursor.execute(sql, (echoarea,)).fetchone()
+        if not echoarea_id:
+            connection.close()
+            return 0
+        echoarea_id = echoarea_id[0]
+        deleted = 0
+        while True:
+            ids = []
+            if max_count is not None:
+                sql = "SELECT COUNT(1) FROM messages WHERE echoarea_id = ?;"
+                count = cursor.execute(sql, (echoarea_id,)).fetchone()[0]
+                sql = "SELECT id, msgid FROM messages " + \
+                      "WHERE echoarea_id = ? ORDER BY id LIMIT ?;"
+                ids = cursor.execute(sql, (echoarea_id, min(
+                    batch, max(0, count - max_count)))).fetchall()
+            if max_age is not None and len(ids) < batch:
+                sql = "SELECT id, msgid FROM messages " + \
+                      "WHERE echoarea_id = ? AND date < ? " + \
+                      "ORDER BY id LIMIT ?;"
+                expired = cursor.execute(sql, (echoarea_id,
+                                               int(time()) - max_age,
+                                               batch)).fetchall()
+                ids = list(dict(ids + expired).items())[:batch]
+            if not ids:
+                break
+            cursor.executemany("DELETE FROM messages WHERE id = ?;",
+                               [(id,) for id, msgid in ids])
+            if self.fts:
+                cursor.executemany("DELETE FROM messages_fts "
+                                   "WHERE rowid = ?;",
+                                   [(id,) for id, msgid in ids])
+            cursor.executemany("DELETE FROM replies WHERE msgid = ?;",
+                               [(msgid,) for id, msgid in ids])
+            connection.commit()
+            if incremental:
+                cursor.execute("PRAGMA incremental_vacuum({});".format(
+                    batch * 4))
+            deleted += len(ids)
+        connection.close()
+        return deleted
+
+    def enable_incremental_vacuum(self):
+        """
+        Switch existing database to incremental vacuum. Rebuilds whole
+        database file once.
+        """
+        connection, cursor = self.__connect()
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        cursor.execute("VACUUM;")
+        connection.close()
+
+    @staticmethod
+    def decode_body(body: Union[str, bytes]) -> str:
+        """
+        Decode body column which may be compressed.
+
+        Args:
+            body (str or bytes): Stored body.
+
+        Return:
+            str: Message body.
+        """
+        body = Base.decompress(body)
+        if isinstance(body, bytes):
+            return body.decode("utf-8")
+        return body
+
+    @staticmethod
+    def stored_size(value: Union[str, bytes]) -> int:
+        """
+        Size of stored column value in bytes.
+
+        Args:
+            value (str or bytes): Column value.
+
+        Return:
+            int: Size in bytes.
+        """
+        if isinstance(value, str):
+            return len(value.encode("utf-8"))
+        return len(value)
+
+    def compress_messages(self, level: int) -> Dict[str, float]:
+        """
+        Compress or decompress all stored messages. Base64 forms are
+        dropped on compression, because they would be larger than
+        compressed messages.
+
+        Args:
+            level (int): zlib compression level. 0 decompresses messages.
+
+        Return:
+            Dict: Statistics {"count", "before", "after",
+                  "compress_seconds", "decompress_seconds"}.
+        """
+        stats = {"count": 0, "before": 0, "after": 0,
+                 "compress_seconds": 0.0, "decompress_seconds": 0.0}
+        connection, cursor = self.__connect()
+        sql = "SELECT id, raw, body, encoded FROM messages WHERE id > ? " + \
+              "ORDER BY id LIMIT 1000;"
+        last = 0
+        while True:
+            rows = cursor.execute(sql, (last,)).fetchall()
+            if not rows:
+                break
+            last = rows[-1][0]
+            updates = []
+            for id, raw, body, encoded in rows:
+                data = Base.decompress(raw)
+                text = self.decode_body(body)
+                stats["before"] += len(raw) + self.stored_size(body)
+                if encoded:
+                    stats["before"] += len(encoded)
+                    if level:
+                        encoded = None
+                    else:
+                        stats["after"] += len(encoded)
+                started = process_time()
+                raw = Base.compress(data, level)
+                body = text
+                if level:
+                    body = Base.compress(text.encode("utf-8"), level)
+                stats["compress_seconds"] += process_time() - started
+                started = process_time()
+                Base.decompress(raw)
+                stats["decompress_seconds"] += process_time() - started
+                stats["after"] += len(raw) + self.stored_size(body)
+                updates.append((raw, body, encoded, id))
+            cursor.executemany("UPDATE messages SET raw = ?, body = ?, "
+                               "encoded = ? WHERE id = ?;", updates)
+            connection.commit()
+            stats["count"] += len(rows)
+        cursor.execute("VACUUM;")
+        connection.close()
+        return stats
+
+    def get_parent(self, msgid: str) -> str:
+        """
+        Get msgid of message to which message replies.
+
+        Args:
+            msgid (str): Msgid.
+
+        Return:
+            str: Parent msgid or None.
+        """
+        connection, cursor = self.__connect()
+        sql = "SELECT parent FROM replies WHERE msgid = ?;"
+        parent = cursor.execute(sql, (msgid,)).fetchone()
+        connection.close()
+        return parent[0] if parent else None
+
+    def get_children(self, msgids: List[str]) -> List[str]:
+        """
+        Get msgids of replies to messages.
+
+        Args:
+            msgids (List): Parent msgids.
+
+        Return:
+            List: Msgids of replies in arrival order.
+        """
+        children = []
+        connection, cursor = self.__connect()
+        for i in range(0, len(msgids), 500):
+            block = msgids[i:i + 500]
+            sql = "SELECT msgid FROM replies WHERE parent IN ({}) " + \
+                  "ORDER BY id;"
+            sql = sql.format(", ".join("?" * len(block)))
+            for child in cursor.execute(sql, block).fetchall():
+                children.append(child[0])
+        connection.close()
+        return children
+
+    def get_sync_cursors(self, uplink: str) -> Dict[str, str]:
+        """
+        Sync cursors of uplink. Cursor is last remote msgid of echoarea
+        which messages before it are saved or pending.
+
+        Args:
+            uplink (str): Uplink URL.
+
+        Return:
+            Dict: Cursors {"echoarea": "msgid"}.
+        """
+        connection, cursor = self.__connect()
+        sql = "SELECT echoarea, msgid FROM sync_cursors WHERE uplink = ?;"
+        cursors = dict(cursor.execute(sql, (uplink,)).fetchall())
+        connection.close()
+        return cursors
+
+    def set_sync_cursor(self, uplink: str, echoarea: str, msgid: str):
+        """
+        Save sync cursor of uplink echoarea.
+
+        Args:
+            uplink (str): Uplink URL.
+            echoarea (str): Echoarea name.
+            msgid (str): Last confirmed remote msgid.
+        """
+        connection, cursor = self.__connect()
+        sql = "INSERT OR REPLACE INTO sync_cursors (uplink, echoarea, " + \
+              "msgid) VALUES (?, ?, ?);"
+        cursor.execute(sql, (uplink, echoarea, msgid))
+        connection.commit()
+        connection.close()
+
+    def get_sync_pending(self, uplink: str) -> Dict[str, List[str]]:
+        """
+        Msgids assigned for download from uplink but not saved yet.
+
+        Args:
+            uplink (str): Uplink URL.
+
+        Return:
+            Dict: Pending msgids of echoareas {"echoarea": List}.
+        """
+        connection, cursor = self.__connect()
+        sql = "SELECT echoarea, msgid FROM sync_pending WHERE uplink = ? " + \
+              "ORDER BY rowid;"
+        pending = {}
+        for echoarea, msgid in cursor.execute(sql, (uplink,)).fetchall():
+            pending.setdefault(echoarea, []).append(msgid)
+        connection.close()
+        return pending
+
+    def add_sync_pending(self, uplink: str, echoarea: str,
+                         msgids: List[str]):
+        """
+        Mark msgids as pending download from uplink.
+
+        Args:
+            uplink (str): Uplink URL.
+            echoarea (str): Echoarea name.
+            msgids (List): Msgids.
+        """
+        connection, cursor = self.__connect()
+        sql = "INSERT OR IGNORE INTO sync_pending (uplink, msgid, " + \
+              "echoarea) VALUES (?, ?, ?);"
+        cursor.executemany(sql, [(uplink, msgid, echoarea)
+                                 for msgid in msgids])
+        connection.commit()
+        connection.close()
+
+    def remove_sync_pending(self, msgids: List[str]):
+        """
+        Unmark saved or rejected msgids as pending for all uplinks.
+
+        Args:
+            msgids (List): Msgids.
+        """
+        connection, cursor = self.__connect()
+        cursor.executemany("DELETE FROM sync_pending WHERE msgid = ?;",
+                           [(msgid,) for msgid in msgids])
+        connection.commit()
+        connection.close()
+
+    def retry_sync_pending(self, uplink: str, echoareas: List[str],
+                           max_attempts: int) -> Dict[str, List[str]]:
+        """
+        Count new download attempt of msgids pending from uplink. Msgids
+        which were retried max_attempts times are unmarked.
+
+        Args:
+            uplink (str): Uplink URL.
+            echoareas (List): Echoareas names.
+            max_attempts (int): Maximal retries of msgid.
+
+        Return:
+            Dict: Pending msgids of echoareas {"echoarea": List}.
+        """
+        connection, cursor = self.__connect()
+        for echoarea in echoareas:
+            cursor.execute("UPDATE sync_pending SET attempts = attempts + 1 "
+                           "WHERE uplink = ? AND echoarea = ?;",
+                           (uplink, echoarea))
+        cursor.execute("DELETE FROM sync_pending WHERE uplink = ? "
+                       "AND attempts > ?;", (uplink, max_attempts))
+        connection.commit()
+        connection.close()
+        pending = self.get_sync_pending(uplink)
+        return {echoarea: pending[echoarea] for echoarea in echoareas
+                if echoarea in pending}
+
     def search_point(self, username: str) -> bool:
         """
         Search point by username.
@@ -296,10 +1203,17 @@ class Sqlite(Base):
         return usernames
 
     def file_list(self) -> List[str]:
+        """
+        List of files available by file request.
+
+        Return:
+            List (str): Files list in "filename:size:description" format.
+        """
         connection, cursor = self.__connect()
-        sql = "SELECT * FROM files ORDER BY id;"
+        sql = "SELECT filename, size, description FROM files ORDER BY id;"
         files = cursor.execute(sql).fetchall()
+        connection.close()
         index = []
         for file in files:
-            index_line = "{}:{}:{}".format(*files[1:])
+            index.append("{}:{}:{}".format(*file))
         return index
@@ -3,19 +3,48 @@ Messages base based on plain text files.
 """
 
 from base.base import Base
-from base64 import urlsafe_b64decode
-from os import path, mkdir
-from typing import Dict, List
+from base.message import Message
+from contextlib import contextmanager
+from math import log
+from os import O_RDONLY, close, fstat, fsync, listdir, path, mkdir, \
+    open as open_fd, remove, replace
+from threading import Lock, RLock
+from time import process_time, time
+from typing import Dict, Iterator, List, Set, Tuple, Union
+import json
+import re
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 class Txt(Base):
-    def __init__(self, path: str):
+    """
+    Messages base in plain text files.
+
+    Args:
+        path (str): Base directory.
+        compression (int, optional): zlib compression level of message
+                                     files. 0 disables compression.
+    """
+    def __init__(self, path: str, compression: int = 0,
+                 bloom: Dict[str, float] = None):
         super().__init__(path)
         if path.endswith("/"):
             self.path = path
         else:
             self.path = path + "/"
+        self.compression = compression
+        self.search_index = None
+        self.search_mark = None
+        self.replies = None
+        self.replies_mark = None
+        self.write_lock = Lock()
+        self.index_lock = RLock()
         self.check_base()
+        self.load_bloom(bloom)
 
     def check_base(self):
         """
@@ -33,6 +62,16 @@ class Txt(Base):
             mkdir(self.path + "files")
         if not path.exists(self.path + "files/index.txt"):
             open(self.path + "files/index.txt", "w")
+        if not path.exists(self.path + "search.txt"):
+            open(self.path + "search.txt", "w")
+        if not path.exists(self.path + "replies.txt"):
+            with open(self.path + "replies.txt", "w") as f:
+                for echoarea in listdir(self.path + "echo"):
+                    for msgid in self.get_index([echoarea]):
+                        tags = self.get_message(msgid).split("\n", 1)[0]
+                        repto = Base.get_repto(tags)
+                        if repto:
+                            f.write("{} {}\n".format(msgid, repto))
 
     def get_blacklist(self) -> List[str]:
         """
@@ -44,6 +83,30 @@ class Txt(Base):
         return list(filter(lambda x: len(x) > 0,
                            open(self.path + "blacklist.txt").read().split("\n")))
 
+    def set_blacklisted(self, msgids: List[str]):
+        """
+        Add msgids to blacklist.
+
+        Args:
+            msgids (List): Msgids.
+        """
+        blacklist = set(self.get_blacklist())
+        with open(self.path + "blacklist.txt", "a") as f:
+            for msgid in msgids:
+                if msgid not in blacklist:
+                    blacklist.add(msgid)
+                    f.write(msgid + "\n")
+
+    def get_echoareas(self) -> List[str]:
+        """
+        Names of all echoareas stored in base.
+
+        Return:
+            List: Echoareas names.
+        """
+        return sorted(echoarea for echoarea in listdir(self.path + "echo")
+                      if not echoarea.endswith(".tmp"))
+
     def get_counts(self, echoareas: List[str]) -> Dict[str, int]:
         """
         Counts the number of messages in a echoarea.
@@ -60,7 +123,7 @@ class Txt(Base):
                 counts[echoarea] = 0
             else:
                 counts[echoarea] = len(open(self.path + "echo/" +
-                                            echoarea).read().split()) - 1
+                                            echoarea).read().split())
         return counts
 
     def get_index(self, echoareas: List[str]) -> List[str]:
@@ -82,6 +145,44 @@ class Txt(Base):
                             index.append(msgid)
         return index
 
+    def get_index_since(self, marks: Dict[str, str]) -> Dict[str, List[str]]:
+        """
+        Get msgids added to echoareas after mark.
+
+        Args:
+            marks (Dict): Marks of echoareas {"name": "mark"}, where mark
+                          is msgid of echoarea message or unixtime.
+                          Whole echoarea index returned for unknown msgid.
+
+        Return:
+            Dict: Msgids of echoareas {"name": List}.
+        """
+        index = {}
+        for echoarea, mark in marks.items():
+            msgids = self.get_index([echoarea])
+            if Base.is_msgid(mark):
+                if mark in msgids:
+                    msgids = msgids[msgids.index(mark) + 1:]
+            else:
+                self.load_search_index()
+                dates = self.search_index["messages"]
+                since = int(mark)
+                msgids = [msgid for msgid in msgids
+                          if dates.get(msgid, (None, since))[1] >= since]
+            index[echoarea] = msgids
+        return index
+
+    def get_msgids(self) -> Iterator[str]:
+        """
+        Iterate msgids of all stored messages.
+
+        Return:
+            Iterator: Msgids.
+        """
+        for msgid in listdir(self.path + "msg/"):
+            if not msgid.endswith(".tmp"):
+                yield msgid
+
     def is_message_exists(self, msgid: str) -> bool:
         """
         Check message exists in echoarea.
@@ -92,7 +193,7 @@ class Txt(Base):
         Return:
              bool: True if message exists.
         """
-        if path.exists("msg/" + msgid):
+        if path.exists(self.path + "msg/" + msgid):
             return True
         return False
 
@@ -106,12 +207,127 @@ class Txt(Base):
         Return:
             str: Message as plain text.
         """
+        return self.get_message_data(msgid).decode("utf-8")
+
+    def get_message_data(self, msgid: str) -> bytes:
+        """
+        Get stored message bytes by msgid.
+
+        Args:
+            msgid (str): Msgid.
+
+        Return:
+            bytes: Message as utf-8 bytes.
+        """
         if path.exists(self.path + "msg/" + msgid):
-            return open(self.path + "msg/" + msgid).read()
+            with open(self.path + "msg/" + msgid, "rb") as f:
+                return Base.decompress(f.read())
         else:
-            return ""
+            return b""
+
+    @contextmanager
+    def locked(self):
+        """
+        Exclusive lock of base shared by all processes, so server and
+        fetcher do not write base files concurrently. Only threads are
+        locked out on systems without fcntl.
+        """
+        with self.write_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.path + "lock", "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def append(filename: str, lines: List[str]):
+        """
+        Append lines to file by one write and flush them to disk.
+
+        Args:
+            filename (str): Filename.
+            lines (List): Lines with line endings.
+        """
+        with open(filename, "a") as f:
+            f.write("".join(lines))
+            f.flush()
+            fsync(f.fileno())
+
+    @staticmethod
+    def fsync_dir(dirname: str):
+        """
+        Flush directory entries to disk, so renamed and created files
+        survive crash. Skipped on systems which can not open directories.
+
+        Args:
+            dirname (str): Directory name.
+        """
+        try:
+            fd = open_fd(dirname, O_RDONLY)
+        except OSError:
+            return
+        try:
+            fsync(fd)
+        finally:
+            close(fd)
+
+    def write_messages(self, messages: List[Tuple[str, str, Message]]) -> int:
+        """
+        Save messages to base by one batch. Message files are written as
+        fsynced temporary files and renamed, then msg directory is fsynced
+        and msgids are appended to echoareas, search and replies files by
+        one write of every file, so index never points to missing or
+        truncated file. Existence of every msgid is checked on disk under
+        process lock, because Bloom filter does not know msgids saved by
+        other processes.
 
-    def save_message(self, echoarea: str, msgid: str, message: str,
+        Args:
+            messages (List): Messages as (echoarea, msgid, Message).
+
+        Return:
+            int: Saved messages count.
+        """
+        with self.locked():
+            self.grow_bloom()
+            echoes = {}
+            search = []
+            replies = []
+            for echoarea, msgid, message in messages:
+                if self.is_message_exists(msgid):
+                    continue
+                filename = self.path + "msg/" + msgid
+                with open(filename + ".tmp", "wb") as f:
+                    f.write(Base.compress(message.data, self.compression))
+                    f.flush()
+                    fsync(f.fileno())
+                replace(filename + ".tmp", filename)
+                self.remember_msgid(msgid)
+                echoes.setdefault(echoarea, []).append(msgid + "\n")
+                search.append(self.search_line(msgid, message))
+                repto = Base.get_repto(message.tags)
+                if repto:
+                    replies.append("{} {}\n".format(msgid, repto))
+            if not search:
+                return 0
+            self.fsync_dir(self.path + "msg")
+            created = False
+            for echoarea, msgids in echoes.items():
+                filename = self.path + "echo/" + echoarea
+                created = created or not path.exists(filename)
+                self.append(filename, msgids)
+            if created:
+                self.fsync_dir(self.path + "echo")
+            self.append(self.path + "search.txt", search)
+            if replies:
+                self.append(self.path + "replies.txt", replies)
+            return len(search)
+
+    def save_message(self, echoarea: str, msgid: str,
+                     message: Union[str, Message],
                      other: object = None) -> bool:
         """
         Save message to base.
@@ -119,36 +335,28 @@ class Txt(Base):
         Args:
             echoarea (str): Echoarea name.
             msgid (str): Msgid.
-            message (str): Message as plain text.
+            message (str or Message): Message.
             other (object): Additional argument.
 
         Return:
             bool: Save status. True if message saved else False.
         """
-        if not self.is_message_exists(msgid):
-            open(self.path + "echo/" + echoarea, "a").write(msgid + "\n")
-            open(self.path + "msg/" + msgid, "w").write(message)
-            return True
-        return False
+        if not isinstance(message, Message):
+            message = Message(message, msgid)
+        return self.write_messages([(echoarea, msgid, message)]) == 1
 
-    def save_messages(self, bundle: List[Dict[str, str]]) -> int:
+    def save_messages(self, bundle: List[Message]) -> int:
         """
-        Save messages of bundle to base.
+        Save messages of bundle to base by one batch.
 
         Args:
-            bundle (List): Bundle as List of dict:
-                           {"msgid", "encoded"}.
+            bundle (List): Bundle as List of messages.
 
         Return:
             int: Saved messages count.
         """
-        saved_counter = 0
-        for message in bundle:
-            body = urlsafe_b64decode(message["encoded"]).decode("utf-8")
-            echoarea = body.split("\n")[1]
-            if self.save_message(echoarea, message["msgid"], body):
-                saved_counter += 1
-        return saved_counter
+        return self.write_messages([(message.echoarea, message.msgid,
+                                     message) for message in bundle])
 
     def toss_message(self, point: Dict[str, str], encoded: str) -> str:
         """
@@ -165,6 +373,478 @@ class Txt(Base):
         """
         return super().toss_message(self.save_message, point, encoded)
 
+    @staticmethod
+    def search_line(msgid: str, message: Message) -> str:
+        """
+        Build line of inverted index file.
+
+        Args:
+            msgid (str): Msgid.
+            message (Message): Message.
+
+        Return:
+            str: Line "msgid echoarea date word:count ...".
+        """
+        words = {}
+        text = message.subject + "\n" + message.body
+        for word in re.findall(r"\w+", text.lower()):
+            words[word] = words.get(word, 0) + 1
+        return "{} {} {} {}\n".format(
+            msgid, message.echoarea, message.date,
+            " ".join("{}:{}".format(*item) for item in words.items()))
+
+    def index_search_line(self, line: str):
+        """
+        Add line of inverted index file to loaded search index. Lines of
+        malformed messages are skipped.
+
+        Args:
+            line (str): Line "msgid echoarea date word:count ...".
+        """
+        fields = line.split()
+        if len(fields) < 3 or not fields[2].isdigit():
+            return
+        msgid = fields[0]
+        self.search_index["messages"][msgid] = (fields[1], int(fields[2]))
+        postings = self.search_index["postings"]
+        for field in fields[3:]:
+            word, _, count = field.rpartition(":")
+            if word and count.isdigit():
+                postings.setdefault(word, {})[msgid] = int(count)
+
+    @staticmethod
+    def read_appended(filename: str, mark: Tuple[int, int]) -> \
+            Tuple[Tuple[int, int], bool, List[str]]:
+        """
+        Read complete lines appended to index file since previous read.
+        File replaced or truncated since previous read is read from start.
+
+        Args:
+            filename (str): Filename.
+            mark (Tuple): (inode, offset) of previous read or None.
+
+        Return:
+            Tuple: New mark, True if file was read from start, and lines.
+        """
+        with open(filename, "rb") as f:
+            stat = fstat(f.fileno())
+            offset = 0
+            if mark and mark[0] == stat.st_ino and mark[1] <= stat.st_size:
+                offset = mark[1]
+            f.seek(offset)
+            data = f.read()
+        data = data[:data.rfind(b"\n") + 1]
+        lines = data.decode("utf-8", "replace").split("\n")[:-1]
+        return (stat.st_ino, offset + len(data)), offset == 0, lines
+
+    def load_search_index(self):
+        """
+        Load inverted index file to memory. Lines appended by other
+        processes since last load are added to loaded index, so running
+        server finds messages saved by fetcher.
+        """
+        with self.index_lock:
+            self.search_mark, reset, lines = self.read_appended(
+                self.path + "search.txt", self.search_mark)
+            if reset or self.search_index is None:
+                self.search_index = {"messages": {}, "postings": {}}
+            for line in lines:
+                self.index_search_line(line)
+
+    def search(self, query: str, echoarea: str = None, since: int = None,
+               until: int = None, limit: int = 20) -> List[Dict[str, str]]:
+        """
+        Full-text search of messages.
+
+        Args:
+            query (str): Search words.
+            echoarea (str, optional): Echoarea name filter.
+            since (int, optional): Minimal message date (unixtime).
+            until (int, optional): Maximal message date (unixtime).
+            limit (int, optional): Maximal results count.
+
+        Return:
+            List: Found messages ordered by rank as Dict:
+                  {"msgid", "snippet"}.
+        """
+        with self.index_lock:
+            self.load_search_index()
+            words = re.findall(r"\w+", query.lower())
+            if not words:
+                return []
+            messages = self.search_index["messages"]
+            postings = [self.search_index["postings"].get(word, {})
+                        for word in words]
+            postings.sort(key=len)
+            ranks = {}
+            for msgid in postings[0]:
+                if not all(msgid in posting for posting in postings[1:]):
+                    continue
+                msg_echoarea, date = messages[msgid]
+                if echoarea and msg_echoarea != echoarea:
+                    continue
+                if (since and date < since) or (until and date > until):
+                    continue
+                ranks[msgid] = sum(posting[msgid] *
+                                   log(1 + len(messages) / len(posting))
+                                   for posting in postings)
+        found = sorted(ranks, key=lambda x: ranks[x], reverse=True)
+        results = []
+        for msgid in found:
+            if not self.is_message_exists(msgid):
+                continue
+            body = self.get_message(msgid).split("\n", 8)[-1]
+            position = max(0, body.lower().find(words[0]))
+            start = max(0, position - 40)
+            snippet = body[start:position + 60].replace("\n", " ")
+            if start > 0:
+                snippet = "..." + snippet
+            if position + 60 < len(body):
+                snippet += "..."
+            results.append({"msgid": msgid, "snippet": snippet})
+            if len(results) >= limit:
+                break
+        return results
+
+    def rebuild_search_index(self):
+        """
+        Rebuild full-text search index of all messages.
+        """
+        with self.locked():
+            with open(self.path + "search.txt.tmp", "w") as f:
+                for echoarea in listdir(self.path + "echo"):
+                    for msgid in self.get_index([echoarea]):
+                        message = self.get_message(msgid)
+                        if message:
+                            f.write(self.search_line(msgid,
+                                                     Message(message)))
+            replace(self.path + "search.txt.tmp", self.path + "search.txt")
+            with self.index_lock:
+                self.search_index = None
+                self.search_mark = None
+
+    def add_reply(self, msgid: str, parent: str):
+        """
+        Add reply to loaded replies index.
+
+        Args:
+            msgid (str): Msgid of reply.
+            parent (str): Msgid of replied message.
+        """
+        self.replies["parents"][msgid] = parent
+        self.replies["children"].setdefault(parent, []).append(msgid)
+
+    def load_replies(self):
+        """
+        Load replies index to memory. Replies appended by other processes
+        since last load are added to loaded index.
+        """
+        with self.index_lock:
+            self.replies_mark, reset, lines = self.read_appended(
+                self.path + "replies.txt", self.replies_mark)
+            if reset or self.replies is None:
+                self.replies = {"parents": {}, "children": {}}
+            for line in lines:
+                fields = line.split()
+                if len(fields) == 2:
+                    self.add_reply(*fields)
+
+    def get_parent(self, msgid: str) -> str:
+        """
+        Get msgid of message to which message replies.
+
+        Args:
+            msgid (str): Msgid.
+
+        Return:
+            str: Parent msgid or None.
+        """
+        self.load_replies()
+        return self.replies["parents"].get(msgid)
+
+    def get_children(self, msgids: List[str]) -> List[str]:
+        """
+        Get msgids of replies to messages.
+
+        Args:
+            msgids (List): Parent msgids.
+
+        Return:
+            List: Msgids of replies in arrival order.
+        """
+        with self.index_lock:
+            self.load_replies()
+            children = []
+            for msgid in msgids:
+                children += [child for child in
+                             self.replies["children"].get(msgid, [])
+                             if self.is_message_exists(child)]
+        return children
+
+    def prune(self, echoarea: str, max_count: int = None,
+              max_age: int = None, batch: int = 500) -> int:
+        """
+        Delete oldest messages of echoarea by retention rules. Lines of
+        deleted messages are dropped from search and replies indexes
+        after last batch.
+
+        Args:
+            echoarea (str): Echoarea name.
+            max_count (int, optional): Maximal messages count.
+            max_age (int, optional): Maximal message age in seconds.
+            batch (int, optional): Messages deleted by one rewrite.
+
+        Return:
+            int: Deleted messages count.
+        """
+        deleted = set()
+        while True:
+            with self.locked():
+                expired = self.prune_batch(echoarea, max_count, max_age,
+                                           batch)
+            if not expired:
+                break
+            deleted.update(expired)
+        if deleted:
+            with self.locked():
+                self.compact_indexes(deleted)
+        return len(deleted)
+
+    def prune_batch(self, echoarea: str, max_count: int = None,
+                    max_age: int = None, batch: int = 500) -> List[str]:
+        """
+        Delete one batch of oldest messages of echoarea.
+
+        Args:
+            echoarea (str): Echoarea name.
+            max_count (int, optional): Maximal messages count.
+            max_age (int, optional): Maximal message age in seconds.
+            batch (int, optional): Messages deleted by one rewrite.
+
+        Return:
+            List: Msgids of deleted messages.
+        """
+        filename = self.path + "echo/" + echoarea
+        msgids = self.get_index([echoarea])
+        expired = 0
+        if max_count is not None and len(msgids) > max_count:
+            expired = len(msgids) - max_count
+        if max_age is not None:
+            self.load_search_index()
+            dates = self.search_index["messages"]
+            oldest = time() - max_age
+            while expired < len(msgids) and \
+                    dates.get(msgids[expired], (None, oldest))[1] < oldest:
+                expired += 1
+        expired = min(expired, batch)
+        if expired == 0:
+            return []
+        with open(filename + ".tmp", "w") as f:
+            f.write("".join(msgid + "\n" for msgid in msgids[expired:]))
+        replace(filename + ".tmp", filename)
+        for msgid in msgids[:expired]:
+            if self.is_message_exists(msgid):
+                remove(self.path + "msg/" + msgid)
+        return msgids[:expired]
+
+    def compact_indexes(self, msgids: Set[str]):
+        """
+        Rewrite search and replies indexes without lines of deleted
+        messages. Loaded indexes are reloaded by other processes because
+        files are replaced.
+
+        Args:
+            msgids (Set): Msgids of deleted messages.
+        """
+        for name in ("search.txt", "replies.txt"):
+            filename = self.path + name
+            with open(filename) as f, open(filename + ".tmp", "w") as tmp:
+                for line in f:
+                    if line.split(" ", 1)[0] not in msgids:
+                        tmp.write(line)
+                tmp.flush()
+                fsync(tmp.fileno())
+            replace(filename + ".tmp", filename)
+
+    def compress_messages(self, level: int) -> Dict[str, float]:
+        """
+        Compress or decompress all stored messages.
+
+        Args:
+            level (int): zlib compression level. 0 decompresses messages.
+
+        Return:
+            Dict: Statistics {"count", "before", "after",
+                  "compress_seconds", "decompress_seconds"}.
+        """
+        stats = {"count": 0, "before": 0, "after": 0,
+                 "compress_seconds": 0.0, "decompress_seconds": 0.0}
+        for msgid in listdir(self.path + "msg"):
+            if msgid.endswith(".tmp"):
+                continue
+            filename = self.path + "msg/" + msgid
+            with open(filename, "rb") as f:
+                stored = f.read()
+            data = Base.decompress(stored)
+            started = process_time()
+            compressed = Base.compress(data, level)
+            stats["compress_seconds"] += process_time() - started
+            started = process_time()
+            Base.decompress(compressed)
+            stats["decompress_seconds"] += process_time() - started
+            with open(filename + ".tmp", "wb") as f:
+                f.write(compressed)
+            replace(filename + ".tmp", filename)
+            stats["count"] += 1
+            stats["before"] += len(stored)
+            stats["after"] += len(compressed)
+        return stats
+
+    def load_sync(self) -> Dict[str, Dict]:
+        """
+        Load sync state from sync.json.
+
+        Return:
+            Dict: State {"cursors": {uplink: {echoarea: msgid}},
+                  "pending": {uplink: {msgid: [echoarea, attempts]}}}.
+        """
+        if not path.exists(self.path + "sync.json"):
+            return {"cursors": {}, "pending": {}}
+        with open(self.path + "sync.json") as f:
+            state = json.loads(f.read())
+        for pending in state["pending"].values():
+            for msgid, value in pending.items():
+                if isinstance(value, str):
+                    pending[msgid] = [value, 0]
+        return state
+
+    def save_sync(self, state: Dict[str, Dict]):
+        """
+        Atomically save sync state to sync.json. Must be called under
+        base lock together with loading of changed state.
+
+        Args:
+            state (Dict): Sync state.
+        """
+        with open(self.path + "sync.json.tmp", "w") as f:
+            f.write(json.dumps(state))
+        replace(self.path + "sync.json.tmp", self.path + "sync.json")
+
+    def get_sync_cursors(self, uplink: str) -> Dict[str, str]:
+        """
+        Sync cursors of uplink. Cursor is last remote msgid of echoarea
+        which messages before it are saved or pending.
+
+        Args:
+            uplink (str): Uplink URL.
+
+        Return:
+            Dict: Cursors {"echoarea": "msgid"}.
+        """
+        return self.load_sync()["cursors"].get(uplink, {})
+
+    def set_sync_cursor(self, uplink: str, echoarea: str, msgid: str):
+        """
+        Save sync cursor of uplink echoarea.
+
+        Args:
+            uplink (str): Uplink URL.
+            echoarea (str): Echoarea name.
+            msgid (str): Last confirmed remote msgid.
+        """
+        with self.locked():
+            state = self.load_sync()
+            cursors = state["cursors"].setdefault(uplink, {})
+            if cursors.get(echoarea) != msgid:
+                cursors[echoarea] = msgid
+                self.save_sync(state)
+
+    def get_sync_pending(self, uplink: str) -> Dict[str, List[str]]:
+        """
+        Msgids assigned for download from uplink but not saved yet.
+
+        Args:
+            uplink (str): Uplink URL.
+
+        Return:
+            Dict: Pending msgids of echoareas {"echoarea": List}.
+        """
+        pending = {}
+        state = self.load_sync()
+        for msgid, (echoarea, _) in state["pending"].get(uplink,
+                                                          {}).items():
+            pending.setdefault(echoarea, []).append(msgid)
+        return pending
+
+    def add_sync_pending(self, uplink: str, echoarea: str,
+                         msgids: List[str]):
+        """
+        Mark msgids as pending download from uplink.
+
+        Args:
+            uplink (str): Uplink URL.
+            echoarea (str): Echoarea name.
+            msgids (List): Msgids.
+        """
+        with self.locked():
+            state = self.load_sync()
+            pending = state["pending"].setdefault(uplink, {})
+            added = [msgid for msgid in msgids if msgid not in pending]
+            for msgid in added:
+                pending[msgid] = [echoarea, 0]
+            if added:
+                self.save_sync(state)
+
+    def remove_sync_pending(self, msgids: List[str]):
+        """
+        Unmark saved or rejected msgids as pending for all uplinks.
+
+        Args:
+            msgids (List): Msgids.
+        """
+        with self.locked():
+            state = self.load_sync()
+            removed = False
+            for pending in state["pending"].values():
+                for msgid in msgids:
+                    if pending.pop(msgid, None) is not None:
+                        removed = True
+            if removed:
+                self.save_sync(state)
+
+    def retry_sync_pending(self, uplink: str, echoareas: List[str],
+                           max_attempts: int) -> Dict[str, List[str]]:
+        """
+        Count new download attempt of msgids pending from uplink. Msgids
+        which were retried max_attempts times are unmarked.
+
+        Args:
+            uplink (str): Uplink URL.
+            echoareas (List): Echoareas names.
+            max_attempts (int): Maximal retries of msgid.
+
+        Return:
+            Dict: Pending msgids of echoareas {"echoarea": List}.
+        """
+        echoareas = set(echoareas)
+        result = {}
+        changed = False
+        with self.locked():
+            state = self.load_sync()
+            pending = state["pending"].get(uplink, {})
+            for msgid, item in list(pending.items()):
+                if item[0] not in echoareas:
+                    continue
+                changed = True
+                item[1] += 1
+                if item[1] > max_attempts:
+                    del pending[msgid]
+                else:
+                    result.setdefault(item[0], []).append(msgid)
+            if changed:
+                self.save_sync(state)
+        return result
+
     def search_point(self, username: str) -> bool:
         """
         Search point by username.
@@ -0,0 +1,124 @@
+"""
+Integrity verification of incoming bundles.
+"""
+
+from base.message import Message
+from base64 import b64decode
+from binascii import Error
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from typing import Dict, List, Tuple
+import atexit
+
+# Bundles smaller than this are verified in current process, because
+# process pool startup costs more than verification itself.
+PARALLEL_THRESHOLD = 1000
+
+# Process pools of current process by workers count. Pools are started
+# on first large bundle and reused until exit.
+pools = {}
+pools_lock = Lock()
+
+
+def get_pool(workers: int = None) -> ProcessPoolExecutor:
+    """
+    Shared process pool of current process.
+
+    Args:
+        workers (int, optional): Processes count. CPU count by default.
+
+    Return:
+        ProcessPoolExecutor: Pool.
+    """
+    with pools_lock:
+        if workers not in pools:
+            pools[workers] = ProcessPoolExecutor(workers)
+        return pools[workers]
+
+
+def drop_pool(workers: int = None):
+    """
+    Forget broken process pool, so next call starts new one.
+
+    Args:
+        workers (int, optional): Processes count.
+    """
+    with pools_lock:
+        pool = pools.pop(workers, None)
+    if pool:
+        pool.shutdown(wait=False)
+
+
+@atexit.register
+def shutdown_pools():
+    """
+    Stop all process pools on exit.
+    """
+    with pools_lock:
+        for pool in pools.values():
+            pool.shutdown()
+        pools.clear()
+
+
+def check_message(item: Tuple[str, str]) -> str:
+    """
+    Check base64 form, header structure and msgid of message.
+
+    Args:
+        item (Tuple): Msgid and urlsafe base64 encoded message.
+
+    Return:
+        str: Reject reason or empty string if message is correct.
+    """
+    msgid, encoded = item
+    try:
+        data = b64decode(encoded, b"-_", validate=True)
+        raw = data.decode("utf-8")
+    except UnicodeDecodeError:
+        return "wrong encoding"
+    except (Error, ValueError):
+        return "wrong base64"
+    message = Message(raw, msgid, data=data)
+    fields = raw.split("\n", 8)
+    if len(fields) < 8 or not fields[0].startswith("ii/") or \
+            not fields[1] or " " in fields[1] or not fields[2].isdigit():
+        return "wrong header"
+    if message.build_msgid() != msgid:
+        return "wrong msgid"
+    return ""
+
+
+def verify_bundle(bundle: List[Message], workers: int = None,
+                  threshold: int = PARALLEL_THRESHOLD
+                  ) -> Tuple[List[Message], Dict[str, str]]:
+    """
+    Verify messages of bundle. Large bundles are checked on shared
+    process pool across all cores.
+
+    Args:
+        bundle (List): Bundle as List of messages.
+        workers (int, optional): Processes count. CPU count by default.
+        threshold (int, optional): Minimal bundle size for process pool.
+
+    Return:
+        Tuple: Correct messages (List) and rejected msgids with reasons
+               (Dict) {"msgid": "reason"}.
+    """
+    items = [(message.msgid, message.encoded) for message in bundle]
+    if len(items) < threshold or workers == 1:
+        reasons = map(check_message, items)
+    else:
+        try:
+            reasons = list(get_pool(workers).map(check_message, items,
+                                                 chunksize=256))
+        except BrokenProcessPool:
+            drop_pool(workers)
+            reasons = map(check_message, items)
+    accepted, rejected = [], {}
+    for message, reason in zip(bundle, reasons):
+        if reason:
+            rejected[message.msgid] = reason
+        else:
+            accepted.append(message)
+    return accepted, rejected
@@ -1,7 +1,10 @@
 import json
+import signal
 import sys
 from idec.client import Client
-from base.sqlite import Sqlite
+from idec.scheduler import Scheduler
+from base.backends import open_base
+from threading import Event
 from typing import Dict, List, Union
 from idec.uplink import Uplink
 
@@ -11,12 +14,76 @@ def load_config(filename: str = "fetcher.json") -> Dict[str,
     return json.loads(open(filename).read())
 
 
+def print_rejected(client: Client):
+    """
+    Print messages rejected by verification on last download.
+
+    Args:
+        client (Client): IDEC-client.
+    """
+    for msgid, reason in client.rejected.items():
+        print("rejected {}: {}".format(msgid, reason))
+
+
+def daemon(client: Client, scheduler: Scheduler):
+    """
+    Poll uplink by schedule until SIGINT or SIGTERM.
+
+    Args:
+        client (Client): IDEC-client.
+        scheduler (Scheduler): Echoareas polling schedule.
+    """
+    stop = Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    while not stop.is_set():
+        due = scheduler.due()
+        if due:
+            try:
+                counts = client.poll_counts(due)
+                merged = client.merge_counts(counts)
+                scheduler.update({echoarea: merged.get(echoarea, 0)
+                                  for echoarea in due})
+                saved = client.download_mail(due, counts)
+                if saved > 0:
+                    print(saved, "messages downloaded.")
+                print_rejected(client)
+                if client.incomplete:
+                    scheduler.failed(sorted(client.incomplete))
+            except Exception as e:
+                print("fetch error:", e)
+                scheduler.failed(due)
+        stop.wait(scheduler.sleep_time())
+
+
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        config = load_config(sys.argv[1])
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("-")]
+    if len(args) > 0:
+        config = load_config(args[0])
     else:
         config = load_config()
-    base = Sqlite(config["base"])
-    uplink = Uplink(config["uplink"])
-    client = Client(uplink, base, config["echoareas"])
-    print(client.download_mail(), "messages downloaded.")
+    base = open_base(config)
+    trusted = config.get("trusted", [])
+    if "uplinks" in config:
+        uplinks = [Uplink(url, trusted=url in trusted)
+                   for url in config["uplinks"]]
+    else:
+        uplinks = [Uplink(config["uplink"],
+                          trusted=config["uplink"] in trusted)]
+    client = Client(uplinks, base, config["echoareas"])
+    if "-d" in sys.argv:
+        schedule = config.get("daemon", {})
+        daemon(client, Scheduler(config["echoareas"], **schedule))
+    else:
+        print(client.download_mail(), "messages downloaded.")
+        print("Stages: " + ", ".join("{} {:.3f}s".format(*timing)
+                                     for timing in client.timings.items()))
+        if "-r" in sys.argv:
+            print(client.sync_digests(), "messages resynced.")
+        print_rejected(client)
+        if len(uplinks) > 1:
+            for url, stats in client.get_stats().items():
+                print("{}: latency {:.3f}s, errors {}, hits {} ({:.0%}), "
+                      "rejected {}".format(url, stats["latency"],
+                                           stats["errors"], stats["hits"],
+                                           stats["share"], stats["rejected"]))
@@ -0,0 +1,135 @@
+"""
+Admission control of server requests.
+"""
+
+from threading import BoundedSemaphore, Lock
+from time import monotonic
+from typing import Dict
+
+# Buckets count after which idle client buckets are dropped.
+MAX_CLIENTS = 10000
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Bucket is refilled by rate tokens per second
+    up to burst tokens, every request takes one token.
+
+    Args:
+        rate (float): Tokens per second.
+        burst (int): Bucket capacity.
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+
+    def refill(self):
+        """
+        Add tokens accumulated since last update.
+        """
+        now = monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> bool:
+        """
+        Take one token.
+
+        Return:
+            bool: False if bucket is empty.
+        """
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def is_full(self) -> bool:
+        """
+        Check bucket is refilled, so client is idle.
+
+        Return:
+            bool: True if bucket is full.
+        """
+        self.refill()
+        return self.tokens >= self.burst
+
+
+class Admission:
+    """
+    Limits requests rate of every client by token buckets and count of
+    concurrently processed requests of every endpoints class by
+    semaphores. Request waits for free slot of its class not longer than
+    timeout, so overloaded server answers quickly instead of queueing
+    requests without bound.
+
+    Args:
+        rate (float, optional): Requests per second of one client. 0
+                                disables rate limiting.
+        burst (int, optional): Maximal requests burst of one client.
+        concurrency (Dict, optional): Concurrently processed requests of
+                                      endpoints classes {"class": int}.
+                                      Other classes are not limited.
+        timeout (float, optional): Maximal waiting time of free slot in
+                                   seconds.
+    """
+    def __init__(self, rate: float = 0, burst: int = 1,
+                 concurrency: Dict[str, int] = None, timeout: float = 1.0):
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.lock = Lock()
+        self.buckets = {}
+        self.slots = {cls: BoundedSemaphore(count)
+                      for cls, count in (concurrency or {}).items()}
+
+    def allow(self, client: str) -> bool:
+        """
+        Take token from client bucket.
+
+        Args:
+            client (str): Client address.
+
+        Return:
+            bool: False if client exceeded requests rate.
+        """
+        if not self.rate:
+            return True
+        with self.lock:
+            if client not in self.buckets and \
+                    len(self.buckets) >= MAX_CLIENTS:
+                self.buckets = {key: bucket
+                                for key, bucket in self.buckets.items()
+                                if not bucket.is_full()}
+            bucket = self.buckets.get(client)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self.buckets[client] = bucket
+            return bucket.take()
+
+    def acquire(self, cls: str) -> bool:
+        """
+        Wait for free slot of endpoints class.
+
+        Args:
+            cls (str): Endpoints class.
+
+        Return:
+            bool: False if no slot was freed during timeout.
+        """
+        if cls not in self.slots:
+            return True
+        return self.slots[cls].acquire(timeout=self.timeout)
+
+    def release(self, cls: str):
+        """
+        Free slot of endpoints class.
+
+        Args:
+            cls (str): Endpoints class.
+        """
+        if cls in self.slots:
+            self.slots[cls].release()
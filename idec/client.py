@@ -3,15 +3,63 @@ IDEC-client class.
 """
 
 from base.base import Base
-from typing import List
+from base.digest import DEPTH, LEAF_SIZE, DigestIndex
+from base.message import Message
+from base.verify import verify_bundle
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from time import time
+from typing import Dict, List, Tuple, Union
 from idec.uplink import Uplink
 
+STAGES = ("index", "download", "verify", "write")
+# Msgids count of one download block.
+BLOCK_SIZE = 120
+DOWNLOAD_WORKERS = 4
+# Blocks waiting between two stages.
+QUEUE_SIZE = 16
+# Minimal messages count of one base transaction.
+WRITE_BATCH = 500
+# Seconds between checks of pipeline stop flag by blocked stages.
+POLL_INTERVAL = 0.1
+# Runs which retry pending msgids before they are dropped.
+PENDING_ATTEMPTS = 5
+
 
 class Client:
-    def __init__(self, uplink: Uplink, base: Base, echoareas: List[str] = None):
-        self.uplink = uplink
+    """
+    IDEC-client. Fetches echomail from one or several uplinks.
+
+    Args:
+        uplinks (Uplink or List): Uplink or list of uplinks. First uplink
+                                  is used for sending and pushing messages.
+        base (Base): Messages base.
+        echoareas (List, optional): Subscribed echoareas.
+    """
+    def __init__(self, uplinks: Union[Uplink, List[Uplink]], base: Base,
+                 echoareas: List[str] = None):
+        if isinstance(uplinks, Uplink):
+            uplinks = [uplinks]
+        self.uplinks = uplinks
+        self.uplink = uplinks[0]
         self.base = base
         self.echoareas = echoareas
+        self.stats = {}
+        self.rejected = {}
+        self.incomplete = set()
+        self.timings = {stage: 0.0 for stage in STAGES}
+        self.lock = Lock()
+        self.stopped = Event()
+        self.digests = None
+        self.synced = {}
+        for uplink in uplinks:
+            self.stats[uplink.url] = {
+                "latency": 0.0,
+                "errors": 0,
+                "hits": 0,
+                "rejected": 0
+            }
 
     def add_echoarea(self, echoarea: str):
         """
@@ -56,29 +104,679 @@ class Client:
         """
         Calculate offset for index requests depth.
         """
-        remote_counts = self.uplink.get_counts(self.echoareas)
-        local_counts = self.base.get_counts(self.echoareas)
+        return self.get_depth(self.echoareas)
+
+    def get_depth(self, echoareas: List[str],
+                  remote_counts: Dict[str, int] = None) -> int:
+        """
+        Calculate index requests depth for echoareas.
+
+        Args:
+            echoareas (List): Echoareas names.
+            remote_counts (Dict, optional): Already downloaded uplink counts.
+
+        Return:
+            int: Maximal difference between uplink and local counts.
+        """
+        if remote_counts is None:
+            remote_counts = self.uplink.get_counts(echoareas)
+        local_counts = self.base.get_counts(echoareas)
         maximum = 0
         for key in local_counts.keys():
-            if remote_counts[key] > local_counts[key]:
+            if remote_counts.get(key, 0) > local_counts[key]:
                 current = remote_counts[key] - local_counts[key]
                 if current > maximum:
                     maximum = current
         return maximum
 
-    def download_mail(self) -> int:
+    def poll_counts(self, echoareas: List[str]) -> Dict[Uplink,
+                                                         Dict[str, int]]:
+        """
+        Concurrently downloads echoareas counts from all uplinks and
+        measures uplinks latency.
+
+        Args:
+            echoareas (List): Echoareas names.
+
+        Return:
+            Dict: Counts of every available uplink {Uplink: {"name": int}}.
+        """
+        def poll(uplink: Uplink):
+            started = time()
+            counts = uplink.get_counts(echoareas)
+            return uplink, counts, time() - started
+
+        counts, error = {}, None
+        with ThreadPoolExecutor(len(self.uplinks)) as executor:
+            futures = [executor.submit(poll, uplink)
+                       for uplink in self.uplinks]
+            for future in futures:
+                try:
+                    uplink, uplink_counts, latency = future.result()
+                except OSError as e:
+                    error = e
+                    continue
+                stats = self.stats[uplink.url]
+                if stats["latency"]:
+                    latency = stats["latency"] * 0.7 + latency * 0.3
+                stats["latency"] = latency
+                counts[uplink] = uplink_counts
+        for uplink in self.uplinks:
+            if uplink not in counts:
+                self.stats[uplink.url]["errors"] += 1
+        if not counts and error:
+            raise error
+        return counts
+
+    @staticmethod
+    def merge_counts(counts: Dict[Uplink, Dict[str, int]]) -> Dict[str, int]:
         """
-        Download echomail and save it to messages base.
+        Merge counts of several uplinks.
+
+        Args:
+            counts (Dict): Counts of uplinks {Uplink: {"name": int}}.
+
+        Return:
+            Dict: Maximal count of every echoarea {"name": int}.
+        """
+        merged = {}
+        for uplink_counts in counts.values():
+            for echoarea, count in uplink_counts.items():
+                merged[echoarea] = max(count, merged.get(echoarea, 0))
+        return merged
+
+    @staticmethod
+    def get_new_index(uplink: Uplink, echoareas: List[str],
+                      marks: Dict[str, str], depth: int) -> List[str]:
+        """
+        Downloads uplink msgids added after last local messages. Falls back
+        to index tail when uplink does not support x/since/.
+
+        Args:
+            uplink (Uplink): Uplink.
+            echoareas (List): Echoareas names.
+            marks (Dict): Last local msgid of echoareas {"name": "msgid"}.
+            depth (int): Index tail depth for fallback.
+
+        Return:
+            List: Msgids.
+        """
+        index = uplink.get_index_since({echoarea: marks[echoarea]
+                                        for echoarea in echoareas})
+        if index is None:
+            return uplink.get_index(echoareas, depth)
+        msgids = []
+        for echoarea in echoareas:
+            msgids += index.get(echoarea, [])
+        return msgids
+
+    def download_mail(self, echoareas: List[str] = None,
+                      counts: Dict[Uplink, Dict[str, int]] = None) -> int:
+        """
+        Download echomail and save it to messages base. Every missing
+        message is downloaded once from the fastest uplink which has it.
+        Messages from untrusted uplinks are verified before saving, rejected
+        ones are stored in rejected attribute {"msgid": "reason"}.
+        Echoareas which index or messages were not downloaded because of
+        uplink errors are stored in incomplete attribute.
+
+        Indexes fetching, blocks downloading, verification and writing to
+        base run as pipeline stages connected by bounded queues, so
+        network and base work overlap. Busy time of every stage is stored
+        in timings attribute {"stage": seconds}.
+
+        Sync cursors and pending msgids of every uplink are persisted in
+        base, so interrupted or partially failed fetching resumes from the
+        last confirmed remote index position and retries only msgids which
+        were not saved, at most PENDING_ATTEMPTS times. Echoareas of
+        uplink are fetched when their counts changed since last complete
+        sync with this uplink, counts are stored in synced attribute
+        {"url": {"name": int}}.
+
+        Args:
+            echoareas (List, optional): Echoareas names. All subscribed
+                                        echoareas by default.
+            counts (Dict, optional): Already polled uplinks counts.
 
         Return:
             int: Saved messages count.
         """
-        depth = self.index_offset
-        if depth > 0:
-            index = self.uplink.get_index(self.echoareas, depth)
-            bundle = self.uplink.get_bundle(index)
-            return self.base.save_messages(bundle)
-        return 0
+        if echoareas is None:
+            echoareas = self.echoareas
+        if counts is None:
+            counts = self.poll_counts(echoareas)
+        uplinks = sorted(counts.keys(),
+                         key=lambda x: self.stats[x.url]["latency"])
+        self.rejected = {}
+        self.incomplete = set()
+        behind = {}
+        pending = {}
+        for uplink in uplinks:
+            synced = self.synced.get(uplink.url, {})
+            behind[uplink] = [echoarea for echoarea in echoareas
+                              if counts[uplink].get(echoarea, 0) !=
+                              synced.get(echoarea, 0)]
+            pending[uplink] = self.base.retry_sync_pending(
+                uplink.url, echoareas, PENDING_ATTEMPTS)
+            if not behind[uplink]:
+                del behind[uplink]
+        if not behind and not any([echoarea in pending[uplink]
+                                   for uplink in uplinks
+                                   for echoarea in echoareas]):
+            return 0
+        self.timings = {stage: 0.0 for stage in STAGES}
+        self.stopped = Event()
+        downloads = Queue(QUEUE_SIZE)
+        downloaded = Queue(QUEUE_SIZE)
+        verified = Queue(QUEUE_SIZE)
+        workers = [Thread(target=self.index_stage,
+                          args=(downloads, echoareas, uplinks, behind,
+                                pending, counts))]
+        workers += [Thread(target=self.download_stage,
+                           args=(downloads, downloaded))
+                     for _ in range(DOWNLOAD_WORKERS)]
+        workers.append(Thread(target=self.verify_stage,
+                              args=(downloaded, verified)))
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            saved = self.write_stage(verified)
+        finally:
+            self.stopped.set()
+            for queue in (downloads, downloaded, verified):
+                self.drain(queue)
+            for worker in workers:
+                worker.join()
+        for uplink in behind:
+            synced = self.synced.setdefault(uplink.url, {})
+            for echoarea in behind[uplink]:
+                if echoarea not in self.incomplete:
+                    synced[echoarea] = counts[uplink].get(echoarea, 0)
+        return saved
+
+    def get_new_depth(self, uplink: Uplink, echoarea: str,
+                      count: int) -> int:
+        """
+        Calculate index tail depth which contains messages added to
+        echoarea of uplink since last sync. Whole index is requested if
+        echoarea was not synced yet or its count decreased.
+
+        Args:
+            uplink (Uplink): Uplink.
+            echoarea (str): Echoarea name.
+            count (int): Current uplink count of echoarea.
+
+        Return:
+            int: Index depth.
+        """
+        last = self.synced.get(uplink.url, {}).get(echoarea, 0)
+        if count > last:
+            return count - last
+        return count
+
+    def put(self, queue: Queue, item: object) -> bool:
+        """
+        Put item to pipeline queue waiting for free place until pipeline
+        is stopped.
+
+        Args:
+            queue (Queue): Queue.
+            item (object): Item.
+
+        Return:
+            bool: False if pipeline was stopped.
+        """
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except Full:
+                continue
+        return False
+
+    def take(self, queue: Queue) -> object:
+        """
+        Get item from pipeline queue waiting for it until pipeline is
+        stopped.
+
+        Args:
+            queue (Queue): Queue.
+
+        Return:
+            object: Item or None if pipeline was stopped.
+        """
+        while not self.stopped.is_set():
+            try:
+                return queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                continue
+        return None
+
+    @staticmethod
+    def drain(queue: Queue):
+        """
+        Drop all items of queue, so stages blocked on it are released.
+
+        Args:
+            queue (Queue): Queue.
+        """
+        while True:
+            try:
+                queue.get_nowait()
+            except Empty:
+                return
+
+    def timed(self, stage: str, started: float):
+        """
+        Add time spent by stage since started.
+
+        Args:
+            stage (str): Stage name.
+            started (float): Start time.
+        """
+        with self.lock:
+            self.timings[stage] += time() - started
+
+    def index_stage(self, downloads: Queue, echoareas: List[str],
+                    uplinks: List[Uplink], behind: Dict[Uplink, List[str]],
+                    pending: Dict[Uplink, Dict[str, List[str]]],
+                    counts: Dict[Uplink, Dict[str, int]]):
+        """
+        Pipeline stage. Downloads new msgids of echoareas from uplinks
+        concurrently and puts blocks of missing msgids to downloads queue
+        as soon as echoarea indexes are received. Every missing msgid is
+        assigned to the fastest uplink which has it. Other uplinks which
+        have msgids of block are its fallbacks.
+
+        Msgids pending from previous runs are queued first. Assigned
+        msgids are stored as pending before uplink sync cursor is moved to
+        the end of received index.
+
+        Args:
+            downloads (Queue): Queue of (echoarea, number, uplinks, msgids)
+                               blocks, where uplinks are ordered by
+                               priority.
+            echoareas (List): Echoareas names.
+            uplinks (List): Uplinks ordered by latency.
+            behind (Dict): Echoareas of uplinks with new messages.
+            pending (Dict): Pending msgids of uplinks echoareas.
+            counts (Dict): Uplinks counts.
+        """
+        try:
+            with ThreadPoolExecutor(max(len(behind), 1)) as executor:
+                indexes = {}
+                for echoarea in echoareas:
+                    for uplink in uplinks:
+                        if echoarea in behind.get(uplink, []):
+                            indexes[(uplink, echoarea)] = executor.submit(
+                                self.get_echoarea_index, uplink, echoarea,
+                                self.get_new_depth(uplink, echoarea,
+                                                   counts[uplink][echoarea]))
+                for echoarea in echoareas:
+                    started = time()
+                    local = set(self.base.get_index([echoarea]))
+                    assigned = {uplink: [] for uplink in uplinks}
+                    saved = []
+                    for uplink in uplinks:
+                        for msgid in pending[uplink].get(echoarea, []):
+                            if msgid in local:
+                                saved.append(msgid)
+                            else:
+                                local.add(msgid)
+                                assigned[uplink].append(msgid)
+                    if saved:
+                        self.base.remove_sync_pending(saved)
+                    indexed = {}
+                    for uplink in uplinks:
+                        if (uplink, echoarea) in indexes:
+                            index = indexes[(uplink, echoarea)].result()
+                        else:
+                            index = []
+                        indexed[uplink] = set(index)
+                        msgids = []
+                        for msgid in index:
+                            if msgid not in local:
+                                local.add(msgid)
+                                msgids.append(msgid)
+                        if msgids:
+                            self.base.add_sync_pending(uplink.url, echoarea,
+                                                       msgids)
+                        if index:
+                            self.base.set_sync_cursor(uplink.url, echoarea,
+                                                      index[-1])
+                        assigned[uplink] += msgids
+                    self.timed("index", started)
+                    number = 0
+                    for uplink in uplinks:
+                        for block in uplink.split(assigned[uplink],
+                                                  BLOCK_SIZE):
+                            candidates = [uplink] + [
+                                other for other in uplinks
+                                if other is not uplink and
+                                any(msgid in indexed[other]
+                                    for msgid in block)]
+                            if not self.put(downloads, (echoarea, number,
+                                                        candidates, block)):
+                                return
+                            number += 1
+                    started = time()
+        finally:
+            for _ in range(DOWNLOAD_WORKERS):
+                self.put(downloads, None)
+
+    def get_echoarea_index(self, uplink: Uplink, echoarea: str,
+                           depth: int) -> List[str]:
+        """
+        Downloads new msgids of echoarea from uplink after its sync
+        cursor or after last local message if there is no cursor yet.
+
+        Args:
+            uplink (Uplink): Uplink.
+            echoarea (str): Echoarea name.
+            depth (int): Index tail depth for fallback.
+
+        Return:
+            List: Msgids or empty list on network error.
+        """
+        mark = self.base.get_sync_cursors(uplink.url).get(echoarea)
+        if mark is None:
+            local = self.base.get_index([echoarea])
+            mark = local[-1] if local else "0"
+        try:
+            return self.get_new_index(uplink, [echoarea], {echoarea: mark},
+                                      depth)
+        except OSError:
+            with self.lock:
+                self.stats[uplink.url]["errors"] += 1
+                self.incomplete.add(echoarea)
+            return []
+
+    def download_stage(self, downloads: Queue, downloaded: Queue):
+        """
+        Pipeline stage. Downloads blocks of messages. Msgids which were not
+        received from uplink because of error or absence are requested
+        from the next uplink of block.
+
+        Args:
+            downloads (Queue): Queue of msgids blocks.
+            downloaded (Queue): Queue of (echoarea, number, parts)
+                                downloaded blocks, where parts are
+                                (uplink, messages) tuples.
+        """
+        try:
+            while True:
+                item = self.take(downloads)
+                if item is None:
+                    return
+                echoarea, number, uplinks, msgids = item
+                started = time()
+                parts = []
+                for uplink in uplinks:
+                    try:
+                        bundle = uplink.get_bundle(msgids)
+                    except OSError:
+                        with self.lock:
+                            self.stats[uplink.url]["errors"] += 1
+                        continue
+                    parts.append((uplink, bundle))
+                    received = {message.msgid for message in bundle}
+                    msgids = [msgid for msgid in msgids
+                              if msgid not in received]
+                    if not msgids:
+                        break
+                if msgids:
+                    with self.lock:
+                        self.incomplete.add(echoarea)
+                self.timed("download", started)
+                if not self.put(downloaded, (echoarea, number, parts)):
+                    return
+        finally:
+            self.put(downloaded, None)
+
+    def verify_stage(self, downloaded: Queue, verified: Queue):
+        """
+        Pipeline stage. Verifies messages of untrusted uplinks.
+
+        Args:
+            downloaded (Queue): Queue of downloaded blocks.
+            verified (Queue): Queue of (echoarea, number, messages) blocks.
+        """
+        finished = 0
+        try:
+            while finished < DOWNLOAD_WORKERS:
+                item = self.take(downloaded)
+                if item is None:
+                    if self.stopped.is_set():
+                        return
+                    finished += 1
+                    continue
+                echoarea, number, parts = item
+                started = time()
+                bundle = []
+                for uplink, part in parts:
+                    bundle += self.verify(uplink, part)
+                self.timed("verify", started)
+                if not self.put(verified, (echoarea, number, bundle)):
+                    return
+        finally:
+            self.put(verified, None)
+
+    def write_stage(self, verified: Queue) -> int:
+        """
+        Pipeline stage. Saves verified blocks to base by batches. Blocks
+        of every echoarea are saved in order of its index. Saved and
+        rejected msgids are removed from pending ones.
+
+        Args:
+            verified (Queue): Queue of verified blocks.
+
+        Return:
+            int: Saved messages count.
+        """
+        saved = 0
+        pending = {}
+        following = {}
+        batch = []
+        while True:
+            item = self.take(verified)
+            if item is None:
+                break
+            echoarea, number, bundle = item
+            pending[(echoarea, number)] = bundle
+            number = following.get(echoarea, 0)
+            while (echoarea, number) in pending:
+                batch += pending.pop((echoarea, number))
+                number += 1
+            following[echoarea] = number
+            if len(batch) >= WRITE_BATCH or batch and verified.empty():
+                saved += self.write_batch(batch)
+                batch = []
+        if batch:
+            saved += self.write_batch(batch)
+        if self.rejected:
+            self.base.remove_sync_pending(list(self.rejected.keys()))
+        return saved
+
+    def write_batch(self, batch: List[Message]) -> int:
+        """
+        Save messages to base and remove them from pending ones.
+
+        Args:
+            batch (List): Messages.
+
+        Return:
+            int: Saved messages count.
+        """
+        started = time()
+        saved = self.base.save_messages(batch)
+        self.base.remove_sync_pending([message.msgid for message in batch])
+        self.timed("write", started)
+        return saved
+
+    def get_bundle(self, uplink: Uplink, msgids: List[str]) -> List[Message]:
+        """
+        Download messages from uplink and verify them if uplink is not
+        trusted. Errors and rejects are counted in uplink stats.
+
+        Args:
+            uplink (Uplink): Uplink.
+            msgids (List): Msgids.
+
+        Return:
+            List: Correct messages.
+        """
+        try:
+            bundle = uplink.get_bundle(msgids)
+        except OSError:
+            self.stats[uplink.url]["errors"] += 1
+            return []
+        return self.verify(uplink, bundle)
+
+    def verify(self, uplink: Uplink, bundle: List[Message]) -> List[Message]:
+        """
+        Verify messages if uplink is not trusted. Rejects are counted in
+        uplink stats.
+
+        Args:
+            uplink (Uplink): Uplink.
+            bundle (List): Downloaded messages.
+
+        Return:
+            List: Correct messages.
+        """
+        if not uplink.trusted:
+            bundle, rejected = verify_bundle(bundle)
+            self.stats[uplink.url]["rejected"] += len(rejected)
+            self.rejected.update(rejected)
+        self.stats[uplink.url]["hits"] += len(bundle)
+        return bundle
+
+    def find_missing(self, uplink: Uplink, echoarea: str,
+                     count: int) -> List[str]:
+        """
+        Find msgids of uplink echoarea missing in local base by descending
+        digests tree one level per round. Every round requests children of
+        all diverged buckets at once, and msgids of all diverged buckets
+        which are leaves or have not more than LEAF_SIZE messages at once.
+
+        Args:
+            uplink (Uplink): Uplink.
+            echoarea (str): Echoarea name.
+            count (int): Uplink messages count of echoarea.
+
+        Return:
+            List: Missing msgids.
+        """
+        diverged = {"": count}
+        missing = []
+        while diverged:
+            small = [prefix for prefix, size in diverged.items()
+                     if len(prefix) == DEPTH or size <= LEAF_SIZE]
+            large = [prefix for prefix in diverged if prefix not in small]
+            if small:
+                local = self.digests.msgids(echoarea, small)
+                missing += [msgid for msgid in
+                            uplink.get_digest_msgids(echoarea, small)
+                            if msgid not in local]
+            diverged = {}
+            if large:
+                local = self.digests.children(echoarea, large)
+                remote = uplink.get_digest_children(echoarea, large)
+                diverged = {child: value[0]
+                            for child, value in remote.items()
+                            if local.get(child) != value}
+        return missing
+
+    def sync_digests(self, echoareas: List[str] = None) -> int:
+        """
+        Download messages missing in local base from echoareas which
+        digests differ from uplink ones, even if counts are equal.
+
+        Args:
+            echoareas (List, optional): Echoareas names. All subscribed
+                                        echoareas by default.
+
+        Return:
+            int: Saved messages count.
+        """
+        if echoareas is None:
+            echoareas = self.echoareas
+        if self.digests is None:
+            self.digests = DigestIndex(self.base)
+        saved = 0
+        for uplink in self.uplinks:
+            try:
+                remote = uplink.get_digests(echoareas)
+            except OSError:
+                self.stats[uplink.url]["errors"] += 1
+                continue
+            if remote is None:
+                continue
+            for echoarea in echoareas:
+                if remote.get(echoarea, (0, 0)) == \
+                        self.digests.get(echoarea):
+                    continue
+                try:
+                    missing = self.find_missing(
+                        uplink, echoarea, remote.get(echoarea, (0, 0))[0])
+                except OSError:
+                    self.stats[uplink.url]["errors"] += 1
+                    continue
+                for block in uplink.split(missing, 1000):
+                    saved += self.base.save_messages(
+                        self.get_bundle(uplink, block))
+        return saved
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Uplinks statistics.
+
+        Return:
+            Dict: Stats of every uplink {"url": {"latency", "errors",
+                  "hits", "rejected", "share"}}, where share is part of
+                  messages downloaded from uplink.
+        """
+        total = sum([stats["hits"] for stats in self.stats.values()])
+        result = {}
+        for url, stats in self.stats.items():
+            result[url] = dict(stats)
+            result[url]["share"] = stats["hits"] / total if total else 0.0
+        return result
+
+    def push_mail(self, auth: str) -> Tuple[int, Dict[str, str]]:
+        """
+        Push local messages missing on uplink (u/push).
+
+        Args:
+            auth (str): Node authstr.
+
+        Return:
+            Tuple: Pushed messages count and errors of echoareas as Dict
+                   {"name": "status"}.
+        """
+        remote_counts = self.uplink.get_counts(self.echoareas)
+        local_counts = self.base.get_counts(self.echoareas)
+        pushed = 0
+        errors = {}
+        for echoarea in self.echoareas:
+            depth = local_counts[echoarea]
+            if depth <= remote_counts.get(echoarea, 0):
+                continue
+            remote_index = set(self.uplink.get_index([echoarea], depth))
+            missing = [msgid for msgid in self.base.get_index([echoarea])
+                       if msgid not in remote_index]
+            for block in self.uplink.split(missing, 100):
+                bundle = []
+                for msgid in block:
+                    message = Message(self.base.get_message(msgid), msgid)
+                    bundle.append(msgid + ":" + message.encoded)
+                status = self.uplink.push(auth, "\n".join(bundle), echoarea)
+                if status.startswith("error"):
+                    errors[echoarea] = status
+                else:
+                    pushed += len(block)
+        return pushed, errors
 
     def send_message(self, message: str):
         """
@@ -0,0 +1,158 @@
+"""
+Read-through fetching of missing messages from uplink.
+"""
+
+from base.base import Base
+from base.verify import verify_bundle
+from threading import Event, Lock
+from time import time
+from typing import List
+from idec.uplink import Uplink
+
+# Misses count after which expired ones are dropped.
+MAX_MISSES = 100000
+
+
+class Proxy:
+    """
+    Fetches messages missing in base from uplink on demand and saves them
+    to base. Concurrent requests of one msgid are coalesced, so message is
+    downloaded only once. Msgids not found on uplink are not requested
+    again during miss_ttl, and one request fetches at most max_fetch
+    msgids, so clients cannot amplify requests to uplink.
+
+    Args:
+        base (Base): Messages base.
+        uplink (Uplink): Uplink with full messages base.
+        echoareas (List, optional): Echoareas allowed to save. All
+                                    echoareas by default.
+        timeout (float, optional): Maximal waiting time of message
+                                   fetched by another request in seconds.
+        miss_ttl (float, optional): Seconds during which msgid not found
+                                    on uplink is not requested again.
+        max_fetch (int, optional): Maximal msgids count fetched from
+                                   uplink by one request.
+    """
+    def __init__(self, base: Base, uplink: Uplink,
+                 echoareas: List[str] = None, timeout: float = 10.0,
+                 miss_ttl: float = 300.0, max_fetch: int = 100):
+        self.base = base
+        self.uplink = uplink
+        self.echoareas = echoareas
+        self.timeout = timeout
+        self.miss_ttl = miss_ttl
+        self.max_fetch = max_fetch
+        self.lock = Lock()
+        self.pending = {}
+        self.misses = {}
+
+    def is_missed(self, msgid: str, now: float) -> bool:
+        """
+        Check msgid was recently not found on uplink.
+
+        Args:
+            msgid (str): Msgid.
+            now (float): Current timestamp.
+
+        Return:
+            bool: True if msgid should not be requested now.
+        """
+        return self.misses.get(msgid, 0) > now
+
+    def add_misses(self, msgids: List[str]):
+        """
+        Remember msgids not found on uplink.
+
+        Args:
+            msgids (List): Msgids.
+        """
+        now = time()
+        with self.lock:
+            if len(self.misses) + len(msgids) > MAX_MISSES:
+                self.misses = {msgid: expires
+                               for msgid, expires in self.misses.items()
+                               if expires > now}
+            if len(self.misses) + len(msgids) > MAX_MISSES:
+                self.misses = {}
+            for msgid in msgids:
+                self.misses[msgid] = now + self.miss_ttl
+
+    def fetch(self, msgids: List[str]) -> int:
+        """
+        Download missing messages from uplink and save them to base.
+        Returns when messages are saved or fetch is failed.
+
+        Args:
+            msgids (List): Msgids.
+
+        Return:
+            int: Saved messages count.
+        """
+        now = time()
+        missing = [msgid for msgid in msgids if Base.is_msgid(msgid) and
+                   not self.is_missed(msgid, now) and
+                   not self.base.is_message_exists(msgid)]
+        missing = missing[:self.max_fetch]
+        if not missing:
+            return 0
+        own, foreign = [], []
+        with self.lock:
+            for msgid in missing:
+                if msgid in self.pending:
+                    foreign.append(self.pending[msgid])
+                else:
+                    self.pending[msgid] = Event()
+                    own.append(msgid)
+        saved = 0
+        try:
+            if own:
+                saved = self.download(own)
+        finally:
+            with self.lock:
+                for msgid in own:
+                    self.pending.pop(msgid).set()
+        for event in foreign:
+            event.wait(self.timeout)
+        return saved
+
+    def download(self, msgids: List[str]) -> int:
+        """
+        Download messages from uplink, verify and save them to base.
+        Msgids not returned by uplink are remembered as misses.
+
+        Args:
+            msgids (List): Msgids.
+
+        Return:
+            int: Saved messages count.
+        """
+        try:
+            bundle = self.uplink.get_bundle(msgids)
+        except OSError:
+            return 0
+        if not self.uplink.trusted:
+            bundle, _ = verify_bundle(bundle)
+        wanted = set(msgids)
+        bundle = [message for message in bundle
+                  if message.msgid in wanted and
+                  (self.echoareas is None or
+                   message.echoarea in self.echoareas)]
+        found = {message.msgid for message in bundle}
+        self.add_misses([msgid for msgid in msgids if msgid not in found])
+        return self.base.save_messages(bundle)
+
+    def get_message_data(self, msgid: str) -> bytes:
+        """
+        Get message bytes from base, fetching it from uplink if missing.
+
+        Args:
+            msgid (str): Msgid.
+
+        Return:
+            bytes: Message as utf-8 bytes or empty bytes if not found.
+        """
+        data = self.base.get_message_data(msgid)
+        if not data:
+            self.fetch([msgid])
+            data = self.base.get_message_data(msgid)
+        return data
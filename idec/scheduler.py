@@ -0,0 +1,110 @@
+"""
+Adaptive polling schedule for echoareas.
+"""
+
+from time import time
+from typing import Dict, List
+
+
+class Scheduler:
+    """
+    Keeps polling interval for every echoarea. Interval shrinks when
+    echoarea count changes and grows when it does not. Uplink errors
+    postpone polling with exponential backoff.
+
+    Args:
+        echoareas (List): Echoareas names.
+        min_interval (int, optional): Minimal polling interval in seconds.
+        max_interval (int, optional): Maximal polling interval in seconds.
+        max_backoff (int, optional): Maximal delay after errors in seconds.
+    """
+    def __init__(self, echoareas: List[str], min_interval: int = 60,
+                 max_interval: int = 3600, max_backoff: int = 3600):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_backoff = max_backoff
+        self.errors = 0
+        self.counts = {}
+        self.intervals = {}
+        self.next_poll = {}
+        for echoarea in echoareas:
+            self.intervals[echoarea] = min_interval
+            self.next_poll[echoarea] = 0
+
+    def due(self, now: float = None) -> List[str]:
+        """
+        Echoareas which should be polled now.
+
+        Args:
+            now (float, optional): Current timestamp.
+
+        Return:
+            List: Echoareas names.
+        """
+        if now is None:
+            now = time()
+        return [echoarea for echoarea, moment in self.next_poll.items()
+                if moment <= now]
+
+    def update(self, counts: Dict[str, int], now: float = None) -> List[str]:
+        """
+        Update schedule by fresh uplink counts.
+
+        Args:
+            counts (Dict): Uplink counts {"name": int}.
+            now (float, optional): Current timestamp.
+
+        Return:
+            List: Echoareas names which counts changed since last poll.
+        """
+        if now is None:
+            now = time()
+        self.errors = 0
+        changed = []
+        for echoarea, count in counts.items():
+            if echoarea not in self.intervals:
+                continue
+            interval = self.intervals[echoarea]
+            if self.counts.get(echoarea) != count:
+                changed.append(echoarea)
+                interval = max(self.min_interval, interval // 2)
+            else:
+                interval = min(self.max_interval, int(interval * 1.5))
+            self.counts[echoarea] = count
+            self.intervals[echoarea] = interval
+            self.next_poll[echoarea] = now + interval
+        return changed
+
+    def failed(self, echoareas: List[str], now: float = None):
+        """
+        Postpone polling of echoareas after uplink error. Their last
+        counts are forgotten, so next poll reports them as changed and
+        failed download is retried.
+
+        Args:
+            echoareas (List): Echoareas names.
+            now (float, optional): Current timestamp.
+        """
+        if now is None:
+            now = time()
+        self.errors += 1
+        delay = min(self.max_backoff, self.min_interval * 2 ** self.errors)
+        for echoarea in echoareas:
+            self.next_poll[echoarea] = now + delay
+            self.counts.pop(echoarea, None)
+
+    def sleep_time(self, now: float = None) -> float:
+        """
+        Seconds until next echoarea should be polled.
+
+        Args:
+            now (float, optional): Current timestamp.
+
+        Return:
+            float: Seconds to sleep.
+        """
+        if now is None:
+            now = time()
+        if not self.next_poll:
+            return self.max_interval
+        return max(0, min(self.next_poll.values()) - now)
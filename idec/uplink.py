@@ -5,10 +5,20 @@ Copyright (c) 2021, Andrew Lobanov.
 License: GNU GPL 3 (see LICENSE for details).
 """
 
+from base.base import Base
+from base.digest import MAX_PREFIXES
+from base.message import Message
 from base64 import b64encode
-from requests import get, post
+from concurrent.futures import ThreadPoolExecutor
+from os import path, remove, replace
+from requests import get, post, request
 from requests.models import Response
-from typing import Dict, List, Set, Union
+from shutil import copyfileobj
+from typing import Dict, List, Set, Tuple, Union
+
+CHUNK = 1024 * 1024
+# Minimal size of file downloaded by parallel ranges.
+PARALLEL_MIN = 8 * CHUNK
 
 
 class Uplink:
@@ -18,13 +28,15 @@ class Uplink:
     Args:
         url (str): Uplink URL.
         auth (str, optional): Point authstr.
+        trusted (bool, optional): Skip verification of downloaded messages.
     """
-    def __init__(self, url: str, auth: str = None):
+    def __init__(self, url: str, auth: str = None, trusted: bool = False):
         if url.endswith("/"):
             self.url = url
         else:
             self.url = url + "/"
         self.auth = auth
+        self.trusted = trusted
             
     def get_list_txt(self) -> List[Dict[str, str]]:
         """
@@ -93,12 +105,41 @@ class Uplink:
         if depth > 0:
             url += "/-{0}:{0}".format(depth)
         response = get(url)
+        self.check_response(response)
         msgids = []
         for line in response.text.split("\n"):
             if len(line) > 0 and "." not in line:
                 msgids.append(line)
         return msgids
 
+    def get_index_since(self, marks: Dict[str, str]) -> Dict[str, List[str]]:
+        """
+        Downloads msgids added to echoareas after marks (x/since/ scheme).
+
+        Args:
+            marks(dict): Marks of echoareas {"name": "mark"}, where mark
+                         is msgid of echoarea message or unixtime.
+
+        Return:
+            dict: Msgids of echoareas {"name": list(str)} or None if
+                  uplink does not support x/since/.
+        """
+        url = "{}x/since/{}".format(self.url, "/".join(
+            "{}:{}".format(*mark) for mark in marks.items()))
+        response = get(url)
+        self.check_response(response)
+        if response.status_code != 200 or response.text.startswith("error"):
+            return None
+        index = {}
+        echoarea = None
+        for line in response.text.split("\n"):
+            if "." in line:
+                echoarea = line
+                index[echoarea] = []
+            elif len(line) > 0 and echoarea:
+                index[echoarea].append(line)
+        return index
+
     def get_message(self, msgid: str) -> str:
         """
         Downloads message from uplink (m/ scheme).
@@ -127,7 +168,19 @@ class Uplink:
         for i in range(0, len(items), size):
             yield items[i:i + size]
 
-    def get_bundle(self, msgids: List[str]) -> List[Dict[str, str]]:
+    @staticmethod
+    def check_response(response: Response):
+        """
+        Raise IOError if uplink rejected request by admission control.
+
+        Args:
+            response (Response): Uplink response.
+        """
+        if response.status_code in (413, 429, 503):
+            raise IOError("request rejected: HTTP {}".format(
+                response.status_code))
+
+    def get_bundle(self, msgids: List[str]) -> List[Message]:
         """
         Downloads message bundle from uplink.
 
@@ -135,20 +188,48 @@ class Uplink:
             msgids(List): List of msgids.
 
         Return:
-            list(dict): List of dicts {"msgid", "encoded"},
-                        where "encoded" contains encoded message.
+            list(Message): List of messages. Messages are decoded on
+                           first access to their text.
         """
         blocks = self.split(msgids)
         bundle = []
         for block in blocks:
             print("fetch", "{}/u/m/{}".format(self.url, "/".join(block)))
             response = get("{}/u/m/{}".format(self.url, "/".join(block)))
-            for line in response.text.split("\n"):
-                if len(line) > 0:
-                    bundled = line.split(":")
-                    bundle.append({"msgid": bundled[0], "encoded": bundled[1]})
+            self.check_response(response)
+            bundle += Base.parse_bundle(response.text)
         return bundle
 
+    def get_thread(self, msgid: str) -> List[str]:
+        """
+        Downloads msgids of whole thread (x/thread/ scheme).
+
+        Args:
+            msgid(str): Msgid of any message of thread.
+
+        Return:
+            list(str): List of msgids. Root message first.
+        """
+        response = get("{}x/thread/{}".format(self.url, msgid))
+        msgids = []
+        for line in response.text.split("\n"):
+            if len(line) > 0:
+                msgids.append(line)
+        return msgids
+
+    def get_thread_bundle(self, msgid: str) -> List[Message]:
+        """
+        Downloads all messages of thread by one request (u/thread/ scheme).
+
+        Args:
+            msgid(str): Msgid of any message of thread.
+
+        Return:
+            list(Message): List of messages.
+        """
+        response = get("{}u/thread/{}".format(self.url, msgid))
+        return list(Base.parse_bundle(response.text))
+
     def send_message(self, message: str) -> str:
         """
         Sends message to uplink.
@@ -185,6 +266,7 @@ class Uplink:
             dict: Dict of echoareas counts {"name"}.
         """
         response = get("{}/x/c/{}".format(self.url, "/".join(echoareas)))
+        self.check_response(response)
         counts = {}
         for line in response.text.split("\n"):
             if len(line) > 0:
@@ -192,6 +274,76 @@ class Uplink:
                 counts[count[0]] = int(count[1])
         return counts
 
+    def get_digests(self, echoareas: List[str]) -> Dict[str,
+                                                        Tuple[int, int]]:
+        """
+        Downloads echoareas counts and digests (x/c/?digest scheme).
+
+        Args:
+            echoareas(list): Echoareas names list.
+
+        Return:
+            dict: Counts and digests {"name": (int, int)} or None if uplink
+                  does not support digests.
+        """
+        response = get("{}x/c/{}?digest".format(self.url, "/".join(echoareas)))
+        self.check_response(response)
+        digests = {}
+        for line in response.text.split("\n"):
+            if len(line) > 0:
+                digest = line.split(":")
+                if len(digest) != 3:
+                    return None
+                digests[digest[0]] = (int(digest[1]), int(digest[2], 16))
+        return digests
+
+    def get_digest_children(self, echoarea: str, prefixes: List[str]
+                            ) -> Dict[str, Tuple[int, int]]:
+        """
+        Downloads counts and digests of child buckets of msgid prefixes
+        (x/d/?prefixes scheme). Prefixes are sent by batches of
+        MAX_PREFIXES.
+
+        Args:
+            echoarea(str): Echoarea name.
+            prefixes(list): Msgid prefixes of parent buckets.
+
+        Return:
+            dict: Non-empty child buckets {"prefix": (int, int)}.
+        """
+        children = {}
+        for block in self.split(prefixes, MAX_PREFIXES):
+            response = get("{}x/d/{}?prefixes={}".format(self.url, echoarea,
+                                                          ",".join(block)))
+            self.check_response(response)
+            for line in response.text.split("\n"):
+                child = line.split(":")
+                if len(child) == 3:
+                    children[child[0]] = (int(child[1]), int(child[2], 16))
+        return children
+
+    def get_digest_msgids(self, echoarea: str,
+                          prefixes: List[str]) -> List[str]:
+        """
+        Downloads msgids of msgid prefixes buckets (x/d/?msgids scheme).
+        Prefixes are sent by batches of MAX_PREFIXES.
+
+        Args:
+            echoarea(str): Echoarea name.
+            prefixes(list): Msgid prefixes.
+
+        Return:
+            list(str): Msgids.
+        """
+        msgids = []
+        for block in self.split(prefixes, MAX_PREFIXES):
+            response = get("{}x/d/{}?msgids&prefixes={}".format(
+                self.url, echoarea, ",".join(block)))
+            self.check_response(response)
+            msgids += [msgid for msgid in response.text.split("\n")
+                       if Base.is_msgid(msgid)]
+        return msgids
+
     def get_filelist(self):
         """
         Downloads files list available for file request.
@@ -227,27 +379,115 @@ class Uplink:
             response (Response): HTTP-response with downloaded file.
         """
         response.raw.decode_content = True
-        path = destination
-        if not path.endswith("/"):
-            path += "/"
-        with open(path + filename, "wb") as f:
-            for chunk in response.iter_content(1024):
+        with open(path.join(destination, filename), "wb") as f:
+            for chunk in response.iter_content(CHUNK):
                 f.write(chunk)
 
-    def download_file(self, destination: str, filename: str):
+    @staticmethod
+    def fetch_range(method: str, url: str, filename: str, start: int = 0,
+                    end: int = None, data: Dict[str, str] = None):
+        """
+        Download bytes range of file appending them to partial file.
+        Download is resumed from partial file size.
+
+        Args:
+            method (str): HTTP method.
+            url (str): File URL.
+            filename (str): Partial filename.
+            start (int, optional): First byte of range.
+            end (int, optional): Last byte of range. End of file by default.
+            data (Dict, optional): POST data.
+        """
+        offset = path.getsize(filename) if path.exists(filename) else 0
+        if end is not None and start + offset > end:
+            return
+        headers = {"Accept-Encoding": "identity"}
+        if start + offset or end is not None:
+            headers["Range"] = "bytes={}-{}".format(
+                start + offset, "" if end is None else end)
+        response = request(method, url, data=data, headers=headers,
+                           stream=True)
+        Uplink.check_response(response)
+        if response.status_code == 416:
+            return
+        if response.status_code not in (200, 206):
+            raise IOError("download failed: HTTP {}".format(
+                response.status_code))
+        mode = "ab" if response.status_code == 206 else "wb"
+        if mode == "wb" and (start or end is not None):
+            raise IOError("download failed: ranges are not supported")
+        with open(filename, mode, buffering=CHUNK) as f:
+            for chunk in response.iter_content(CHUNK):
+                f.write(chunk)
+
+    def fetch_file(self, method: str, url: str, filename: str,
+                   size: int = None, data: Dict[str, str] = None,
+                   parts: int = 1):
+        """
+        Download file to filename. Partial download is kept in
+        "<filename>.part" and resumed by Range request on next call.
+        Large files of known size can be downloaded by parallel ranges.
+
+        Args:
+            method (str): HTTP method.
+            url (str): File URL.
+            filename (str): Saved filename.
+            size (int, optional): Expected file size from file index.
+            data (Dict, optional): POST data.
+            parts (int, optional): Count of parallel ranges.
+        """
+        part = filename + ".part"
+        if parts > 1 and size and size >= PARALLEL_MIN and \
+                not path.exists(part):
+            step = -(-size // parts)
+            ranges = [(i, min(i + step, size) - 1)
+                      for i in range(0, size, step)]
+            names = ["{}{}".format(part, n) for n in range(len(ranges))]
+            with ThreadPoolExecutor(len(ranges)) as executor:
+                for future in [executor.submit(self.fetch_range, method,
+                                               url, name, start, end, data)
+                               for name, (start, end)
+                               in zip(names, ranges)]:
+                    future.result()
+            with open(part + ".tmp", "wb") as f:
+                for name in names:
+                    with open(name, "rb") as p:
+                        copyfileobj(p, f, CHUNK)
+            replace(part + ".tmp", part)
+            for name in names:
+                remove(name)
+        else:
+            self.fetch_range(method, url, part, data=data)
+        if size is not None and path.getsize(part) != size:
+            actual = path.getsize(part)
+            if actual > size:
+                remove(part)
+            raise IOError("download failed: size {} instead of {}".format(
+                actual, size))
+        replace(part, filename)
+
+    def download_file(self, destination: str, filename: str,
+                      size: int = None, parts: int = 1):
         """
         Downloads a file using file request and save it at destination.
 
         Args:
             filename (str): Filename.
             destination (str): The path of the saved file.
+            size (int, optional): File size. Taken from file list if not
+                                  set.
+            parts (int, optional): Count of parallel ranges.
         """
         data = {
             "pauth": self.auth,
             "filename": filename
         }
-        response = post(self.url + "x/file", data=data, stream=True)
-        self.save_file(destination, filename, response)
+        if size is None:
+            for file in self.get_filelist():
+                if file["name"] == filename:
+                    size = file["size"]
+        self.fetch_file("POST", self.url + "x/file",
+                        path.join(destination, filename), size, data, parts)
 
     def get_f_list_txt(self) -> List[Dict[str, Union[str, int]]]:
         """
@@ -319,20 +559,22 @@ class Uplink:
         return files
 
     def download_fileechoarea_file(self, fecho: str, fid_name: str,
-                                   destination: str):
+                                   destination: str, parts: int = 1):
         """
         Downloads a file from fileechoarea and save it at destination.
 
         Args:
             fecho (str): Fileechoarea name.
             fid_name (str): Fid and filename in format "fid:filename".
-                           Can be a full line of fileechoarea index.
+                           Can be a full line of fileechoarea index, then
+                           size of downloaded file is verified.
             destination (str): The path of the saved file.
+            parts (int, optional): Count of parallel ranges.
         """
         frow = fid_name.split(":")
-        response = get("{}f/f/{}/{}".format(self.url, fecho, frow[0]),
-                       stream=True)
-        self.save_file(destination, frow[1], response)
+        size = int(frow[2]) if len(frow) > 2 and frow[2].isdigit() else None
+        self.fetch_file("GET", "{}f/f/{}/{}".format(self.url, fecho, frow[0]),
+                        path.join(destination, frow[1]), size, parts=parts)
 
     def send_file_to_fileechoarea(self, fecho: str, filename: str,
                                   description: str) -> str:
@@ -352,10 +594,8 @@ class Uplink:
             "fecho": fecho,
             "dsc": description
         }
-        files = {
-            "file": open(filename, "rb")
-        }
-        response = post(self.url + "f/p", data=data, files=files)
+        with open(filename, "rb") as f:
+            response = post(self.url + "f/p", data=data, files={"file": f})
         return response.text
 
     def push(self, auth: str, bundle: str, echoarea: str) -> str:
@@ -376,4 +616,5 @@ class Uplink:
             "echoarea": echoarea
         }
         response = post(self.url + "u/push", data=data)
+        self.check_response(response)
         return response.text
@@ -1,4 +1,4 @@
-from base.sqlite import Sqlite
+from base.backends import open_base
 import json
 import sys
 
@@ -9,7 +9,8 @@ def usage():
 
 
 config = json.loads(open("server.json").read())
-base = Sqlite(config["base"])
+config.pop("bloom", None)
+base = open_base(config)
 args = sys.argv
 if len(args) == 1 or args[1] == "-h":
     usage()
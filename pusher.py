@@ -0,0 +1,42 @@
+import json
+import sys
+import time
+from idec.client import Client
+from base.backends import open_base
+from typing import Dict, List, Union
+from idec.uplink import Uplink
+
+
+def load_config(filename: str = "fetcher.json") -> Dict[str,
+                                                        Union[str, List[str]]]:
+    return json.loads(open(filename).read())
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        config = load_config(sys.argv[1])
+    else:
+        config = load_config()
+    base = open_base(config)
+    uplink = Uplink(config.get("uplink") or config["uplinks"][0])
+    client = Client(uplink, base, config["echoareas"])
+    interval = config.get("push_interval", 5)
+    last_counts = {}
+    try:
+        while True:
+            counts = base.get_counts(config["echoareas"])
+            if counts != last_counts:
+                try:
+                    pushed, errors = client.push_mail(config["nauth"])
+                except OSError as e:
+                    print("push error:", e)
+                else:
+                    if pushed > 0:
+                        print(pushed, "messages pushed.")
+                    for echoarea, status in errors.items():
+                        print(echoarea, status)
+                    if not errors:
+                        last_counts = counts
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
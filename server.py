@@ -1,8 +1,149 @@
-from base64 import urlsafe_b64encode
-from bottle import post, request, response, route, run
-from base.sqlite import Sqlite
+from bottle import HTTPResponse, post, request, response, route, run, \
+    static_file
+from base.backends import open_base
+from base.base import Base
+from base.digest import DEPTH, MAX_PREFIXES, DigestIndex
+from base.fileechoes import FileEchoes
+from base.memindex import MemoryIndex
+from base.message import Message
+from base.verify import verify_bundle
+from functools import wraps
+from idec.admission import Admission
+from idec.proxy import Proxy
+from idec.uplink import Uplink
+from itertools import islice
+from socketserver import ThreadingMixIn
+from typing import Callable, Dict, List
+from wsgiref.simple_server import WSGIServer
 import json
 
+# Messages count verified and saved at once by u/push.
+PUSH_BATCH = 1000
+# Maximal size of f/p form fields and multipart headers besides file.
+FORM_OVERHEAD = 64 * 1024
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """
+    Standard library WSGI server handling every request in own thread.
+    """
+    daemon_threads = True
+
+
+class SlotBody:
+    """
+    Streamed response body which frees admission slot of endpoints class
+    when server closes it after sending, so slot is held during whole
+    file transfer. Other attributes are taken from wrapped body, so files
+    are still served by wsgi.file_wrapper.
+
+    Args:
+        body (object): File or iterator.
+        cls (str): Endpoints class.
+    """
+    def __init__(self, body: object, cls: str):
+        self.body = body
+        self.cls = cls
+        self.released = False
+
+    def __getattr__(self, name: str) -> object:
+        return getattr(self.body, name)
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        """
+        Close wrapped body and free slot once.
+        """
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            if not self.released:
+                self.released = True
+                admission.release(self.cls)
+
+
+def hold_slot(result: object, cls: str) -> object:
+    """
+    Free slot of endpoints class after callback returned, or after
+    streamed body is sent if result is file or iterator.
+
+    Args:
+        result (object): Callback result.
+        cls (str): Endpoints class.
+
+    Return:
+        object: Callback result with streamed body wrapped.
+    """
+    body = result.body if isinstance(result, HTTPResponse) else result
+    if not hasattr(body, "read") and not hasattr(body, "close"):
+        admission.release(cls)
+        return result
+    if isinstance(result, HTTPResponse):
+        result.body = SlotBody(body, cls)
+        return result
+    return SlotBody(body, cls)
+
+
+def admitted(cls: str) -> Callable:
+    """
+    Decorator of route callbacks. Rejects request with 429 status if
+    client exceeded requests rate and with 503 status if no slot of
+    endpoints class was freed during admission timeout. Slot is held
+    until streamed response body is closed.
+
+    Args:
+        cls (str): Endpoints class.
+
+    Return:
+        Callable: Decorator.
+    """
+    def decorator(callback: Callable) -> Callable:
+        @wraps(callback)
+        def wrapper(*args, **kwargs):
+            if not admission.allow(request.remote_addr or ""):
+                response.status = 429
+                response.set_header("Content-Type",
+                                    "text/plain; charset=utf-8")
+                response.set_header("Retry-After", "1")
+                return "error: too many requests\n"
+            if not admission.acquire(cls):
+                response.status = 503
+                response.set_header("Content-Type",
+                                    "text/plain; charset=utf-8")
+                response.set_header("Retry-After", "1")
+                return "error: server is busy\n"
+            try:
+                result = callback(*args, **kwargs)
+            except BaseException:
+                admission.release(cls)
+                raise
+            return hold_slot(result, cls)
+        return wrapper
+    return decorator
+
+
+def check_limit(count: int, key: str, name: str) -> str:
+    """
+    Check count of requested items does not exceed configured limit.
+    Sets 413 status if it does.
+
+    Args:
+        count (int): Count of requested echoareas or msgids.
+        key (str): Limit name in limits config.
+        name (str): Items name for error message.
+
+    Return:
+        str: Error message or empty string.
+    """
+    limit = limits.get(key)
+    if limit and count > limit:
+        response.status = 413
+        return "error: too many {}\n".format(name)
+    return ""
+
 
 @route("/")
 def index():
@@ -18,7 +159,7 @@ def echoareas_list():
     echoareas = []
     for echoarea in config["echoareas"]:
         echoareas.append(echoarea["name"])
-    counts = base.get_counts(echoareas)
+    counts = get_counts(echoareas)
     list_txt = []
     for echoarea in config["echoareas"]:
         list_txt.append("{}:{}:{}".format(
@@ -35,21 +176,90 @@ def blacklist():
     return "\n".join(base.get_blacklist()) + "\n\n"
 
 
+def get_counts(echoareas: List[str]) -> Dict[str, int]:
+    """
+    Count messages of echoareas using memory index if it enabled.
+
+    Args:
+        echoareas (List): Echoareas names.
+
+    Return:
+        Dict: Dict of echoareas counts (str) {"name": int}.
+    """
+    if memindex:
+        return memindex.get_counts(echoareas)
+    return base.get_counts(echoareas)
+
+
+def index_slice(count: int, start: int, end: int, slc: bool) -> slice:
+    """
+    Convert u/e/ slice arguments to slice of echoarea index.
+
+    Args:
+        count (int): Messages count of echoarea.
+        start (int): Slice start.
+        end (int): Slice length.
+        slc (bool): True if slice was requested.
+
+    Return:
+        slice: Slice of index.
+    """
+    ss = start
+    if start < 0 and start + count < 0:
+        ss = 0
+    elif start > count:
+        ss = end * -1
+    if start + end == 0:
+        return slice(ss, None)
+    elif slc:
+        return slice(ss, ss + end)
+    return slice(None)
+
+
+def get_records(echoarea: str, start: int = 0, end: int = 0,
+                slc: bool = False) -> bytes:
+    """
+    Get slice of echoarea index as "msgid\\n" records.
+
+    Args:
+        echoarea (str): Echoarea name.
+        start (int, optional): Slice start.
+        end (int, optional): Slice length.
+        slc (bool, optional): True if slice was requested.
+
+    Return:
+        bytes: Msgids records.
+    """
+    count = memindex.count(echoarea) if memindex else None
+    if count is None:
+        index = base.get_index([echoarea])
+        index = index[index_slice(len(index), start, end, slc)]
+        return "".join(msgid + "\n" for msgid in index).encode("utf-8")
+    first, last, _ = index_slice(count, start, end, slc).indices(count)
+    return memindex.index(echoarea, first, last)
+
+
 @route("/e/<echoarea>")
+@admitted("index")
 def echoarea_index(echoarea):
     response.set_header("Content-Type", "text/plain; charset=utf-8")
     response.set_header("Access-Control-Allow-Origin", "*")
-    return "\n".join(base.get_index([echoarea])) + "\n\n"
+    records = get_records(echoarea)
+    return iter([records, b"\n" if records else b"\n\n"])
 
 
 @route("/m/<msgid>")
+@admitted("bundle")
 def message(msgid):
     response.set_header("Content-Type", "text/plain; charset=utf-8")
     response.set_header("Access-Control-Allow-Origin", "*")
-    return base.get_message(msgid)
+    if proxy:
+        return proxy.get_message_data(msgid)
+    return base.get_message_data(msgid)
 
 
 @route("/u/e/<echoareas:path>")
+@admitted("index")
 def universal_echoareas_index(echoareas):
     response.set_header("Content-Type", "text/plain; charset=utf-8")
     echoareas = echoareas.split("/")
@@ -58,37 +268,84 @@ def universal_echoareas_index(echoareas):
         slc = echoareas[-1].split(":")
         start, end, slc = int(slc[0]), int(slc[1]), True
         echoareas = echoareas[:-1]
+    error = check_limit(len(echoareas), "max_echoareas", "echoareas")
+    if error:
+        return error
     ue_index = []
     for echoarea in echoareas:
+        ue_index.append(echoarea.encode("utf-8") + b"\n")
+        ue_index.append(get_records(echoarea, start, end, slc))
+    ue_index.append(b"\n")
+    return iter(ue_index)
+
+
+def build_bundle(msgids: List[str]) -> str:
+    """
+    Build bundle of messages.
+
+    Args:
+        msgids (List): Msgids.
+
+    Return:
+        str: Bundle in "msgid:base64" format.
+    """
+    if proxy:
+        proxy.fetch(msgids)
+    bundle = []
+    for message in base.get_bundle(msgids):
+        bundle.append(message.msgid + ":" + message.encoded)
+    return "\n".join(bundle) + "\n\n"
+
+
+@route("/x/since/<marks:path>")
+@admitted("index")
+def echoareas_index_since(marks):
+    response.set_header("Content-Type", "text/plain; charset=utf-8")
+    marks = marks.split("/")
+    error = check_limit(len(marks), "max_echoareas", "echoareas")
+    if error:
+        return error
+    since = {}
+    for mark in marks:
+        echoarea, _, mark = mark.partition(":")
+        if not Base.is_msgid(mark) and not mark.isdigit():
+            return "error: wrong mark " + mark
+        since[echoarea] = mark
+    index = base.get_index_since(since)
+    ue_index = []
+    for echoarea, msgids in index.items():
         ue_index.append(echoarea)
-        ss = start
-        index = base.get_index([echoarea])
-        if start < 0 and start + len(index) < 0:
-            ss = 0
-        elif start > len(index):
-            ss = end * -1
-        if start + end == 0:
-            ue_index = ue_index + index[ss:]
-        elif slc:
-            ue_index = ue_index + index[ss:ss + end]
-        else:
-            ue_index = ue_index + index
+        ue_index += msgids
     return "\n".join(ue_index) + "\n\n"
 
 
 @route("/u/m/<msgids:path>")
+@admitted("bundle")
 def universal_bundle(msgids):
     response.set_header("Content-Type", "text/plain; charset=utf-8")
-    bundle = []
-    for msgid in msgids.split("/"):
-        if base.is_message_exists(msgid):
-            encoded = urlsafe_b64encode(base.get_message(msgid).encode())
-            bundle.append(msgid + ":" + encoded.decode("utf-8"))
-    return "\n".join(bundle) + "\n\n"
+    msgids = msgids.split("/")
+    return check_limit(len(msgids), "max_msgids", "msgids") or \
+        build_bundle(msgids)
+
+
+@route("/x/thread/<msgid>")
+@admitted("bundle")
+def thread_index(msgid):
+    response.set_header("Content-Type", "text/plain; charset=utf-8")
+    response.set_header("Access-Control-Allow-Origin", "*")
+    return "\n".join(base.get_thread(msgid)) + "\n\n"
+
+
+@route("/u/thread/<msgid>")
+@admitted("bundle")
+def thread_bundle(msgid):
+    response.set_header("Content-Type", "text/plain; charset=utf-8")
+    return build_bundle(base.get_thread(msgid))
 
 
 @post("/u/point")
 @route("/u/point/<pauth>/<tmsg>")
+@admitted("write")
 def receive_message(pauth: str = "", tmsg: str = ""):
     response.set_header("Content-Type", "text/plain; charset=utf-8")
     response.set_header("Access-Control-Allow-Origin", "*")
@@ -98,21 +355,321 @@ def receive_message(pauth: str = "", tmsg: str = ""):
     point = base.check_point(config["nodename"], pauth)
     if point:
         status = base.toss_message(point, tmsg)
+        if memindex and status.startswith("msg ok"):
+            msgid = status.split(":", 1)[1]
+            sync_memindex(Message(base.get_message(msgid), msgid).echoarea)
         return status
     return "error:login incorrect"
 
 
+def sync_memindex(echoarea: str):
+    """
+    Add new messages of echoarea to memory index if it enabled. Diverged
+    echoarea index is rebuilt from base.
+
+    Args:
+        echoarea (str): Echoarea name.
+    """
+    if memindex and echoarea in memindex.buffers:
+        if not memindex.sync(echoarea, True):
+            memindex.load(echoarea, False)
+
+
+def check_node(nauth: str) -> str:
+    """
+    Check node authstr for push.
+
+    Args:
+        nauth (str): Node authstr.
+
+    Return:
+        str: Node name or empty string.
+    """
+    for node in config.get("nodes", []):
+        if nauth and node["auth"] == nauth:
+            return node["name"]
+    return ""
+
+
+@post("/u/push")
+@admitted("write")
+def receive_push():
+    response.set_header("Content-Type", "text/plain; charset=utf-8")
+    node = check_node(request.POST.get("nauth", ""))
+    if not node:
+        return "error: no auth"
+    echoarea = request.POST.get("echoarea", "")
+    echoareas = [echoarea["name"] for echoarea in config["echoareas"]]
+    if echoarea not in echoareas:
+        return "error: wrong echoarea"
+    upush = request.POST.get("upush", "")
+    error = check_limit(upush.count(":"), "max_msgids", "msgids")
+    if error:
+        return error
+    bundle = Base.parse_bundle(upush)
+    broken = []
+    while True:
+        batch = list(islice(bundle, PUSH_BATCH))
+        if not batch:
+            break
+        if node not in trusted_nodes:
+            batch, rejected = verify_bundle(batch)
+            broken.extend(rejected)
+        for message in batch:
+            if message.echoarea != echoarea:
+                broken.append(message.msgid)
+        base.save_messages([message for message in batch
+                            if message.echoarea == echoarea])
+    sync_memindex(echoarea)
+    if broken:
+        return "error: broken messages " + ",".join(broken)
+    return "message saved: ok"
+
+
 @route("/x/c/<echoareas:path>")
+@admitted("index")
 def echoareas_count(echoareas: str):
     response.set_header("Content-Type", "text/plain; charset=utf-8")
     echoareas = echoareas.split("/")
-    counts = base.get_counts(echoareas)
+    error = check_limit(len(echoareas), "max_echoareas", "echoareas")
+    if error:
+        return error
+    if "digest" in request.query:
+        xc = ""
+        for echoarea in echoareas:
+            digest = (0, 0)
+            if echoarea in served_echoareas:
+                digest = digests.get(echoarea)
+            xc += "{}:{}\n".format(echoarea, DigestIndex.format(*digest))
+        return xc
+    counts = get_counts(echoareas)
     xc = ""
     for echoarea in echoareas:
         xc += "{}:{}\n".format(echoarea, counts[echoarea])
     return xc
 
 
+@route("/x/d/<echoarea>")
+@route("/x/d/<echoarea>/<prefix>")
+@admitted("index")
+def echoarea_digests(echoarea: str, prefix: str = ""):
+    response.set_header("Content-Type", "text/plain; charset=utf-8")
+    if echoarea not in served_echoareas:
+        return "error: wrong echoarea"
+    prefixes = [prefix]
+    if "prefixes" in request.query:
+        prefixes = request.query.get("prefixes").split(",")
+    if len(prefixes) > MAX_PREFIXES:
+        return "error: too many prefixes"
+    for prefix in prefixes:
+        if len(prefix) > DEPTH or prefix and not prefix.isalnum():
+            return "error: wrong prefix"
+    if "msgids" in request.query:
+        return "".join(msgid + "\n" for msgid in
+                       sorted(digests.msgids(echoarea, prefixes)))
+    if any(len(prefix) == DEPTH for prefix in prefixes):
+        return "error: wrong prefix"
+    children = digests.children(echoarea, prefixes)
+    return "".join("{}:{}\n".format(child,
+                                    DigestIndex.format(*children[child]))
+                   for child in sorted(children))
+
+
+@route("/x/stats/echo/<echoarea>")
+@admitted("index")
+def echoarea_stats(echoarea: str):
+    response.set_header("Content-Type", "application/json; charset=utf-8")
+    response.set_header("Access-Control-Allow-Origin", "*")
+    try:
+        days = max(1, min(int(request.query.get("days", 30)), 366))
+        top = max(1, min(int(request.query.get("top", 10)), 100))
+    except ValueError:
+        return json.dumps({"error": "wrong arguments"})
+    stats = base.get_echoarea_stats(echoarea, days, top)
+    if stats is None:
+        return json.dumps({"error": "stats not supported"})
+    return json.dumps(stats, ensure_ascii=False)
+
+
+def file_response(filename: str, root: str, name: str = None):
+    """
+    Serve file by static_file, which streams it by wsgi.file_wrapper
+    (sendfile where server supports it) and answers Range requests.
+
+    Args:
+        filename (str): Filename in root directory.
+        root (str): Files directory.
+        name (str, optional): Filename for client. Same as stored
+                              filename by default.
+
+    Return:
+        HTTPResponse: File response.
+    """
+    return static_file(filename, root=root, download=name or filename,
+                       mimetype="application/octet-stream")
+
+
+@route("/x/filelist")
+@post("/x/filelist")
+@admitted("files")
+def file_list():
+    response.set_header("Content-Type", "text/plain; charset=utf-8")
+    return "".join(line + "\n" for line in base.file_list())
+
+
+@post("/x/file")
+@admitted("files")
+def file_request():
+    response.set_header("Content-Type", "text/plain; charset=utf-8")
+    if not base.check_point(config["nodename"],
+                            request.POST.get("pauth", "")):
+        return "error: no auth"
+    filename = request.POST.getunicode("filename", "")
+    names = [line.split(":")[0] for line in base.file_list()]
+    if filename not in names:
+        return "error: file not found"
+    return file_response(filename, config.get("files", "files"))
+
+
+@route("/f/list.txt")
+def fileechoareas_list():
+    response.set_header("Content-Type", "text/plain; charset=utf-8")
+    response.set_header("Access-Control-Allow-Origin", "*")
+    fechoes = config.get("fileechoareas", [])
+    counts = fileechoes.get_counts([fecho["name"] for fecho in fechoes])
+    return "".join("{}:{}:{}\n".format(fecho["name"], counts[fecho["name"]],
+                                       fecho["description"])
+                   for fecho in fechoes)
+
+
+@route("/f/blacklist.txt")
+def fileechoareas_blacklist():
+    response.set_header("Content-Type", "text/plain; charset=utf-8")
+    return "".join(fid + "\n" for fid in fileechoes.get_blacklist())
+
+
+@route("/f/c/<fechoes:path>")
+@admitted("index")
+def fileechoareas_count(fechoes: str):
+    response.set_header("Content-Type", "text/plain; charset=utf-8")
+    fechoes = fechoes.split("/")
+    error = check_limit(len(fechoes), "max_echoareas", "fileechoareas")
+    if error:
+        return error
+    counts = fileechoes.get_counts(fechoes)
+    return "".join("{}:{}\n".format(*count) for count in counts.items())
+
+
+@route("/f/e/<fechoes:path>")
+@admitted("index")
+def fileechoareas_index(fechoes: str):
+    response.set_header("Content-Type", "text/plain; charset=utf-8")
+    fechoes = fechoes.split("/")
+    start, end, slc = 0, 0, False
+    if ":" in fechoes[-1]:
+        try:
+            start, end = [int(x) for x in fechoes[-1].split(":")]
+        except ValueError:
+            return "error: wrong slice"
+        slc = True
+        fechoes = fechoes[:-1]
+    error = check_limit(len(fechoes), "max_echoareas", "fileechoareas")
+    if error:
+        return error
+    fe_index = []
+    blacklist = set(fileechoes.get_blacklist())
+    for fecho in fechoes:
+        index = [line for line in fileechoes.get_index(fecho)
+                 if line.split(":", 1)[0] not in blacklist]
+        fe_index.append(fecho)
+        fe_index += index[index_slice(len(index), start, end, slc)]
+    return "\n".join(fe_index) + "\n"
+
+
+@route("/f/f/<fecho>/<fid>")
+@admitted("files")
+def fileechoarea_file(fecho: str, fid: str):
+    response.set_header("Content-Type", "text/plain; charset=utf-8")
+    file = fileechoes.get_file(fecho, fid)
+    if not file:
+        return "error: file not found"
+    return file_response(fid, file["root"], file["filename"])
+
+
+@post("/f/p")
+@admitted("write")
+def receive_file():
+    response.set_header("Content-Type", "text/plain; charset=utf-8")
+    max_size = config.get("max_file_size")
+    if max_size is not None and \
+            request.content_length > max_size + FORM_OVERHEAD:
+        response.status = 413
+        return "error: file too big"
+    point = base.check_point(config["nodename"],
+                             request.POST.get("pauth", ""))
+    if not point:
+        return "error: no auth"
+    fecho = request.POST.getunicode("fecho", "")
+    if fecho not in [x["name"] for x in config.get("fileechoareas", [])]:
+        return "error: wrong fileechoarea"
+    upload = request.files.get("file")
+    if upload is None:
+        return "error: no file"
+    fid = fileechoes.add_file(fecho, upload.file, upload.filename,
+                              point["address"],
+                              request.POST.getunicode("dsc", "")[:1024],
+                              max_size)
+    if not fid:
+        return "error: file too big"
+    return "file ok:" + fid
+
+
+@route("/x/search")
+@admitted("index")
+def search():
+    response.set_header("Content-Type", "text/plain; charset=utf-8")
+    response.set_header("Access-Control-Allow-Origin", "*")
+    query = request.query.getunicode("q", "")
+    echoarea = request.query.getunicode("echo", "")
+    try:
+        since = int(request.query.get("from", 0))
+        until = int(request.query.get("to", 0))
+        limit = max(1, min(int(request.query.get("limit", 20)), 100))
+    except ValueError:
+        return "error: wrong arguments"
+    results = base.search(query, echoarea, since, until, limit)
+    return "".join("{}:{}\n".format(result["msgid"],
+                                     result["snippet"].replace("\n", " "))
+                   for result in results)
+
+
 config = json.loads(open("server.json").read())
-base = Sqlite(config["base"])
-run(host="0.0.0.0", port=62220)
+base = open_base(config)
+limits = config.get("limits", {})
+admission = Admission(limits.get("rate", 0), limits.get("burst", 1),
+                      limits.get("concurrency"), limits.get("timeout", 1.0))
+trusted_nodes = [node["name"] for node in config.get("nodes", [])
+                 if node.get("trusted")]
+fileechoes = FileEchoes(config.get("fileechoes", "fileechoes"))
+served_echoareas = [echoarea["name"] for echoarea in config["echoareas"]]
+digests = DigestIndex(base, config.get("memindex", {}).get("ttl", 1.0))
+proxy = None
+if "proxy" in config:
+    proxy = Proxy(base, Uplink(config["proxy"]["uplink"],
+                               trusted=config["proxy"].get("trusted", False)),
+                  [x["name"] for x in config["echoareas"]],
+                  config["proxy"].get("timeout", 10.0),
+                  config["proxy"].get("miss_ttl", 300.0),
+                  config["proxy"].get("max_fetch", 100))
+memindex = None
+if "memindex" in config:
+    memindex = MemoryIndex(base, [x["name"] for x in config["echoareas"]],
+                           **config["memindex"])
+server = config.get("server", "threaded")
+if server == "threaded":
+    run(host="0.0.0.0", port=62220, server="wsgiref",
+        server_class=ThreadingWSGIServer)
+else:
+    run(host="0.0.0.0", port=62220, server=server)
+if memindex:
+    memindex.save()